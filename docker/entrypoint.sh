@@ -128,4 +128,5 @@ done
 echo "Starting charging server"
 
 python3 manage.py migrate
+python3 manage.py build_entitlements
 gunicorn wsgi:application --workers 1 --forwarded-allow-ips "*" --log-file - --bind 0.0.0.0:8006 --log-level ${LOGLEVEL}
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Benchmark of the pay-per-use aggregation of the PriceResolver. The time per SDR
+must stay constant as the number of SDRs and price components grows.
+
+It also compares resolving the prices of many contracts one by one with the
+batch resolution, which compiles each distinct pricing model once.
+
+Usage (from the src directory): python -m benchmarks.price_resolver
+"""
+
+import timeit
+from decimal import Decimal
+
+from wstore.charging_engine.price_resolver import PriceResolver
+
+UNITS = ["call", "Megabyte", "hour", "device", "message", "event", "request", "second"]
+
+
+def build_pricing_model(components):
+    return {
+        "general_currency": "EUR",
+        "pay_per_use": [
+            {"unit": UNITS[i % len(UNITS)], "value": "0.{:02d}".format(i + 1), "duty_free": "0.0{}".format(i + 1)}
+            for i in range(components)
+        ],
+    }
+
+
+def build_accounting(sdrs):
+    return [
+        {
+            "usage_id": str(i),
+            "unit": UNITS[i % len(UNITS)].upper() if i % 2 else UNITS[i % len(UNITS)],
+            "value": str(Decimal(i % 100) / 10),
+        }
+        for i in range(sdrs)
+    ]
+
+
+def run(sdrs, components, repeat=5):
+    pricing_model = build_pricing_model(components)
+    accounting = build_accounting(sdrs)
+
+    timer = timeit.Timer(lambda: PriceResolver().resolve_price(pricing_model, accounting))
+    return min(timer.repeat(repeat=repeat, number=1))
+
+
+def run_batch(contracts, models, repeat=5):
+    pricing_models = [build_pricing_model(8) for _ in range(models)]
+    for i, pricing_model in enumerate(pricing_models):
+        pricing_model["subscription"] = [{"value": "{}.00".format(i + 1), "duty_free": "{}.00".format(i)}]
+
+    accounting = build_accounting(10)
+    charges = [(pricing_models[i % models], accounting) for i in range(contracts)]
+
+    def one_by_one():
+        for pricing_model, accounting_info in charges:
+            PriceResolver().resolve_price(pricing_model, accounting_info)
+
+    single = min(timeit.Timer(one_by_one).repeat(repeat=repeat, number=1))
+    batch = min(timeit.Timer(lambda: PriceResolver().resolve_prices(charges)).repeat(repeat=repeat, number=1))
+    return single, batch
+
+
+def main():
+    print("{:>8} {:>11} {:>10} {:>12}".format("SDRs", "components", "time (s)", "us per SDR"))
+    for components in (1, 8):
+        for sdrs in (1000, 10000, 50000, 100000):
+            elapsed = run(sdrs, components)
+            print("{:>8} {:>11} {:>10.4f} {:>12.2f}".format(sdrs, components, elapsed, elapsed * 1e6 / sdrs))
+
+    print()
+    print("{:>9} {:>7} {:>14} {:>10}".format("contracts", "models", "one by one (s)", "batch (s)"))
+    for contracts in (1000, 10000):
+        single, batch = run_batch(contracts, 10)
+        print("{:>9} {:>7} {:>14.4f} {:>10.4f}".format(contracts, 10, single, batch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Micro-benchmark of the parsing of SDR dates, comparing the precompiled parser
+with the previous strptime based one.
+
+Usage (from the src directory): python -m benchmarks.sdr_dates
+"""
+
+import timeit
+from datetime import datetime
+
+from wstore.charging_engine.accounting.date_parser import parse_sdr_date
+
+DATES = [
+    "2015-10-20T17:31:57.838123",
+    "2015-10-20 17:31:57.100000",
+    "2015-10-20T17:31:57.8",
+    "2015-10-20T17:31:57+02:00",
+]
+
+
+def legacy_get_datetime(raw_time):
+    try:
+        if "+" in raw_time:
+            time = raw_time.split("+")[0] + ".0"
+        else:
+            sp_time = raw_time.split(".")
+            milis = sp_time[1]
+
+            if len(milis) > 3:
+                milis = milis[:3]
+
+            time = sp_time[0] + "." + milis
+
+        try:
+            time_stamp = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f")
+        except:
+            time_stamp = datetime.strptime(time, "%Y-%m-%d %H:%M:%S.%f")
+    except:
+        raise ValueError("Invalid date format")
+
+    return time_stamp
+
+
+def main(number=100000):
+    print("{:<30} {:>12} {:>12}".format("date", "legacy (us)", "parser (us)"))
+    for raw_time in DATES:
+        assert legacy_get_datetime(raw_time) == parse_sdr_date(raw_time)
+
+        legacy = min(timeit.repeat(lambda: legacy_get_datetime(raw_time), number=number, repeat=3))
+        parser = min(timeit.repeat(lambda: parse_sdr_date(raw_time), number=number, repeat=3))
+        print("{:<30} {:>12.2f} {:>12.2f}".format(raw_time, legacy * 1e6 / number, parser * 1e6 / number))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+from mongodb_migrations.base import BaseMigration
+
+# Document locks written by previous versions are booleans that never expire. Migrations are
+# run with the servers stopped, so the locks still taken were abandoned by a crashed process
+LEGACY_LOCKS = [
+    ("wstore_resource", "_lock_asset"),
+    ("wstore_context", "_lock_ctx"),
+]
+
+
+class Migration(BaseMigration):
+    def upgrade(self):
+        for collection, lock_id in LEGACY_LOCKS:
+            self.db[collection].update_many({lock_id: True}, {"$set": {lock_id: False}})
+
+    def downgrade(self):
+        # Previous versions do not understand leases, so they are released
+        for collection, lock_id in LEGACY_LOCKS:
+            self.db[collection].update_many({lock_id: {"$type": "object"}}, {"$set": {lock_id: False}})
@@ -44,6 +44,23 @@ DATABASES = {
     }
 }
 
+# Size limits of the connection pool shared by the raw MongoDB accesses of a process
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+
+# Connection pools of the HTTP session shared by the clients of the external APIs. Idempotent
+# requests failed because of connection errors or 502, 503 or 504 responses are retried up to
+# HTTP_RETRIES times with exponential backoff
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_SIZE = 20
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.3
+
+# Seconds before the lease of a locked document expires if it is not released
+DOCUMENT_LOCK_TTL = 60
+
 BASEDIR = path.dirname(path.abspath(__file__))
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800
@@ -173,12 +190,22 @@ WSTOREMAILPASS = "wstore_email_passwd"
 SMTPSERVER = "wstore_smtp_server"
 SMTPPORT = 587
 
+# Emails are sent in background by SMTP_SENDERS threads, each one with its own SMTP session,
+# which is closed after SMTP_IDLE_TIMEOUT seconds without emails. Transient errors are retried
+# up to SMTP_MAX_RETRIES times with exponential backoff starting at SMTP_RETRY_DELAY seconds
+SMTP_SENDERS = 2
+SMTP_TIMEOUT = 30
+SMTP_IDLE_TIMEOUT = 60
+SMTP_MAX_RETRIES = 3
+SMTP_RETRY_DELAY = 5
+
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "wstore.store_commons.middleware.AuthenticationMiddleware",
+    "wstore.store_commons.middleware.IdentityMapMiddleware",
 ]
 
 ROOT_URLCONF = "urls"
@@ -198,9 +225,69 @@ TEST_RUNNER = "django_nose.NoseTestSuiteRunner"
 CRONJOBS = [
     ("0 5 * * *", "django.core.management.call_command", ["pending_charges_daemon"]),
     ("0 6 * * *", "django.core.management.call_command", ["resend_cdrs"]),
+    ("30 6 * * *", "django.core.management.call_command", ["resend_ratings"]),
     ("0 4 * * *", "django.core.management.call_command", ["resend_upgrade"]),
+    ("*/5 * * * *", "django.core.management.call_command", ["resume_upgrades"]),
 ]
 
+# CDRs are sent to the RSS in batches of up to CDR_BATCH_SIZE CDRs every CDR_BATCH_INTERVAL seconds.
+# Failed batches are retried with exponential backoff (seconds) up to CDR_MAX_ATTEMPTS times
+CDR_BATCH_SIZE = 100
+CDR_BATCH_INTERVAL = 5
+CDR_MAX_ATTEMPTS = 10
+CDR_RETRY_DELAY = 30
+CDR_MAX_RETRY_DELAY = 3600
+
+# Number of invoices rendered to PDF at the same time
+INVOICE_WORKERS = 2
+
+# Usage documents are retrieved from the usage API in pages of USAGE_PAGE_SIZE documents. Enable
+# USAGE_PRODUCT_FILTER if the usage API supports filtering usage by the value of its characteristics
+USAGE_PAGE_SIZE = 100
+USAGE_PRODUCT_FILTER = False
+
+# Usage documents of a usage charge are rated with USAGE_RATING_WORKERS concurrent requests. Enable
+# USAGE_RATING_BACKGROUND to rate them in a background job once the payment has been confirmed
+USAGE_RATING_WORKERS = 8
+USAGE_RATING_BACKGROUND = False
+
+# Payout batches sent to PayPal are checked in background, up to PAYOUT_POLL_BUDGET batches every
+# PAYOUT_POLL_INTERVAL seconds. The delay between the checks of a batch doubles after every check up
+# to PAYOUT_POLL_MAX_INTERVAL seconds, and batches are no longer checked after PAYOUT_POLL_MAX_AGE seconds
+PAYOUT_POLL_INTERVAL = 5
+PAYOUT_POLL_MAX_INTERVAL = 600
+PAYOUT_POLL_BUDGET = 20
+PAYOUT_POLL_MAX_AGE = 259200
+
+# Inventory products are upgraded with INVENTORY_UPGRADE_WORKERS concurrent requests, retrieving up to
+# INVENTORY_UPGRADE_PREFETCH pages in advance. Running upgrades refresh their checkpoint every
+# INVENTORY_UPGRADE_HEARTBEAT seconds; the ones not refreshed for INVENTORY_UPGRADE_STALE seconds are
+# considered interrupted and resumed by the resume_upgrades cron job
+INVENTORY_UPGRADE_WORKERS = 8
+INVENTORY_UPGRADE_PREFETCH = 2
+INVENTORY_UPGRADE_HEARTBEAT = 60
+INVENTORY_UPGRADE_STALE = 300
+
+# Maximum number of SDRs accepted in a request to the batch accounting API
+SDR_BATCH_MAX_SIZE = 1000
+
+# Customers, memberships and order ids checked when validating SDRs are cached for SDR_CACHE_TTL seconds
+SDR_CACHE_SIZE = 10000
+SDR_CACHE_TTL = 300
+
+# Users authenticated with the same identity headers are reused for AUTH_CACHE_TTL seconds
+AUTH_CACHE_SIZE = 1000
+AUTH_CACHE_TTL = 60
+
+# Seconds after which a process reloads the plugin registered for an asset type, so the
+# plugins installed, downgraded or removed with the management commands are picked up
+PLUGIN_REGISTRY_TTL = 60
+
+# Product event handlers of the assets of an offering run concurrently on PLUGIN_EVENT_WORKERS
+# threads, waiting PLUGIN_EVENT_TIMEOUT seconds unless the plugin sets its own event_timeout
+PLUGIN_EVENT_WORKERS = 8
+PLUGIN_EVENT_TIMEOUT = 60
+
 CLIENTS = {
     "paypal": "wstore.charging_engine.payment_client.paypal_client.PayPalClient",
     "fipay": "wstore.charging_engine.payment_client.fipay_client.FiPayClient",
@@ -239,6 +326,11 @@ env_port = environ.get("BAE_CB_MONGO_PORT", None)
 if env_port is not None:
     DATABASES["default"]["CLIENT"]["port"] = int(env_port)
 
+MONGO_MAX_POOL_SIZE = int(environ.get("BAE_CB_MONGO_MAX_POOL_SIZE", MONGO_MAX_POOL_SIZE))
+MONGO_MIN_POOL_SIZE = int(environ.get("BAE_CB_MONGO_MIN_POOL_SIZE", MONGO_MIN_POOL_SIZE))
+
+HTTP_POOL_SIZE = int(environ.get("BAE_CB_HTTP_POOL_SIZE", HTTP_POOL_SIZE))
+HTTP_READ_TIMEOUT = float(environ.get("BAE_CB_HTTP_READ_TIMEOUT", HTTP_READ_TIMEOUT))
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = int(environ.get("BAE_CB_MAX_UPLOAD_SIZE", DATA_UPLOAD_MAX_MEMORY_SIZE))
 
@@ -5,3 +5,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
 
 application = get_wsgi_application()
+
+# Background workers only run in the server processes
+from wstore.apps import start_background_workers  # noqa: E402
+
+start_background_workers()
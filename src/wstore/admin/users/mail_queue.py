@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+from logging import getLogger
+
+from django.conf import settings
+
+logger = getLogger("wstore.default_logger")
+
+
+class MailQueue:
+    """
+    Queue of emails delivered in background by a pool of sender threads. Every sender keeps
+    its own authenticated SMTP session open while there are messages to send, closing it
+    once it has been idle for SMTP_IDLE_TIMEOUT seconds. Transient failures (connection
+    errors and 4xx replies) are retried with exponential backoff
+    """
+
+    def __init__(self):
+        self._server = settings.SMTPSERVER
+        self._port = settings.SMTPPORT
+        self._mailuser = settings.WSTOREMAILUSER
+        self._password = settings.WSTOREMAILPASS
+
+        self._timeout = getattr(settings, "SMTP_TIMEOUT", 30)
+        self._idle_timeout = getattr(settings, "SMTP_IDLE_TIMEOUT", 60)
+        self._max_retries = getattr(settings, "SMTP_MAX_RETRIES", 3)
+        self._retry_delay = getattr(settings, "SMTP_RETRY_DELAY", 5)
+
+        self._queue = queue.Queue()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"sent": 0, "failed": 0, "retried": 0, "sessions": 0}
+
+        self._senders = [
+            threading.Thread(target=self._run, name="mail-sender-{}".format(i), daemon=True)
+            for i in range(getattr(settings, "SMTP_SENDERS", 2))
+        ]
+        for sender in self._senders:
+            sender.start()
+
+    def enqueue(self, fromaddr, recipients, message):
+        """
+        Queues an email to be sent in background
+        :param fromaddr: Sender address
+        :param recipients: List of recipient addresses
+        :param message: Full message as a string
+        """
+        self._queue.put((fromaddr, recipients, message))
+
+    def flush(self, timeout=None):
+        """
+        Waits until all the queued emails have been processed
+        :return: True if the queue has been drained
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+
+        return True
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+
+        metrics["queued"] = self._queue.qsize()
+        return metrics
+
+    def _count(self, metric):
+        with self._metrics_lock:
+            self._metrics[metric] += 1
+
+    def _open_session(self):
+        session = smtplib.SMTP(self._server, self._port, timeout=self._timeout)
+        session.starttls()
+        session.login(self._mailuser, self._password)
+
+        self._count("sessions")
+        return session
+
+    def _close_session(self, session):
+        try:
+            session.quit()
+        except Exception:
+            pass
+
+    def _is_transient(self, error):
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+
+        # Refused recipients are reported once the message has been processed
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return False
+
+        # Connection errors
+        return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError))
+
+    def _deliver(self, session, mail):
+        fromaddr, recipients, message = mail
+
+        for attempt in range(self._max_retries + 1):
+            try:
+                if session is None:
+                    session = self._open_session()
+
+                session.sendmail(fromaddr, recipients, message)
+                self._count("sent")
+                return session
+
+            except Exception as e:
+                transient = self._is_transient(e)
+
+                if transient or not isinstance(e, smtplib.SMTPException):
+                    # The session may not be usable anymore
+                    if session is not None:
+                        self._close_session(session)
+                    session = None
+
+                if not transient or attempt == self._max_retries:
+                    logger.error(f"Error sending email to {recipients}: {e}")
+                    self._count("failed")
+                    return session
+
+                logger.warning(f"Error sending email to {recipients}, retrying: {e}")
+                self._count("retried")
+                time.sleep(self._retry_delay * 2**attempt)
+
+    def _run(self):
+        session = None
+        while True:
+            try:
+                mail = self._queue.get(timeout=self._idle_timeout)
+            except queue.Empty:
+                if session is not None:
+                    self._close_session(session)
+                    session = None
+                continue
+
+            try:
+                session = self._deliver(session, mail)
+            except Exception as e:
+                logger.error(f"Unexpected error sending email: {e}")
+            finally:
+                self._queue.task_done()
+
+
+_mail_queue = None
+_mail_queue_pid = None
+_mail_queue_lock = threading.Lock()
+
+
+def _flush_at_exit():
+    # Give the senders the chance to deliver the queued emails when short lived
+    # processes, like management commands, finish
+    if _mail_queue is not None and _mail_queue_pid == os.getpid():
+        if not _mail_queue.flush(getattr(settings, "SMTP_FLUSH_TIMEOUT", 30)):
+            logger.error(f"Exiting with unsent emails: {_mail_queue.get_metrics()}")
+
+
+atexit.register(_flush_at_exit)
+
+
+def get_mail_queue():
+    """
+    Returns the mail queue of the current process, starting its senders if needed
+    """
+    global _mail_queue, _mail_queue_pid
+
+    with _mail_queue_lock:
+        if _mail_queue is None or _mail_queue_pid != os.getpid():
+            _mail_queue = MailQueue()
+            _mail_queue_pid = os.getpid()
+
+        return _mail_queue
@@ -20,7 +20,6 @@
 
 
 import os
-import smtplib
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -31,8 +30,10 @@ from bson.objectid import ObjectId
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from wstore.admin.users.mail_queue import get_mail_queue
 from wstore.models import User
 from wstore.ordering.models import Offering
+from wstore.store_commons.utils.identity_map import get_object
 
 
 class NotificationsHandler:
@@ -48,11 +49,8 @@ class NotificationsHandler:
             raise ImproperlyConfigured("Missing email configuration")
 
     def _send_email(self, recipient, msg):
-        server = smtplib.SMTP(self._server, self._port)
-        server.starttls()
-        server.login(self._mailuser, self._password)
-
-        server.sendmail(self._fromaddr, recipient, msg.as_string())
+        # Emails are delivered in background over persistent SMTP sessions
+        get_mail_queue().enqueue(self._fromaddr, recipient, msg.as_string())
 
     def _send_text_email(self, text, recipients, subject):
         msg = MIMEText(text)
@@ -72,6 +70,10 @@ class NotificationsHandler:
         msg.attach(message)
 
         for bill in bills:
+            # Charges whose invoice could not be generated have no bill
+            if not bill:
+                continue
+
             path = os.path.join(settings.BASEDIR, bill)
 
             with open(path, "rb") as fp:
@@ -103,7 +105,7 @@ class NotificationsHandler:
         text = "We have received the payment of your order with reference " + str(order.pk) + "\n"
         text += "containing the following product offerings: \n\n"
         for cont in order.get_contracts():
-            offering = Offering.objects.get(pk=ObjectId(cont.offering))
+            offering = get_object(Offering, ObjectId(cont.offering))
             text += offering.name + " with id " + offering.off_id + "\n\n"
 
         text += "You can review your orders at: \n" + order_url + "\n"
@@ -127,7 +129,7 @@ class NotificationsHandler:
 
     def send_provider_notification(self, order, contract):
         # Get destination email
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_object(Offering, ObjectId(contract.offering))
         org = offering.owner_organization
         recipients = [User.objects.get(pk=pk).email for pk in org.managers]
         domain = settings.SITE
@@ -147,7 +149,7 @@ class NotificationsHandler:
         domain = settings.SITE
         url = urljoin(domain, "/#/inventory/order/" + order.order_id)
 
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_object(Offering, ObjectId(contract.offering))
 
         text = "Your subscription belonging to the product offering " + offering.name + " has expired.\n"
         text += "You can renovate all your pending subscriptions of the order with reference " + str(order.pk) + "\n"
@@ -163,7 +165,7 @@ class NotificationsHandler:
         domain = settings.SITE
         url = urljoin(domain, "/#/inventory/order/" + order.order_id)
 
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_object(Offering, ObjectId(contract.offering))
 
         text = "Your subscription belonging to the product offering " + offering.name + "\n"
         text += "is going to expire in " + str(days) + " days. \n\n"
@@ -187,7 +189,7 @@ class NotificationsHandler:
         text += "The following product offerings have been renovated: \n\n"
         for t in transactions:
             cont = order.get_item_contract(t["item"])
-            offering = Offering.objects.get(pk=ObjectId(cont.offering))
+            offering = get_object(Offering, ObjectId(cont.offering))
 
             text += offering.name + " with id " + offering.off_id + "\n\n"
 
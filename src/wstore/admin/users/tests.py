@@ -19,15 +19,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import smtplib
+import time
 from importlib import reload
 
 from bson import ObjectId
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import MagicMock, call, mock_open
 from parameterized import parameterized
 
-from wstore.admin.users import notification_handler
+from wstore.admin.users import mail_queue, notification_handler
 
 __test__ = False
 
@@ -102,7 +105,7 @@ class NotificationsTestCase(TestCase):
         notification_handler.MIMEText = MagicMock()
         notification_handler.MIMEBase = MagicMock()
         notification_handler.encoders = MagicMock()
-        notification_handler.smtplib = MagicMock()
+        notification_handler.get_mail_queue = MagicMock()
 
         # Mock open method
         self._mock_open = mock_open()
@@ -163,10 +166,7 @@ class NotificationsTestCase(TestCase):
     def _validate_email_call(self, mime, emails=None):
         if emails is None:
             emails = ["user1@email.com", "user2@email.com"]
-        notification_handler.smtplib.SMTP.assert_called_once_with("smtp.gmail.com", 587)
-        notification_handler.smtplib.SMTP().starttls.assert_called_once_with()
-        notification_handler.smtplib.SMTP().login.assert_called_once_with("wstore", "passwd")
-        notification_handler.smtplib.SMTP().sendmail.assert_called_once_with(
+        notification_handler.get_mail_queue().enqueue.assert_called_once_with(
             "wstore@email.com", emails, mime().as_string()
         )
 
@@ -241,6 +241,19 @@ class NotificationsTestCase(TestCase):
         self._validate_multipart_call()
         self._validate_email_call(notification_handler.MIMEMultipart)
 
+    def test_acquisition_notification_no_invoice(self):
+        # The invoice of the charge could not be generated
+        self._order.get_contracts()[0].charges[0].invoice = ""
+
+        handler = notification_handler.NotificationsHandler()
+        handler.send_acquired_notification(self._order)
+
+        # The notification is sent without attachments
+        self._mock_open.assert_not_called()
+        notification_handler.MIMEBase.assert_not_called()
+        notification_handler.MIMEMultipart().attach.assert_called_once_with(notification_handler.MIMEText())
+        self._validate_email_call(notification_handler.MIMEMultipart)
+
     def test_payout_error(self):
         handler = notification_handler.NotificationsHandler()
 
@@ -309,3 +322,99 @@ class NotificationsTestCase(TestCase):
         notification_handler.MIMEText.assert_called_once_with(text)
 
         self._validate_mime_text_info("Product upgraded")
+
+
+@override_settings(
+    SMTPSERVER="smtp.gmail.com",
+    SMTPPORT=587,
+    WSTOREMAILUSER="wstore",
+    WSTOREMAILPASS="passwd",
+    SMTP_SENDERS=0,
+    SMTP_MAX_RETRIES=2,
+    SMTP_RETRY_DELAY=5,
+)
+class MailQueueTestCase(TestCase):
+    tags = ("notifications", "mail-queue")
+
+    def setUp(self):
+        # Keep the real exceptions of smtplib
+        mail_queue.smtplib = MagicMock(
+            SMTPException=smtplib.SMTPException,
+            SMTPResponseException=smtplib.SMTPResponseException,
+            SMTPRecipientsRefused=smtplib.SMTPRecipientsRefused,
+            SMTPServerDisconnected=smtplib.SMTPServerDisconnected,
+            SMTPConnectError=smtplib.SMTPConnectError,
+        )
+        self._session = mail_queue.smtplib.SMTP.return_value
+        mail_queue.time = MagicMock()
+
+        self._mail = ("wstore@email.com", ["user1@email.com"], "message")
+
+    def tearDown(self):
+        reload(mail_queue)
+
+    def _check_metrics(self, queue, sent, failed, retried, sessions):
+        self.assertEquals(
+            {"sent": sent, "failed": failed, "retried": retried, "sessions": sessions, "queued": 0},
+            queue.get_metrics(),
+        )
+
+    def test_persistent_session(self):
+        queue = mail_queue.MailQueue()
+
+        session = queue._deliver(None, self._mail)
+        session = queue._deliver(session, self._mail)
+
+        mail_queue.smtplib.SMTP.assert_called_once_with("smtp.gmail.com", 587, timeout=30)
+        self._session.starttls.assert_called_once_with()
+        self._session.login.assert_called_once_with("wstore", "passwd")
+        self.assertEquals(
+            [call("wstore@email.com", ["user1@email.com"], "message")] * 2,
+            self._session.sendmail.call_args_list,
+        )
+        self._check_metrics(queue, 2, 0, 0, 1)
+
+    def test_transient_error(self):
+        self._session.sendmail.side_effect = [smtplib.SMTPServerDisconnected(), None]
+        queue = mail_queue.MailQueue()
+
+        session = queue._deliver(None, self._mail)
+
+        self.assertEquals(self._session, session)
+        self.assertEquals(2, mail_queue.smtplib.SMTP.call_count)
+        self._session.quit.assert_called_once_with()
+        mail_queue.time.sleep.assert_called_once_with(5)
+        self._check_metrics(queue, 1, 0, 1, 2)
+
+    def test_retries_exhausted(self):
+        self._session.sendmail.side_effect = smtplib.SMTPResponseException(421, "Service not available")
+        queue = mail_queue.MailQueue()
+
+        session = queue._deliver(None, self._mail)
+
+        self.assertIsNone(session)
+        self.assertEquals([call(5), call(10)], mail_queue.time.sleep.call_args_list)
+        self._check_metrics(queue, 0, 1, 2, 3)
+
+    def test_permanent_error(self):
+        self._session.sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        queue = mail_queue.MailQueue()
+
+        session = queue._deliver(None, self._mail)
+
+        # The session is still usable
+        self.assertEquals(self._session, session)
+        self._session.quit.assert_not_called()
+        mail_queue.time.sleep.assert_not_called()
+        self._check_metrics(queue, 0, 1, 0, 1)
+
+    @override_settings(SMTP_SENDERS=1)
+    def test_background_delivery(self):
+        mail_queue.time = time
+        queue = mail_queue.MailQueue()
+
+        queue.enqueue(*self._mail)
+
+        self.assertTrue(queue.flush(5))
+        self._session.sendmail.assert_called_once_with("wstore@email.com", ["user1@email.com"], "message")
+        self._check_metrics(queue, 1, 0, 0, 1)
@@ -3,7 +3,7 @@ from django.apps import AppConfig
 
 def register_signals():
     from django.contrib.auth.models import User
-    from django.db.models.signals import post_save
+    from django.db.models.signals import post_delete, post_save
     from django.dispatch import receiver
 
     @receiver(post_save, sender=User, dispatch_uid="user_profile")
@@ -25,6 +25,52 @@ def register_signals():
                 profile.complete_name = instance.first_name + " " + instance.last_name
                 profile.save()
 
+    # Keep the lookups cached for the SDR validation up to date
+    @receiver(post_delete, sender="wstore.Order", dispatch_uid="sdr_cache_order")
+    def invalidate_order(sender, instance, **kwargs):
+        from wstore.charging_engine.accounting import sdr_manager
+
+        sdr_manager.invalidate_order(instance.order_id)
+
+    @receiver(post_save, sender="wstore.Organization", dispatch_uid="sdr_cache_organization")
+    @receiver(post_delete, sender="wstore.Organization", dispatch_uid="sdr_cache_organization_delete")
+    def invalidate_customer(sender, instance, **kwargs):
+        from wstore.charging_engine.accounting import sdr_manager
+
+        sdr_manager.invalidate_customer(instance.name)
+
+    @receiver(post_save, sender="wstore.UserProfile", dispatch_uid="sdr_cache_profile")
+    def invalidate_profile(sender, instance, **kwargs):
+        from wstore.charging_engine.accounting import sdr_manager
+
+        sdr_manager.invalidate_user(instance.user.username)
+
+    @receiver(post_delete, sender=User, dispatch_uid="sdr_cache_user")
+    def invalidate_user(sender, instance, **kwargs):
+        from wstore.charging_engine.accounting import sdr_manager
+
+        sdr_manager.invalidate_user(instance.username)
+
+
+def start_background_workers():
+    """
+    Starts the background workers of the server process and warms its caches. Management commands,
+    including the cron jobs, do not run them, so a short lived process never leaves a claimed job
+    half done
+    """
+    from wstore.asset_manager.resource_plugins.decorators import plugin_registry
+    from wstore.charging_engine.payout_engine import get_payout_poller
+    from wstore.rss_adaptor.cdr_outbox import get_shipper
+
+    # Start sending the CDRs left in the outbox
+    get_shipper()
+
+    # Keep checking the payouts that were pending when the process stopped
+    get_payout_poller()
+
+    # Load the installed plugins
+    plugin_registry.warm()
+
 
 class WstoreConfig(AppConfig):
     name = "wstore"
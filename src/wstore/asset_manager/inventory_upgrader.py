@@ -19,10 +19,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from logging import getLogger
-from threading import Thread
+from threading import Event, Thread
 
-import requests
+from bson import ObjectId
 from django.conf import settings
 from requests.exceptions import HTTPError
 
@@ -30,16 +32,24 @@ from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.models import Context, Resource
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.ordering.models import Offering, Order
-from wstore.store_commons.database import DocumentLock
+from wstore.store_commons.database import DocumentLock, get_database_connection
+from wstore.store_commons.http_session import get_http_session
 
 logger = getLogger("wstore.default_logger")
 PAGE_LEN = 100.0
 
+# Progress of the running upgrades, so the ones interrupted by a crash can be resumed
+CHECKPOINTS_COLLECTION = "wstore_upgrade_checkpoints"
+
 
 class InventoryUpgrader(Thread):
-    def __init__(self, asset):
+    def __init__(self, asset, checkpoint=None):
         Thread.__init__(self)
         self._asset = asset
+        self._checkpoint = checkpoint
+
+        # Products are patched over the shared pool of keep-alive connections
+        self._workers = getattr(settings, "INVENTORY_UPGRADE_WORKERS", 8)
         self._client = InventoryClient()
 
         # Get product name
@@ -48,7 +58,7 @@ class InventoryUpgrader(Thread):
                 settings.CATALOG, self._asset.product_id
             )
 
-            resp = requests.get(prod_url)
+            resp = get_http_session().get(prod_url)
             resp.raise_for_status()
 
             self._product_name = resp.json()["name"]
@@ -92,7 +102,7 @@ class InventoryUpgrader(Thread):
                 # A failure in the email notification is not relevant
                 pass
 
-    def upgrade_products(self, product_ids, id_filter):
+    def upgrade_products(self, product_ids, id_filter, start_page=0, on_page=None):
         def is_digital_char(characteristic):
             # Return whether a characteristics is defining asset info for the given one
             def is_product(id_):
@@ -134,75 +144,111 @@ class InventoryUpgrader(Thread):
 
             return dig_char, id_str
 
-        n_pages = int(math.ceil(len(product_ids) / PAGE_LEN))
+        def upgrade_product(product):
+            pre_ids = ""
+            product_id = str(product["id"])
+
+            new_characteristics = []
+            for char in product["productCharacteristic"]:
+                is_dig, ids_str = is_digital_char(char)
+                if not is_dig:
+                    new_characteristics.append(char)
+                else:
+                    pre_ids = ids_str
+
+            new_characteristics.append(
+                {
+                    "name": "{}Media Type".format(pre_ids),
+                    "value": self._asset.content_type,
+                }
+            )
 
-        missing_upgrades = []
-        for page in range(0, n_pages):
-            # Get the ids related to the current product page
-            offset = page * int(PAGE_LEN)
+            new_characteristics.append(
+                {
+                    "name": "{}Asset Type".format(pre_ids),
+                    "value": self._asset.resource_type,
+                }
+            )
 
-            page_ids = [str(id_filter(p_id)) for p_id in product_ids[offset : offset + int(PAGE_LEN)]]
-            ids = ",".join(page_ids)
+            new_characteristics.append(
+                {
+                    "name": "{}Location".format(pre_ids),
+                    "value": self._asset.download_link,
+                }
+            )
 
-            # Get product characteristics field
             try:
-                products = self._client.get_products(query={"id": ids, "fields": "id,productCharacteristic"})
+                # The inventory API returns the product after patching
+                patched_product = self._client.patch_product(product_id, {"productCharacteristic": new_characteristics})
             except HTTPError:
-                missing_upgrades.extend(page_ids)
-                continue
+                return product_id
 
-            # Patch product to include new asset information
-            for product in products:
-                pre_ids = ""
-                product_id = str(product["id"])
-
-                new_characteristics = []
-                for char in product["productCharacteristic"]:
-                    is_dig, ids_str = is_digital_char(char)
-                    if not is_dig:
-                        new_characteristics.append(char)
-                    else:
-                        pre_ids = ids_str
-
-                new_characteristics.append(
-                    {
-                        "name": "{}Media Type".format(pre_ids),
-                        "value": self._asset.content_type,
-                    }
-                )
+            self._notify_user(patched_product)
+            return None
 
-                new_characteristics.append(
-                    {
-                        "name": "{}Asset Type".format(pre_ids),
-                        "value": self._asset.resource_type,
-                    }
-                )
+        def fetch_page(page_ids):
+            # Get product characteristics field
+            try:
+                return self._client.get_products(query={"id": ",".join(page_ids), "fields": "id,productCharacteristic"})
+            except HTTPError:
+                return None
 
-                new_characteristics.append(
-                    {
-                        "name": "{}Location".format(pre_ids),
-                        "value": self._asset.download_link,
-                    }
-                )
+        n_pages = int(math.ceil(len(product_ids) / PAGE_LEN))
 
-                try:
-                    # The inventory API returns the product after patching
-                    patched_product = self._client.patch_product(
-                        product_id, {"productCharacteristic": new_characteristics}
+        # Get the ids related to every product page
+        pages = [
+            [str(id_filter(p_id)) for p_id in product_ids[page * int(PAGE_LEN) : (page + 1) * int(PAGE_LEN)]]
+            for page in range(0, n_pages)
+        ]
+
+        missing_upgrades = []
+        with ThreadPoolExecutor(max_workers=1) as fetcher, ThreadPoolExecutor(max_workers=self._workers) as patcher:
+            # The next pages are retrieved while the products of the current one are patched
+            prefetch = max(1, getattr(settings, "INVENTORY_UPGRADE_PREFETCH", 2))
+            fetches = {}
+            for page in range(start_page, min(n_pages, start_page + prefetch)):
+                fetches[page] = fetcher.submit(fetch_page, pages[page])
+
+            for page in range(start_page, n_pages):
+                if page + prefetch < n_pages:
+                    fetches[page + prefetch] = fetcher.submit(fetch_page, pages[page + prefetch])
+
+                products = fetches.pop(page).result()
+                if products is None:
+                    missing_upgrades.extend(pages[page])
+                else:
+                    results = (
+                        patcher.map(upgrade_product, products) if self._workers > 1 else map(upgrade_product, products)
                     )
-                except HTTPError:
-                    missing_upgrades.append(product_id)
-                    continue
+                    missing_upgrades.extend(product_id for product_id in results if product_id is not None)
 
-                self._notify_user(patched_product)
+                if on_page is not None:
+                    on_page(page + 1, missing_upgrades)
 
         return missing_upgrades
 
-    def upgrade_asset_products(self, offering_ids):
-        # Get all the product ids related to the given product offering
+    def upgrade_asset_products(self, offering_ids, checkpoint=None):
+        """
+        Upgrades the products of the given offerings
+        :param offering_ids: Ids of the offerings whose products are upgraded
+        :param checkpoint: Progress to be resumed. If provided, the progress is saved after every page
+        :return: Tuple with the ids of the offerings and the products that could not be upgraded
+        """
         missing_off = []
         missing_products = []
-        for off_id in offering_ids:
+        start_page = 0
+
+        if checkpoint is not None:
+            missing_off.extend(checkpoint["missing_offerings"])
+            missing_products.extend(checkpoint["missing_products"])
+            start_page = checkpoint["page"]
+
+        for index, off_id in enumerate(offering_ids):
+            on_page = None
+            if checkpoint is not None:
+                on_page = self._get_checkpoint_callback(offering_ids[index:], missing_off, missing_products)
+
+            # Get all the product ids related to the given product offering
             try:
                 product_ids = self._client.get_products(query={"productOffering.id": off_id, "fields": "id"})
             except HTTPError:
@@ -210,10 +256,95 @@ class InventoryUpgrader(Thread):
                 missing_off.append(off_id)
                 continue
 
-            missing_products.extend(self.upgrade_products(product_ids, lambda p_id: p_id["id"]))
+            missing_products.extend(
+                self.upgrade_products(product_ids, lambda p_id: p_id["id"], start_page=start_page, on_page=on_page)
+            )
+            start_page = 0
 
         return missing_off, missing_products
 
+    def _get_checkpoint_callback(self, offering_ids, missing_off, missing_products):
+        def on_page(page, missing):
+            self._save_checkpoint(offering_ids, page, missing_off, missing_products + missing)
+
+        return on_page
+
+    def _save_checkpoint(self, offering_ids, page, missing_off, missing_products):
+        get_database_connection()[CHECKPOINTS_COLLECTION].update_one(
+            {"_id": str(self._asset.pk)},
+            {
+                "$set": {
+                    "offerings": list(offering_ids),
+                    "page": page,
+                    "missing_offerings": list(missing_off),
+                    "missing_products": list(missing_products),
+                    "updated": datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+
+    def _touch_checkpoint(self):
+        # The checkpoint is not upserted, so an upgrade already finished is not recreated
+        get_database_connection()[CHECKPOINTS_COLLECTION].update_one(
+            {"_id": str(self._asset.pk)}, {"$set": {"updated": datetime.utcnow()}}
+        )
+
+    def _start_heartbeat(self):
+        """
+        Refreshes the checkpoint while the upgrade is running, so a page that takes longer
+        than INVENTORY_UPGRADE_STALE seconds is not taken as an interrupted upgrade
+        :return: Event that stops the heartbeat when set
+        """
+        stopped = Event()
+        interval = getattr(settings, "INVENTORY_UPGRADE_HEARTBEAT", 60)
+
+        def beat():
+            while not stopped.wait(interval):
+                try:
+                    self._touch_checkpoint()
+                except Exception as e:
+                    logger.warning(f"Error refreshing the upgrade checkpoint of asset {self._asset.pk}: {e}")
+
+        Thread(target=beat, daemon=True).start()
+        return stopped
+
+    def _remove_checkpoint(self):
+        get_database_connection()[CHECKPOINTS_COLLECTION].delete_one({"_id": str(self._asset.pk)})
+
+    @staticmethod
+    def resume_upgrades():
+        """
+        Restarts the upgrades whose checkpoint has not been refreshed for INVENTORY_UPGRADE_STALE
+        seconds, as the process running them is no longer alive
+        :return: List with the started upgraders
+        """
+        collection = get_database_connection()[CHECKPOINTS_COLLECTION]
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=getattr(settings, "INVENTORY_UPGRADE_STALE", 300))
+        upgraders = []
+
+        for checkpoint in collection.find({"updated": {"$lt": stale}}):
+            # Only one server instance resumes each upgrade
+            claimed = collection.find_one_and_update(
+                {"_id": checkpoint["_id"], "updated": checkpoint["updated"]}, {"$set": {"updated": now}}
+            )
+            if claimed is None:
+                continue
+
+            try:
+                asset = Resource.objects.get(pk=ObjectId(checkpoint["_id"]))
+            except Exception:
+                collection.delete_one({"_id": checkpoint["_id"]})
+                continue
+
+            logger.info(f"Resuming the inventory upgrade of asset {checkpoint['_id']}")
+            upgrader = InventoryUpgrader(asset, checkpoint=claimed)
+            upgrader.start()
+            upgraders.append(upgrader)
+
+        return upgraders
+
     def _get_providing_offerings(self):
         # Get product bundles that contain the included asset
         assets = [self._asset]
@@ -233,11 +364,23 @@ class InventoryUpgrader(Thread):
         return offerings
 
     def run(self):
-        # Get all the offerings that give access to the provided digital asset
-        offerings = self._get_providing_offerings()
-
-        # Upgrade all the products related to the provided asset
-        missing_off, missing_products = self.upgrade_asset_products([offering.off_id for offering in offerings])
+        if self._checkpoint is None:
+            # Get all the offerings that give access to the provided digital asset
+            offering_ids = [offering.off_id for offering in self._get_providing_offerings()]
+            checkpoint = {"page": 0, "missing_offerings": [], "missing_products": []}
+            self._save_checkpoint(offering_ids, 0, [], [])
+        else:
+            offering_ids = self._checkpoint["offerings"]
+            checkpoint = self._checkpoint
+
+        heartbeat = self._start_heartbeat()
+        try:
+            # Upgrade all the products related to the provided asset
+            missing_off, missing_products = self.upgrade_asset_products(offering_ids, checkpoint=checkpoint)
+        finally:
+            heartbeat.set()
 
         if len(missing_off) > 0 or len(missing_products) > 0:
             self._save_failed(missing_off, missing_products)
+
+        self._remove_checkpoint()
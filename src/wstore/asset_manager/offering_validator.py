@@ -21,12 +21,11 @@
 
 from decimal import Decimal
 
-import requests
-
 from wstore.asset_manager.catalog_validator import CatalogValidator
 from wstore.asset_manager.models import Resource
 from wstore.asset_manager.resource_plugins.decorators import on_product_offering_validation
 from wstore.ordering.models import Offering
+from wstore.store_commons.http_session import get_http_session
 from wstore.store_commons.utils.units import ChargePeriod, CurrencyCode
 
 
@@ -128,7 +127,7 @@ class OfferingValidator(CatalogValidator):
         return is_open
 
     def _download(self, url):
-        r = requests.get(url)
+        r = get_http_session().get(url)
 
         if r.status_code != 200:
             raise ValueError("There has been a problem accessing the product spec included in the offering")
@@ -19,15 +19,24 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import wraps
 from logging import getLogger
 
 from bson.objectid import ObjectId
+from django.conf import settings
 
 from wstore.asset_manager.errors import ProductError
 from wstore.asset_manager.models import Resource
+from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.models import ResourcePlugin
 from wstore.ordering.models import Offering
+from wstore.store_commons.utils.cache import TTLCache
+from wstore.store_commons.utils.identity_map import get_object, get_objects
 
 logger = getLogger("wstore.default_logger")
 
@@ -42,16 +51,82 @@ def _get_plugin_model(name):
     return plugin_model
 
 
-def load_plugin_module(asset_t):
-    plugin_model = _get_plugin_model(asset_t)
-    module = plugin_model.module
-    module_class_name = module.split(".")[-1]
-    module_package = module.partition("." + module_class_name)[0]
+class PluginRegistry:
+    """
+    Process wide registry of the installed plugins. Plugin classes are imported once per
+    plugin name and version, while the plugin models expire after a given number of seconds,
+    so the changes made by the management commands in other processes are eventually loaded
+    """
+
+    def __init__(self, ttl):
+        self._models = TTLCache(1000, ttl)
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def _import_class(self, module):
+        module_class_name = module.split(".")[-1]
+        module_package = module.partition("." + module_class_name)[0]
+
+        return getattr(
+            __import__(module_package, globals(), locals(), [module_class_name], 0),
+            module_class_name,
+        )
+
+    def _register(self, plugin_model):
+        key = (plugin_model.name, plugin_model.version)
+
+        with self._lock:
+            if key not in self._classes:
+                self._classes[key] = self._import_class(plugin_model.module)
+
+            module_class = self._classes[key]
+
+        self._models.set(plugin_model.name, plugin_model)
+        return module_class
+
+    def get(self, name):
+        """
+        Returns the model and the class of the plugin registered for the given asset type
+        """
+        plugin_model = self._models.get(name)
+
+        if plugin_model is None:
+            plugin_model = _get_plugin_model(name)
+
+        return plugin_model, self._register(plugin_model)
+
+    def invalidate(self, name):
+        """
+        Removes the loaded versions of a plugin, used when it is installed, downgraded or removed
+        """
+        self._models.invalidate(name)
+
+        with self._lock:
+            for key in [key for key in self._classes if key[0] == name]:
+                del self._classes[key]
+
+    def clear(self):
+        self._models.clear()
 
-    module_class = getattr(
-        __import__(module_package, globals(), locals(), [module_class_name], 0),
-        module_class_name,
-    )
+        with self._lock:
+            self._classes.clear()
+
+    def warm(self):
+        """
+        Loads all the installed plugins, so the first events do not pay the import
+        """
+        for plugin_model in ResourcePlugin.objects.all():
+            try:
+                self._register(plugin_model)
+            except Exception as e:
+                logger.error(f"Plugin {plugin_model.name} could not be loaded: {e}")
+
+
+plugin_registry = PluginRegistry(getattr(settings, "PLUGIN_REGISTRY_TTL", 60))
+
+
+def load_plugin_module(asset_t):
+    plugin_model, module_class = plugin_registry.get(asset_t)
 
     logger.debug(f"Loaded plugin module for {asset_t}")
     return module_class(plugin_model)
@@ -120,8 +195,7 @@ def _expand_bundled_assets(offering_assets):
     assets = []
     for off_asset in offering_assets:
         if len(off_asset.bundled_assets) > 0:
-            for bundled_asset_pk in off_asset.bundled_assets:
-                assets.append(Resource.objects.get(pk=bundled_asset_pk))
+            assets.extend(get_objects(Resource, off_asset.bundled_assets))
         else:
             assets.append(off_asset)
 
@@ -157,38 +231,173 @@ def on_product_offering_validation(func):
     return wrapper
 
 
-def _execute_asset_event(asset, order, contract, type_):
-    # Load plugin module
-    plugin_module = load_plugin_module(asset.resource_type)
+# Pool shared by the product event handlers of the assets of an offering
+_event_pool = None
+_event_pool_pid = None
+_event_pool_lock = threading.Lock()
+
+# Number of event pool workers held by handlers that are still running after their timeout
+_stalled_workers = 0
 
+
+def _get_event_pool():
+    global _event_pool, _event_pool_pid, _stalled_workers
+
+    with _event_pool_lock:
+        # A forked process cannot reuse the threads of its parent
+        if _event_pool is None or _event_pool_pid != os.getpid():
+            _event_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "PLUGIN_EVENT_WORKERS", 8), thread_name_prefix="plugin-events"
+            )
+            _event_pool_pid = os.getpid()
+            _stalled_workers = 0
+
+        return _event_pool
+
+
+def _get_asset_event(plugin_module, type_):
     events = {
         "activate": plugin_module.on_product_acquisition,
         "suspend": plugin_module.on_product_suspension,
         "usage": plugin_module.on_usage_refresh,
     }
-    # Execute event
-    events[type_](asset, contract, order)
+    return events[type_]
+
+
+def _get_event_timeout(plugin_module):
+    timeout = getattr(plugin_module, "event_timeout", None)
+    return timeout if isinstance(timeout, (int, float)) else getattr(settings, "PLUGIN_EVENT_TIMEOUT", 60)
+
+
+def _execute_asset_events(handlers, order, contract, type_):
+    errors = []
+    for asset, plugin_module in handlers:
+        try:
+            _get_asset_event(plugin_module, type_)(asset, contract, order)
+        except Exception as e:
+            errors.append((asset, e))
+
+    return errors
+
+
+class _EventTask:
+    """
+    Event handlers run in the event pool, whose timeout starts when they begin executing
+    """
+
+    def __init__(self, handlers, order, contract, type_):
+        self.handlers = handlers
+        self._args = (order, contract, type_)
+        self._started = threading.Event()
+        self._start_time = None
+        self._finished = False
+        self._stalled = False
+
+        # Serial handlers are given the sum of their timeouts
+        self.timeout = sum(_get_event_timeout(plugin_module) for _, plugin_module in handlers)
+
+    def __call__(self):
+        global _stalled_workers
+
+        self._start_time = time.monotonic()
+        self._started.set()
+        try:
+            return _execute_asset_events(self.handlers, *self._args)
+        finally:
+            with _event_pool_lock:
+                self._finished = True
+                if self._stalled:
+                    _stalled_workers -= 1
+                    logger.info(f"Timed out event handler finished, {_stalled_workers} event workers still held")
+
+    def _stall(self):
+        global _stalled_workers
+
+        # The handler cannot be interrupted, so it keeps its worker until it returns
+        with _event_pool_lock:
+            if self._finished:
+                return
+
+            self._stalled = True
+            _stalled_workers += 1
+            logger.warning(
+                f"Event handler of assets {', '.join(str(asset.pk) for asset, _ in self.handlers)} timed out, "
+                f"{_stalled_workers} of {getattr(settings, 'PLUGIN_EVENT_WORKERS', 8)} event workers held "
+                "by timed out handlers"
+            )
+
+    def result(self, future):
+        # Tasks waiting for a free worker are given the same time to start
+        if not self._started.wait(self.timeout) and future.cancel():
+            raise FutureTimeoutError()
+
+        self._started.wait()
+        try:
+            return future.result(timeout=max(0, self._start_time + self.timeout - time.monotonic()))
+        except FutureTimeoutError:
+            self._stall()
+            raise
+
+
+def _dispatch_asset_events(assets, order, contract, type_):
+    """
+    Executes the event handlers of the given assets. The handlers of plugins declaring
+    serial_events run one after another in the asset order, while the rest run concurrently
+    :return: List of (asset, error) with the failed handlers
+    """
+    handlers = [(asset, load_plugin_module(asset.resource_type)) for asset in assets]
+
+    serial = [handler for handler in handlers if getattr(handler[1], "serial_events", False) is True]
+    tasks = [[handler] for handler in handlers if getattr(handler[1], "serial_events", False) is not True]
+    if len(serial):
+        tasks.append(serial)
+
+    # Single tasks also run in the pool, so their timeout is enforced
+    if not len(tasks):
+        return []
+
+    pool = _get_event_pool()
+
+    futures = []
+    for handlers in tasks:
+        task = _EventTask(handlers, order, contract, type_)
+        futures.append((task, pool.submit(task)))
+
+    errors = []
+    for task, future in futures:
+        try:
+            errors.extend(task.result(future))
+        except FutureTimeoutError:
+            errors.extend((asset, PluginError("The event handler timed out")) for asset, _ in task.handlers)
+
+    return errors
 
 
 def process_product_notification(order, contract, type_):
     # Get digital asset from the contract
     offering_assets = []
-    offering = Offering.objects.get(pk=ObjectId(contract.offering))
+    offering = get_object(Offering, ObjectId(contract.offering))
 
     if len(offering.bundled_offerings) > 0:
-        offering_assets = [
-            Offering.objects.get(pk=ObjectId(key)).asset
-            for key in offering.bundled_offerings
-            if Offering.objects.get(pk=ObjectId(key)).is_digital
-        ]
+        bundled_offerings = get_objects(Offering, [ObjectId(key) for key in offering.bundled_offerings])
+        offering_assets = [bundled.asset for bundled in bundled_offerings if bundled.is_digital]
 
     elif offering.is_digital:
         offering_assets = [offering.asset]
 
     assets = _expand_bundled_assets(offering_assets)
 
-    for event_asset in assets:
-        _execute_asset_event(event_asset, order, contract, type_)
+    errors = _dispatch_asset_events(assets, order, contract, type_)
+    for asset, error in errors:
+        logger.error(f"The {type_} event of asset {asset.pk} failed: {error}")
+
+    if len(errors) == 1:
+        raise errors[0][1]
+
+    if len(errors) > 1:
+        raise PluginError(
+            "The {} event failed for {} assets: {}".format(type_, len(errors), ", ".join(str(e) for _, e in errors))
+        )
 
 
 def on_product_acquired(order, contract):
@@ -32,6 +32,12 @@ logger = getLogger("wstore.default_logger")
 
 
 class Plugin(object):
+    # Plugins whose product event handlers cannot run concurrently set it to True
+    serial_events = False
+
+    # Seconds to wait for a product event handler, PLUGIN_EVENT_TIMEOUT if not set
+    event_timeout = None
+
     def __init__(self, plugin_model):
         self._model = plugin_model
 
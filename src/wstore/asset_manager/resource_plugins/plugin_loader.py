@@ -27,6 +27,7 @@ from shutil import rmtree
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from wstore.asset_manager.resource_plugins.decorators import plugin_registry
 from wstore.asset_manager.resource_plugins.plugin import Plugin
 from wstore.asset_manager.resource_plugins.plugin_error import PluginError
 from wstore.asset_manager.resource_plugins.plugin_rollback import installPluginRollback
@@ -63,6 +64,7 @@ class PluginLoader(object):
 
     def _update_model_data_from_json(self, model, module, json_info):
         # Create or update plugin model data
+        old_name = model.name
         model.name = json_info["name"]
         model.version = json_info["version"]
         model.author = json_info["author"]
@@ -75,6 +77,10 @@ class PluginLoader(object):
         model.pull_accounting = json_info.get("pull_accounting", False)
         model.save()
 
+        # Installs and downgrades change the plugin class loaded for the asset type
+        plugin_registry.invalidate(old_name)
+        plugin_registry.invalidate(model.name)
+
     @installPluginRollback
     def install_plugin(self, path, rb_log=None):
         logger.info(f"Installing plugin: {path}")
@@ -254,4 +260,5 @@ class PluginLoader(object):
 
         # Remove model
         plugin_model.delete()
+        plugin_registry.invalidate(name)
         logger.info(f"Plugin {plugin_id} successfully uninstalled")
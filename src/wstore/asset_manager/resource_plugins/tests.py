@@ -21,6 +21,8 @@
 
 
 import os
+import threading
+import time
 from importlib import reload
 from json import dump as jsondump
 from shutil import rmtree
@@ -28,6 +30,7 @@ from shutil import rmtree
 from bson.objectid import ObjectId
 from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import MagicMock, call
 from parameterized import parameterized
 from requests.exceptions import HTTPError
@@ -396,6 +399,7 @@ class PluginLoaderTestCase(TestCase):
         plugin_loader.ResourcePlugin.objects.get.return_value = plugin_mock
 
         plugin_loader.rmtree = MagicMock(name="rmtree")
+        plugin_loader.plugin_registry = MagicMock()
 
         if side_effect is not None:
             if name == "two_versions":
@@ -419,6 +423,7 @@ class PluginLoaderTestCase(TestCase):
             plugin_loader.Resource.objects.filter.assert_called_once_with(resource_type=plugin_name)
             plugin_loader.rmtree.assert_called_once_with(os.path.join(plugin_l._plugins_path, "test_plugin"))
             plugin_mock.delete.assert_called_once_with()
+            plugin_loader.plugin_registry.invalidate.assert_called_once_with(plugin_name)
 
             self.assertEquals(pull, plugin_mock.usage_called)
         else:
@@ -899,6 +904,50 @@ class DecoratorsTestCase(TestCase):
         offering.asset = asset
         return offering
 
+    def _mock_plugin_model(self, version="1.0"):
+        plugin_model = MagicMock(version=version, module="wstore.asset_manager.resource_plugins.tests.TestPlugin")
+        plugin_model.name = "Test Plugin"
+
+        decorators.ResourcePlugin = MagicMock()
+        decorators.ResourcePlugin.objects.get.return_value = plugin_model
+        decorators.ResourcePlugin.objects.all.return_value = [plugin_model]
+        return plugin_model
+
+    def test_plugin_registry(self):
+        plugin_model = self._mock_plugin_model()
+        registry = decorators.PluginRegistry(60)
+        registry._import_class = MagicMock(return_value=TestPlugin)
+
+        self.assertEquals((plugin_model, TestPlugin), registry.get("Test Plugin"))
+        self.assertEquals((plugin_model, TestPlugin), registry.get("Test Plugin"))
+
+        decorators.ResourcePlugin.objects.get.assert_called_once_with(name="Test Plugin")
+        registry._import_class.assert_called_once_with("wstore.asset_manager.resource_plugins.tests.TestPlugin")
+
+        # A new version of the plugin is imported once the registry is invalidated
+        plugin_model = self._mock_plugin_model(version="2.0")
+        registry.invalidate("Test Plugin")
+
+        self.assertEquals((plugin_model, TestPlugin), registry.get("Test Plugin"))
+        self.assertEquals(2, registry._import_class.call_count)
+
+    def test_plugin_registry_warm(self):
+        plugin_model = self._mock_plugin_model()
+        registry = decorators.PluginRegistry(60)
+        registry._import_class = MagicMock(return_value=TestPlugin)
+        registry.warm()
+
+        self.assertEquals((plugin_model, TestPlugin), registry.get("Test Plugin"))
+        self.assertEquals(0, decorators.ResourcePlugin.objects.get.call_count)
+
+    def test_load_plugin_module_not_supported(self):
+        reload(decorators)
+        decorators.ResourcePlugin = MagicMock()
+        decorators.ResourcePlugin.objects.get.side_effect = Exception("Not found")
+
+        with self.assertRaises(decorators.ProductError):
+            decorators.load_plugin_module("Test Plugin")
+
     def test_product_acquired(self):
         # Include order and contract info
         bundle = self._get_offering_mock()
@@ -910,35 +959,43 @@ class DecoratorsTestCase(TestCase):
 
         offering1 = self._get_offering_mock()
         offering2 = self._get_offering_mock()
+        offering2.pk = ObjectId("61004aba5e05acc115f022f1")
         offering3 = self._get_offering_mock(bundle_asset=True)
+        offering3.pk = ObjectId("61004aba5e05acc115f022f2")
 
+        # Bundled offerings and assets are loaded with a single query
         decorators.Offering = MagicMock()
-        decorators.Offering.objects.get.side_effect = [
-            bundle,
-            offering1,
-            offering1,
-            offering2,
-            offering2,
-            offering3,
-            offering3,
-        ]
+        decorators.Offering.objects.get.return_value = bundle
+        decorators.Offering.objects.filter.return_value = [offering3, offering1, offering2]
 
         decorators.Resource = MagicMock()
-        asset1 = MagicMock(resource_type="asset3")
-        asset2 = MagicMock(resource_type="asset4")
-        decorators.Resource.objects.get.side_effect = [asset1, asset2]
+        asset1 = MagicMock(pk="3", resource_type="asset3")
+        asset2 = MagicMock(pk="4", resource_type="asset4")
+        decorators.Resource.objects.filter.return_value = [asset1, asset2]
 
         self._contract.offering = "61004aba5e05acc115f022f0"
 
         decorators.on_product_acquired(self._order, self._contract)
 
         # Check calls
+        decorators.Offering.objects.get.assert_called_once_with(pk=ObjectId("61004aba5e05acc115f022f0"))
+        decorators.Offering.objects.filter.assert_called_once_with(
+            pk__in=[
+                ObjectId("61004aba5e05acc115f022f0"),
+                ObjectId("61004aba5e05acc115f022f1"),
+                ObjectId("61004aba5e05acc115f022f2"),
+            ]
+        )
+        decorators.Resource.objects.filter.assert_called_once_with(pk__in=["3", "4"])
+        self.assertEquals(0, decorators.Resource.objects.get.call_count)
+
         self.assertEquals(
             [call("asset"), call("asset"), call("asset3"), call("asset4")],
             decorators.load_plugin_module.call_args_list,
         )
 
-        self.assertEquals(
+        # The handlers of the different assets run concurrently
+        self.assertCountEqual(
             [
                 call(offering1.asset, self._contract, self._order),
                 call(offering2.asset, self._contract, self._order),
@@ -948,6 +1005,116 @@ class DecoratorsTestCase(TestCase):
             self._module.on_product_acquisition.call_args_list,
         )
 
+    def _mock_event_plugins(self, serial=False):
+        events = []
+
+        def build_plugin(resource_type):
+            plugin_module = MagicMock(serial_events=serial)
+            plugin_module.on_product_acquisition.side_effect = lambda asset, contract, order: events.append(asset)
+            return plugin_module
+
+        decorators.load_plugin_module.side_effect = build_plugin
+        return [MagicMock(pk=str(i), resource_type="asset") for i in range(5)], events
+
+    def test_dispatch_serial_events(self):
+        assets, events = self._mock_event_plugins(serial=True)
+
+        errors = decorators._dispatch_asset_events(assets, self._order, self._contract, "activate")
+
+        self.assertEquals([], errors)
+        self.assertEquals(assets, events)
+
+    def test_dispatch_events_errors(self):
+        assets = [MagicMock(pk=str(i), resource_type="asset") for i in range(5)]
+        self._module.serial_events = False
+        self._module.on_product_acquisition.side_effect = lambda asset, contract, order: 1 / int(asset.pk)
+
+        errors = decorators._dispatch_asset_events(assets, self._order, self._contract, "activate")
+
+        self.assertEquals(1, len(errors))
+        self.assertEquals(assets[0], errors[0][0])
+        self.assertIsInstance(errors[0][1], ZeroDivisionError)
+        self.assertEquals(5, self._module.on_product_acquisition.call_count)
+
+    def test_dispatch_events_timeout(self):
+        assets = [MagicMock(pk=str(i), resource_type="asset") for i in range(5)]
+        release = threading.Event()
+
+        def slow_event(asset, contract, order):
+            if asset.pk == "0":
+                release.wait(5)
+
+        self._module.serial_events = False
+        self._module.event_timeout = 0.05
+        self._module.on_product_acquisition.side_effect = slow_event
+
+        errors = decorators._dispatch_asset_events(assets, self._order, self._contract, "activate")
+        release.set()
+
+        self.assertEquals([assets[0]], [asset for asset, _ in errors])
+        self.assertEquals("Plugin Error: The event handler timed out", str(errors[0][1]))
+
+    def test_dispatch_single_event_timeout(self):
+        asset = MagicMock(pk="0", resource_type="asset")
+        release = threading.Event()
+        finished = threading.Event()
+
+        def slow_event(asset, contract, order):
+            release.wait(5)
+            finished.set()
+
+        self._module.serial_events = False
+        self._module.event_timeout = 0.05
+        self._module.on_product_acquisition.side_effect = slow_event
+
+        decorators._event_pool = None
+        try:
+            errors = decorators._dispatch_asset_events([asset], self._order, self._contract, "activate")
+
+            # The worker is held by the handler until it returns
+            self.assertEquals(1, decorators._stalled_workers)
+            release.set()
+            finished.wait(5)
+            decorators._event_pool.shutdown(wait=True)
+            self.assertEquals(0, decorators._stalled_workers)
+        finally:
+            release.set()
+            decorators._event_pool = None
+
+        self.assertEquals([asset], [asset for asset, _ in errors])
+        self.assertEquals("Plugin Error: The event handler timed out", str(errors[0][1]))
+
+    @override_settings(PLUGIN_EVENT_WORKERS=1)
+    def test_dispatch_events_timeout_queued(self):
+        assets = [MagicMock(pk=str(i), resource_type="asset") for i in range(2)]
+        self._module.serial_events = False
+        self._module.event_timeout = 0.5
+        self._module.on_product_acquisition.side_effect = lambda asset, contract, order: time.sleep(0.3)
+
+        # The second handler waits for the first one, but its timeout starts when it is executed
+        decorators._event_pool = None
+        try:
+            errors = decorators._dispatch_asset_events(assets, self._order, self._contract, "activate")
+        finally:
+            decorators._event_pool = None
+
+        self.assertEquals([], errors)
+        self.assertEquals(2, self._module.on_product_acquisition.call_count)
+
+    def test_product_notification_errors(self):
+        self._contract.offering = "61004aba5e05acc115f022f0"
+        decorators.Offering = MagicMock()
+        decorators.Offering.objects.get.return_value = self._get_offering_mock()
+
+        decorators._dispatch_asset_events = MagicMock(
+            return_value=[(MagicMock(pk="1"), Exception("error 1")), (MagicMock(pk="2"), Exception("error 2"))]
+        )
+
+        with self.assertRaises(PluginError) as ctx:
+            decorators.on_product_acquired(self._order, self._contract)
+
+        self.assertEquals("Plugin Error: The activate event failed for 2 assets: error 1, error 2", str(ctx.exception))
+
     def test_product_suspended(self):
         self._contract.offering = "61004aba5e05acc115f022f0"
         offering = self._get_offering_mock()
@@ -19,16 +19,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
 from copy import deepcopy
 
 from bson import ObjectId
 from django.test.testcases import TestCase
-from mock import MagicMock, call
+from django.test.utils import override_settings
+from mock import ANY, MagicMock, call
 from requests.exceptions import HTTPError
 
 from wstore.asset_manager import inventory_upgrader
 
 
+@override_settings(INVENTORY_UPGRADE_WORKERS=1)
 class InventoryUpgraderTestCase(TestCase):
     tags = ("upgrades",)
 
@@ -258,10 +261,10 @@ class InventoryUpgraderTestCase(TestCase):
         self._lock_inst = MagicMock()
         inventory_upgrader.DocumentLock = MagicMock(return_value=self._lock_inst)
 
-        inventory_upgrader.requests = MagicMock()
+        inventory_upgrader.get_http_session = MagicMock()
         self._resp = MagicMock()
         self._resp.json.return_value = {"name": self._product_spec_name}
-        inventory_upgrader.requests.get.return_value = self._resp
+        inventory_upgrader.get_http_session().get.return_value = self._resp
 
         inventory_upgrader.PAGE_LEN = 2.0
 
@@ -284,11 +287,17 @@ class InventoryUpgraderTestCase(TestCase):
         self._not_handler = MagicMock()
         inventory_upgrader.NotificationsHandler = MagicMock(return_value=self._not_handler)
 
+        # Mock checkpoints collection
+        self._checkpoints = MagicMock()
+        inventory_upgrader.get_database_connection = MagicMock(
+            return_value={"wstore_upgrade_checkpoints": self._checkpoints}
+        )
+
     def tearDown(self):
         inventory_upgrader.settings.CATALOG = self._cat_url
 
     def _check_product_spec_retrieved(self):
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
+        inventory_upgrader.get_http_session().get.assert_called_once_with(self._product_spec_url)
         self._resp.raise_for_status.assert_called_once_with()
         self._resp.json.assert_called_once_with()
 
@@ -614,7 +623,7 @@ class InventoryUpgraderTestCase(TestCase):
 
         self._client_instance.patch_product.side_effect = [None, HTTPError()]
 
-        inventory_upgrader.requests.get.side_effect = HTTPError()
+        inventory_upgrader.get_http_session().get.side_effect = HTTPError()
 
         # Execute the tested method
         upgrader = inventory_upgrader.InventoryUpgrader(self._asset)
@@ -653,8 +662,134 @@ class InventoryUpgraderTestCase(TestCase):
             self._client_instance.patch_product.call_args_list,
         )
 
-        inventory_upgrader.requests.get.assert_called_once_with(self._product_spec_url)
+        inventory_upgrader.get_http_session().get.assert_called_once_with(self._product_spec_url)
         self.assertEquals(0, self._resp.raise_for_status.call_count)
         self.assertEquals(0, self._resp.json.call_count)
 
         self.assertEquals(0, inventory_upgrader.NotificationsHandler.call_count)
+
+    def _mock_products(self, n_products):
+        products = {
+            str(i): {"id": i, "name": " oid={}".format(i), "productCharacteristic": deepcopy(self._prev_asset_chars)}
+            for i in range(1, n_products + 1)
+        }
+
+        def get_products(query):
+            if "productOffering.id" in query:
+                return [{"id": product_id} for product_id in products]
+
+            return [products[product_id] for product_id in query["id"].split(",")]
+
+        self._client_instance.get_products.side_effect = get_products
+        self._client_instance.patch_product.side_effect = lambda product_id, patch: products[product_id]
+
+        inventory_upgrader.Offering.objects.filter.side_effect = [[MagicMock(off_id=self._product_off_id)], []]
+
+    @override_settings(INVENTORY_UPGRADE_WORKERS=4)
+    def test_inventory_upgrader_concurrent(self):
+        self._mock_products(7)
+        self._client_instance.patch_product.side_effect = lambda product_id, patch: (
+            self._raise_http_error() if product_id == "5" else {"id": product_id, "name": " oid=" + product_id}
+        )
+
+        upgrader = inventory_upgrader.InventoryUpgrader(self._asset)
+        upgrader.run()
+
+        self.assertCountEqual(
+            [call(str(i), {"productCharacteristic": self._new_asset_chars}) for i in range(1, 8)],
+            self._client_instance.patch_product.call_args_list,
+        )
+        self.assertEquals(
+            [{"asset_id": self._asset_pk, "pending_offerings": [], "pending_products": ["5"]}],
+            self._ctx_instance.failed_upgrades,
+        )
+
+        # Progress is saved at the start and after every page
+        self.assertEquals(
+            [0, 1, 2, 3, 4],
+            [c[0][1]["$set"]["page"] for c in self._checkpoints.update_one.call_args_list],
+        )
+        self.assertEquals(
+            ["5"],
+            self._checkpoints.update_one.call_args_list[-1][0][1]["$set"]["missing_products"],
+        )
+        self._checkpoints.delete_one.assert_called_once_with({"_id": self._asset_pk})
+
+    def _raise_http_error(self):
+        raise HTTPError()
+
+    def test_inventory_upgrader_resume(self):
+        self._mock_products(5)
+        checkpoint = {
+            "_id": self._asset_pk,
+            "offerings": [self._product_off_id],
+            "page": 2,
+            "missing_offerings": ["999"],
+            "missing_products": ["2"],
+        }
+
+        upgrader = inventory_upgrader.InventoryUpgrader(self._asset, checkpoint=checkpoint)
+        upgrader.run()
+
+        # Only the pages not processed before are upgraded
+        self.assertEquals(0, inventory_upgrader.Offering.objects.filter.call_count)
+        self.assertEquals(
+            [
+                call(query={"productOffering.id": self._product_off_id, "fields": "id"}),
+                call(query={"id": "5", "fields": "id,productCharacteristic"}),
+            ],
+            self._client_instance.get_products.call_args_list,
+        )
+        self.assertEquals(
+            [call("5", {"productCharacteristic": self._new_asset_chars})],
+            self._client_instance.patch_product.call_args_list,
+        )
+        self.assertEquals(
+            [{"asset_id": self._asset_pk, "pending_offerings": ["999"], "pending_products": ["2"]}],
+            self._ctx_instance.failed_upgrades,
+        )
+        self._checkpoints.delete_one.assert_called_once_with({"_id": self._asset_pk})
+
+    def test_resume_upgrades(self):
+        checkpoint = {"_id": "61004aba5e05acc115f022f0", "updated": "date"}
+        self._checkpoints.find.return_value = [checkpoint, {"_id": "61004aba5e05acc115f022f1", "updated": "date"}]
+        self._checkpoints.find_one_and_update.side_effect = [checkpoint, None]
+
+        inventory_upgrader.Resource.objects.get.return_value = self._asset
+
+        upgrader_class = inventory_upgrader.InventoryUpgrader
+        inventory_upgrader.InventoryUpgrader = MagicMock()
+        try:
+            upgraders = upgrader_class.resume_upgrades()
+            upgrader_mock = inventory_upgrader.InventoryUpgrader
+        finally:
+            inventory_upgrader.InventoryUpgrader = upgrader_class
+
+        self._checkpoints.find.assert_called_once_with({"updated": {"$lt": ANY}})
+        self.assertEquals(
+            [
+                call({"_id": "61004aba5e05acc115f022f0", "updated": "date"}, {"$set": {"updated": ANY}}),
+                call({"_id": "61004aba5e05acc115f022f1", "updated": "date"}, {"$set": {"updated": ANY}}),
+            ],
+            self._checkpoints.find_one_and_update.call_args_list,
+        )
+        inventory_upgrader.Resource.objects.get.assert_called_once_with(pk=ObjectId("61004aba5e05acc115f022f0"))
+        upgrader_mock.assert_called_once_with(self._asset, checkpoint=checkpoint)
+        upgrader_mock().start.assert_called_once_with()
+        self.assertEquals([upgrader_mock()], upgraders)
+
+    @override_settings(INVENTORY_UPGRADE_HEARTBEAT=0.01)
+    def test_inventory_upgrader_heartbeat(self):
+        upgrader = inventory_upgrader.InventoryUpgrader(self._asset)
+
+        stopped = upgrader._start_heartbeat()
+        try:
+            # The checkpoint is refreshed without changing the saved progress
+            for _ in range(100):
+                if self._checkpoints.update_one.call_count > 0:
+                    break
+                time.sleep(0.01)
+        finally:
+            stopped.set()
+
+        self._checkpoints.update_one.assert_called_with({"_id": self._asset_pk}, {"$set": {"updated": ANY}})
@@ -69,6 +69,7 @@ class ValidatorTestCase(TestCase):
 
         wstore.asset_manager.resource_plugins.decorators.ResourcePlugin = MagicMock()
         wstore.asset_manager.resource_plugins.decorators.ResourcePlugin.objects.get.return_value = self._plugin_instance
+        wstore.asset_manager.resource_plugins.decorators.plugin_registry.clear()
 
         # Mock Site
         product_validator.settings.SITE = "http://testlocation.org/"
@@ -663,11 +664,11 @@ class ValidatorTestCase(TestCase):
         self._validate_bundle_offering_calls(offering, True, is_open=True)
 
     def _mock_product_request(self):
-        offering_validator.requests = MagicMock()
+        offering_validator.get_http_session = MagicMock()
         product = deepcopy(BASIC_PRODUCT["product"])
         product["id"] = "20"
         resp = MagicMock()
-        offering_validator.requests.get.return_value = resp
+        offering_validator.get_http_session().get.return_value = resp
         resp.json.return_value = product
         resp.status_code = 200
 
@@ -708,7 +709,7 @@ class ValidatorTestCase(TestCase):
         ]
 
     def _catalog_api_error(self):
-        offering_validator.requests.get().status_code = 500
+        offering_validator.get_http_session().get().status_code = 500
 
     def _non_open_bundled(self):
         for bundle_resp in self._bundles:
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import re
+from datetime import datetime
+
+# The fields accept the same values as the %Y-%m-%d, %H:%M:%S strptime directives
+_DATE_TIME = (
+    r"(\d\d\d\d)-(1[0-2]|0[1-9]|[1-9])-(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])"
+    r"(?:[Tt]|\s+)(2[0-3]|[0-1]\d|\d):([0-5]\d|\d):(6[0-1]|[0-5]\d|\d)"
+)
+
+# Dates with an offset, everything after the + sign is ignored
+_OFFSET_RE = re.compile(_DATE_TIME + r"\+")
+
+# Dates with a fractional part, of which only the milliseconds are used
+_FRACTION_RE = re.compile(_DATE_TIME + r"\.(?:([0-9]{3})|([0-9]{1,2})(?:\.|\Z))")
+
+INVALID_DATE_MSG = (
+    "Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm"
+)
+
+
+def parse_sdr_date(raw_time):
+    """
+    Parses the date of an SDR, the fractional part is truncated to milliseconds (database supported)
+    :param raw_time: Date in one of the formats YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms,
+    or YYYY-MM-ddTHH:mm:ss+HH:mm
+    :return: datetime with the parsed date
+    """
+    if not isinstance(raw_time, str):
+        raise ValueError(INVALID_DATE_MSG)
+
+    microsecond = 0
+    if "+" in raw_time:
+        match = _OFFSET_RE.match(raw_time)
+        if match is None:
+            raise ValueError(INVALID_DATE_MSG)
+    else:
+        match = _FRACTION_RE.match(raw_time)
+        if match is None:
+            raise ValueError(INVALID_DATE_MSG)
+
+        millis = match.group(7) or match.group(8)
+        microsecond = int(millis) * 10 ** (6 - len(millis))
+
+    year, month, day, hour, minute, second = match.group(1, 2, 3, 4, 5, 6)
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond)
+    except ValueError as e:
+        raise ValueError(INVALID_DATE_MSG) from e
@@ -19,13 +19,51 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from datetime import datetime
-
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
 
-from wstore.models import Organization
+from wstore.charging_engine.accounting.date_parser import parse_sdr_date
+from wstore.models import Organization, UserProfile
 from wstore.ordering.models import Order
+from wstore.store_commons.utils.cache import TTLCache
+
+# Lookups of the SDR validation that rarely change. Orders are cached by their
+# primary key, as their contracts change with every SDR and are always read
+_order_pks = TTLCache(getattr(settings, "SDR_CACHE_SIZE", 10000), getattr(settings, "SDR_CACHE_TTL", 300))
+_customers = TTLCache(getattr(settings, "SDR_CACHE_SIZE", 10000), getattr(settings, "SDR_CACHE_TTL", 300))
+_user_organizations = TTLCache(getattr(settings, "SDR_CACHE_SIZE", 10000), getattr(settings, "SDR_CACHE_TTL", 300))
+
+
+def invalidate_order(order_id):
+    _order_pks.invalidate(order_id)
+
+
+def invalidate_customer(name):
+    _customers.invalidate(name)
+
+
+def invalidate_user(username):
+    _user_organizations.invalidate(username)
+
+
+def _customer_exists(name):
+    exists = _customers.get(name)
+    if exists is None:
+        exists = len(Organization.objects.filter(name=name)) > 0
+        _customers.set(name, exists)
+
+    return exists
+
+
+def _get_user_organizations(username):
+    organizations = _user_organizations.get(username)
+    if organizations is None:
+        user = User.objects.get(username=username)
+        organizations = frozenset(org["organization"] for org in user.userprofile.organizations)
+        _user_organizations.set(username, organizations)
+
+    return organizations
 
 
 class SDRManager(object):
@@ -33,16 +71,27 @@ class SDRManager(object):
         self._order = None
         self._contract = None
         self._time_stamp = None
+        self._contracts = {}
+        self._updated = set()
 
     def _get_order_contract(self, order_id, product_id):
         # Get the order
         order = None
         contract = None
 
-        try:
-            order = Order.objects.get(order_id=order_id)
-        except:
-            pass
+        order_pk = _order_pks.get(order_id)
+        if order_pk is not None:
+            try:
+                order = Order.objects.get(pk=order_pk)
+            except:
+                invalidate_order(order_id)
+
+        if order is None:
+            try:
+                order = Order.objects.get(order_id=order_id)
+                _order_pks.set(order_id, order.pk)
+            except:
+                pass
 
         try:
             contract = order.get_product_contract(product_id)
@@ -52,29 +101,7 @@ class SDRManager(object):
         return order, contract
 
     def _get_datetime(self, raw_time):
-        try:
-            if "+" in raw_time:
-                # Time with offset, remove it from the string
-                time = raw_time.split("+")[0] + ".0"
-            else:
-                sp_time = raw_time.split(".")
-                milis = sp_time[1]
-
-                if len(milis) > 3:
-                    milis = milis[:3]
-
-                time = sp_time[0] + "." + milis
-
-            try:
-                time_stamp = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f")
-            except:
-                time_stamp = datetime.strptime(time, "%Y-%m-%d %H:%M:%S.%f")
-        except:
-            raise ValueError(
-                "Invalid date format, must be YYYY-MM-ddTHH:mm:ss.ms, YYYY-MM-dd HH:mm:ss.ms, or YYYY-MM-ddTHH:mm:ss+HH:mm"
-            )
-
-        return time_stamp
+        return parse_sdr_date(raw_time)
 
     def get_sdr_values(self, sdr):
         expected_fields = ["orderid", "productid", "correlationnumber", "unit", "value"]
@@ -97,17 +124,11 @@ class SDRManager(object):
 
         return values
 
-    def validate_sdr(self, sdr):
-        if sdr["status"].lower() != "received":
-            raise ValueError("Invalid initial status, must be Received")
-
-        sdr_values = self.get_sdr_values(sdr)
-        self._order, self._contract = self._get_order_contract(sdr_values["orderid"], sdr_values["productid"])
-
-        if self._order is None:
+    def _check_sdr(self, sdr, sdr_values, order, contract, customer_exists, get_user_organizations):
+        if order is None:
             raise ValueError("Invalid orderId, the order does not exists")
 
-        if self._contract is None:
+        if contract is None:
             raise ValueError("Invalid productId, the contract does not exist")
 
         # Check that the value field is a valid number
@@ -121,33 +142,27 @@ class SDRManager(object):
 
         # Check that the customer exist
         customer_name = sdr["relatedParty"][0]["id"]
-        customer = Organization.objects.filter(name=customer_name)
 
-        if not len(customer):
+        if not customer_exists(customer_name):
             raise ValueError("The specified customer " + customer_name + " does not exist")
 
         # Check if the user making the request belongs to the customer organization
-        user = User.objects.get(username=customer_name)
-
-        for org in user.userprofile.organizations:
-            if org["organization"] == self._order.owner_organization.pk:
-                break
-        else:
+        if order.owner_organization.pk not in get_user_organizations(customer_name):
             raise PermissionDenied("You don't belong to the customer organization")
 
         # Validate that the price mode included in the contract correspond to the one specified in the SDR
-        price_model = self._contract.pricing_model
+        price_model = contract.pricing_model
         if "pay_per_use" not in price_model:
             raise ValueError("The pricing model of the offering does not define pay-per-use components")
 
         # Check the correlation number and timestamp
-        if int(sdr_values["correlationnumber"]) != self._contract.correlation_number:
-            raise ValueError("Invalid correlation number, expected: " + str(self._contract.correlation_number))
+        if int(sdr_values["correlationnumber"]) != contract.correlation_number:
+            raise ValueError("Invalid correlation number, expected: " + str(contract.correlation_number))
 
         # Truncate ms to 3 decimals (database supported)
-        self._time_stamp = self._get_datetime(sdr["date"])
+        time_stamp = self._get_datetime(sdr["date"])
 
-        if self._contract.last_usage is not None and self._contract.last_usage > self._time_stamp:
+        if contract.last_usage is not None and contract.last_usage > time_stamp:
             raise ValueError("The provided timestamp specifies a lower timing than the last SDR received")
 
         # Check that the pricing model contains the specified unit
@@ -157,8 +172,124 @@ class SDRManager(object):
         else:
             raise ValueError("The specified unit is not included in the pricing model")
 
+        return time_stamp
+
+    def validate_sdr(self, sdr):
+        if sdr["status"].lower() != "received":
+            raise ValueError("Invalid initial status, must be Received")
+
+        sdr_values = self.get_sdr_values(sdr)
+        self._order, self._contract = self._get_order_contract(sdr_values["orderid"], sdr_values["productid"])
+
+        self._time_stamp = self._check_sdr(
+            sdr,
+            sdr_values,
+            self._order,
+            self._contract,
+            _customer_exists,
+            _get_user_organizations,
+        )
+
     def update_usage(self):
         # Save new usage information
         self._contract.last_usage = self._time_stamp
         self._contract.correlation_number += 1
         self._order.save()
+
+    def validate_sdrs(self, sdrs):
+        """
+        Validates a batch of SDRs loading all the involved orders, customers and users at once.
+        SDRs of the same contract are validated in order, so their correlation numbers must be
+        consecutive
+        :param sdrs: List of SDR documents
+        :return: List with the HTTP status code and message of the validation of each SDR
+        """
+        # Extract the characteristics of all the SDRs before accessing the database
+        parsed = []
+        for sdr in sdrs:
+            try:
+                if "id" not in sdr:
+                    raise ValueError("Missing required field id")
+
+                if sdr["status"].lower() != "received":
+                    raise ValueError("Invalid initial status, must be Received")
+
+                parsed.append((self.get_sdr_values(sdr), None))
+            except Exception as e:
+                parsed.append((None, e))
+
+        order_ids = set(sdr_values["orderid"] for sdr_values, _ in parsed if sdr_values is not None)
+        orders = {order.order_id: order for order in Order.objects.filter(order_id__in=list(order_ids))}
+
+        names = set()
+        for sdr in sdrs:
+            try:
+                names.add(sdr["relatedParty"][0]["id"])
+            except:
+                pass
+
+        customers = set(org.name for org in Organization.objects.filter(name__in=list(names)))
+        users = {user.username: user for user in User.objects.filter(username__in=list(names))}
+
+        # Profiles are loaded in a single query instead of once per user
+        user_ids = [user.pk for user in users.values()]
+        profiles = {profile.user_id: profile for profile in UserProfile.objects.filter(user_id__in=user_ids)}
+
+        def get_user_organizations(name):
+            if name not in users:
+                raise User.DoesNotExist("User matching query does not exist.")
+
+            return frozenset(org["organization"] for org in profiles[users[name].pk].organizations)
+
+        # Contracts are loaded once per batch, so the SDRs of the same contract see the previous ones
+        self._contracts = {}
+        self._updated = set()
+        results = []
+        for sdr, (sdr_values, error) in zip(sdrs, parsed):
+            try:
+                if error is not None:
+                    raise error
+
+                key = (sdr_values["orderid"], sdr_values["productid"])
+                if key not in self._contracts:
+                    order = orders.get(sdr_values["orderid"])
+                    contract = None
+                    try:
+                        contract = order.get_product_contract(sdr_values["productid"])
+                    except:
+                        pass
+
+                    self._contracts[key] = (order, contract)
+
+                order, contract = self._contracts[key]
+                time_stamp = self._check_sdr(
+                    sdr, sdr_values, order, contract, customers.__contains__, get_user_organizations
+                )
+
+                contract.last_usage = time_stamp
+                contract.correlation_number += 1
+                self._updated.add(key)
+                results.append((200, "OK"))
+            except PermissionDenied as e:
+                results.append((403, str(e)))
+            except ValueError as e:
+                results.append((422, str(e)))
+            except:
+                results.append((500, "The SDR document could not be processed due to an unexpected error"))
+
+        return results
+
+    def update_usages(self):
+        """
+        Saves the usage information of the SDRs validated with validate_sdrs, saving each order once
+        """
+        updated = {}
+        for key in self._updated:
+            order, contract = self._contracts[key]
+            updated.setdefault(order.order_id, (order, {}))[1][contract.product_id] = contract
+
+        for order, contracts in updated.values():
+            order.contracts = [contracts.get(c["product_id"], c) for c in order.contracts]
+            order.save()
+
+        return len(updated)
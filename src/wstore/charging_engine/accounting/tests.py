@@ -21,16 +21,18 @@
 
 
 import json
+import random
 from copy import deepcopy
 from datetime import datetime
 from importlib import reload
 
 from django.core.exceptions import PermissionDenied
-from django.test import TestCase
-from mock import MagicMock
+from django.test import TestCase, override_settings
+from mock import ANY, MagicMock, call
 from parameterized import parameterized
+from pymongo import DeleteOne, UpdateOne
 
-from wstore.charging_engine.accounting import sdr_manager, usage_client, views
+from wstore.charging_engine.accounting import date_parser, sdr_manager, usage_client, usage_rater, views
 from wstore.charging_engine.accounting.errors import UsageError
 
 BASIC_SDR = {
@@ -77,6 +79,9 @@ class SDRManagerTestCase(TestCase):
 
         self._timestamp = datetime.strptime("2015-10-20 17:31:57.100", "%Y-%m-%d %H:%M:%S.%f")
 
+    def tearDown(self):
+        reload(sdr_manager)
+
     def _side_cust_not_exists(self):
         sdr_manager.Organization.objects.filter.return_value = []
 
@@ -262,6 +267,49 @@ class SDRManagerTestCase(TestCase):
             self.assertTrue(isinstance(error, err_type))
             self.assertEquals(str(error), err_msg)
 
+    def test_sdr_lookups_cached(self):
+        self._order.pk = "order_pk"
+        sdr_mng = sdr_manager.SDRManager()
+
+        sdr_mng.validate_sdr(deepcopy(BASIC_SDR))
+
+        self._contract.correlation_number = 2
+        sdr = deepcopy(BASIC_SDR)
+        sdr["usageCharacteristic"][2]["value"] = "2"
+        sdr_mng.validate_sdr(sdr)
+
+        # Only the order is read again, by its primary key
+        self.assertEqual(
+            [call(order_id="1"), call(pk="order_pk")],
+            sdr_manager.Order.objects.get.call_args_list,
+        )
+        sdr_manager.Organization.objects.filter.assert_called_once_with(name="test_user")
+        sdr_manager.User.objects.get.assert_called_once_with(username="test_user")
+
+        # Changes in the customer profile are visible once invalidated
+        self._user.userprofile.organizations = [{"organization": "2222"}]
+        sdr_manager.invalidate_user("test_user")
+        sdr_manager.invalidate_customer("test_user")
+
+        with self.assertRaises(PermissionDenied):
+            sdr_mng.validate_sdr(sdr)
+
+        self.assertEqual(2, sdr_manager.Organization.objects.filter.call_count)
+        self.assertEqual(2, sdr_manager.User.objects.get.call_count)
+
+    def test_sdr_deleted_order_cached(self):
+        self._order.pk = "order_pk"
+        sdr_mng = sdr_manager.SDRManager()
+        sdr_mng.validate_sdr(deepcopy(BASIC_SDR))
+
+        # The order is not found by its cached primary key
+        sdr_manager.Order.objects.get.side_effect = [Exception("Not found"), Exception("Not found")]
+
+        with self.assertRaises(ValueError):
+            sdr_mng.validate_sdr(deepcopy(BASIC_SDR))
+
+        self.assertIsNone(sdr_manager._order_pks.get("1"))
+
     def test_update_usage(self):
         sdr_mng = sdr_manager.SDRManager()
         sdr_mng._contract = self._contract
@@ -275,6 +323,156 @@ class SDRManagerTestCase(TestCase):
 
         self._order.save.assert_called_once_with()
 
+    def _batch_sdr(self, usage_id, correlation, order_id="1"):
+        sdr = deepcopy(BASIC_SDR)
+        sdr["id"] = usage_id
+        sdr["usageCharacteristic"][0]["value"] = order_id
+        sdr["usageCharacteristic"][2]["value"] = str(correlation)
+        return sdr
+
+    def test_validate_sdrs(self):
+        self._order.order_id = "1"
+        self._contract.product_id = "2"
+        sdr_manager.Order.objects.filter.return_value = [self._order]
+        sdr_manager.Organization.objects.filter.return_value[0].name = "test_user"
+        self._user.username = "test_user"
+        sdr_manager.User.objects.filter.return_value = [self._user]
+        sdr_manager.UserProfile = MagicMock()
+        self._user.userprofile.user_id = self._user.pk
+        sdr_manager.UserProfile.objects.filter.return_value = [self._user.userprofile]
+
+        no_id = self._batch_sdr("5", 3)
+        del no_id["id"]
+        sdrs = [
+            self._batch_sdr("1", 1),
+            self._batch_sdr("2", 2),
+            self._batch_sdr("3", 5),
+            self._batch_sdr("4", 1, order_id="2"),
+            no_id,
+            self._batch_sdr("6", 3),
+        ]
+
+        sdr_mng = sdr_manager.SDRManager()
+        results = sdr_mng.validate_sdrs(sdrs)
+
+        self.assertEqual(
+            [
+                (200, "OK"),
+                (200, "OK"),
+                (422, "Invalid correlation number, expected: 3"),
+                (422, "Invalid orderId, the order does not exists"),
+                (422, "Missing required field id"),
+                (200, "OK"),
+            ],
+            results,
+        )
+        self.assertEqual(4, self._contract.correlation_number)
+        self.assertEqual(self._timestamp, self._contract.last_usage)
+
+        # Database access is grouped for the whole batch
+        sdr_manager.Order.objects.filter.assert_called_once_with(order_id__in=ANY)
+        self.assertEqual(["1", "2"], sorted(sdr_manager.Order.objects.filter.call_args[1]["order_id__in"]))
+        sdr_manager.Organization.objects.filter.assert_called_once_with(name__in=["test_user"])
+        sdr_manager.User.objects.filter.assert_called_once_with(username__in=["test_user"])
+        sdr_manager.UserProfile.objects.filter.assert_called_once_with(user_id__in=[self._user.pk])
+        self._order.get_product_contract.assert_called_once_with("2")
+
+        # Each order is saved once
+        other_contract = {"product_id": "3"}
+        self._order.contracts = [{"product_id": "2"}, other_contract]
+
+        self.assertEqual(1, sdr_mng.update_usages())
+        self.assertEqual([self._contract, other_contract], self._order.contracts)
+        self._order.save.assert_called_once_with()
+
+
+def _legacy_get_datetime(raw_time):
+    # Previous implementation of SDRManager._get_datetime, used as reference
+    try:
+        if "+" in raw_time:
+            time = raw_time.split("+")[0] + ".0"
+        else:
+            sp_time = raw_time.split(".")
+            milis = sp_time[1]
+
+            if len(milis) > 3:
+                milis = milis[:3]
+
+            time = sp_time[0] + "." + milis
+
+        try:
+            time_stamp = datetime.strptime(time, "%Y-%m-%dT%H:%M:%S.%f")
+        except:
+            time_stamp = datetime.strptime(time, "%Y-%m-%d %H:%M:%S.%f")
+    except:
+        raise ValueError("Invalid date")
+
+    return time_stamp
+
+
+class SDRDateParserTestCase(TestCase):
+    tags = ("sdr",)
+
+    def _parse(self, parser, raw_time):
+        try:
+            return parser(raw_time)
+        except ValueError:
+            return ValueError
+
+    @parameterized.expand(
+        [
+            ("space", "2015-10-20 17:31:57.100000", datetime(2015, 10, 20, 17, 31, 57, 100000)),
+            ("t_separator", "2015-10-20T17:31:57.838123", datetime(2015, 10, 20, 17, 31, 57, 838000)),
+            ("short_fraction", "2015-10-20T17:31:57.8", datetime(2015, 10, 20, 17, 31, 57, 800000)),
+            ("offset", "2015-10-20T17:31:57+02:00", datetime(2015, 10, 20, 17, 31, 57)),
+            ("zulu", "2015-10-20T17:31:57.838Z", datetime(2015, 10, 20, 17, 31, 57, 838000)),
+            ("no_fraction", "2015-10-20T17:31:57", None),
+            ("offset_fraction", "2015-10-20T17:31:57.838+02:00", None),
+            ("invalid_day", "2015-02-30T17:31:57.838", None),
+            ("not_a_date", "invalid", None),
+            ("not_a_string", 1445362317, None),
+        ]
+    )
+    def test_parse_sdr_date(self, name, raw_time, expected):
+        if expected is None:
+            with self.assertRaises(ValueError) as ctx:
+                date_parser.parse_sdr_date(raw_time)
+
+            self.assertEqual(date_parser.INVALID_DATE_MSG, str(ctx.exception))
+        else:
+            self.assertEqual(expected, date_parser.parse_sdr_date(raw_time))
+
+    def test_parse_sdr_date_matches_legacy(self):
+        # Randomized comparison with the previous parser over valid and malformed dates
+        rnd = random.Random(20151020)
+
+        def number(low, high, width):
+            value = str(rnd.randint(low, high))
+            return value.zfill(width) if rnd.random() < 0.8 else value
+
+        for _ in range(5000):
+            raw_time = "{}-{}-{}{}{}:{}:{}".format(
+                number(1, 9999, 4),
+                number(0, 13, 2),
+                number(0, 32, 2),
+                rnd.choice(["T", " ", "t", "  ", "\t", "_"]),
+                number(0, 24, 2),
+                number(0, 60, 2),
+                number(0, 61, 2),
+            )
+            raw_time += rnd.choice(["", ".", "." + "".join(rnd.choice("0123456789") for _ in range(rnd.randint(1, 8)))])
+            raw_time += rnd.choice(["", "", "Z", "+02:00", "-02:00", "+", ".5", "x"])
+
+            if rnd.random() < 0.05:
+                pos = rnd.randint(0, len(raw_time))
+                raw_time = raw_time[:pos] + rnd.choice(".+: T-0") + raw_time[pos:]
+
+            self.assertEqual(
+                self._parse(_legacy_get_datetime, raw_time),
+                self._parse(date_parser.parse_sdr_date, raw_time),
+                raw_time,
+            )
+
 
 BASIC_USAGE = {
     "id": "3",
@@ -297,7 +495,7 @@ class UsageClientTestCase(TestCase):
 
     def setUp(self):
         usage_client.settings.USAGE = "http://example.com/DSUsageManagement"
-        usage_client.requests = MagicMock()
+        usage_client.get_http_session = MagicMock()
         self._old_inv = usage_client.settings.INVENTORY
         usage_client.settings.INVENTORY = "http://localhost:8080/DSProductInventory"
 
@@ -324,26 +522,127 @@ class UsageClientTestCase(TestCase):
         # Create mocks
         mock_response = MagicMock()
         mock_response.json.return_value = response
-        usage_client.requests.get.return_value = mock_response
+        last_response = MagicMock()
+        last_response.json.return_value = []
+        usage_client.get_http_session().get.side_effect = [mock_response, last_response]
         client = usage_client.UsageClient()
 
         cust_usage = client.get_customer_usage(self._customer, self._product_id, state=state)
 
         # Verify response
-        self.assertEquals(exp_resp, cust_usage)
+        self.assertEquals(exp_resp, list(cust_usage))
 
         # Verify calls
-        usage_client.requests.get.assert_called_once_with(
-            usage_client.settings.USAGE
-            + "/api/usageManagement/v2/usage?relatedParty.id="
-            + self._customer
-            + extra_query,
-            headers={"Accept": "application/json"},
+        url = usage_client.settings.USAGE + "/api/usageManagement/v2/usage?relatedParty.id=" + self._customer
+        self.assertEquals(
+            [
+                call(url + extra_query + "&sort=id&offset=0&size=100", headers={"Accept": "application/json"}),
+                call(
+                    url + extra_query + "&sort=id&offset={}&size=100".format(len(response)),
+                    headers={"Accept": "application/json"},
+                ),
+            ],
+            usage_client.get_http_session().get.call_args_list,
         )
 
         mock_response.raise_for_status.assert_called_once_with()
         mock_response.json.assert_called_once_with()
 
+    def _usage_doc(self, usage_id, product_id="1"):
+        return {"id": usage_id, "usageCharacteristic": [{"name": "productId", "value": product_id}]}
+
+    @override_settings(USAGE_PAGE_SIZE=2)
+    def test_retrieve_usage_paginated(self):
+        pages = [
+            [self._usage_doc("1"), self._usage_doc("2", product_id="2")],
+            [self._usage_doc("3"), self._usage_doc("4")],
+            [self._usage_doc("5")],
+            [],
+        ]
+        responses = [MagicMock(**{"json.return_value": page}) for page in pages]
+        usage_client.get_http_session().get.side_effect = responses
+
+        client = usage_client.UsageClient()
+        cust_usage = client.get_customer_usage(self._customer, self._product_id, state="Guided")
+
+        # Pages are only requested as the usage is consumed
+        self.assertEqual("1", next(cust_usage)["id"])
+        self.assertEqual(1, usage_client.get_http_session().get.call_count)
+
+        self.assertEqual(["3", "4", "5"], [usage["id"] for usage in cust_usage])
+
+        url = usage_client.settings.USAGE + "/api/usageManagement/v2/usage?relatedParty.id=test_customer&status=Guided"
+        self.assertEqual(
+            [
+                call(url + "&sort=id&offset=0&size=2", headers={"Accept": "application/json"}),
+                call(url + "&sort=id&offset=2&size=2", headers={"Accept": "application/json"}),
+                call(url + "&sort=id&offset=4&size=2", headers={"Accept": "application/json"}),
+                call(url + "&sort=id&offset=5&size=2", headers={"Accept": "application/json"}),
+            ],
+            usage_client.get_http_session().get.call_args_list,
+        )
+
+    @override_settings(USAGE_PAGE_SIZE=3)
+    def test_retrieve_usage_capped_pages(self):
+        # The API returns fewer documents than requested
+        pages = [
+            [self._usage_doc("1"), self._usage_doc("2")],
+            [self._usage_doc("3"), self._usage_doc("4")],
+            [],
+        ]
+        responses = [MagicMock(**{"json.return_value": page}) for page in pages]
+        usage_client.get_http_session().get.side_effect = responses
+
+        client = usage_client.UsageClient()
+        cust_usage = client.get_customer_usage(self._customer, self._product_id, state="Guided")
+
+        self.assertEqual(["1", "2", "3", "4"], [usage["id"] for usage in cust_usage])
+
+        url = usage_client.settings.USAGE + "/api/usageManagement/v2/usage?relatedParty.id=test_customer&status=Guided"
+        self.assertEqual(
+            [
+                call(url + "&sort=id&offset=0&size=3", headers={"Accept": "application/json"}),
+                call(url + "&sort=id&offset=2&size=3", headers={"Accept": "application/json"}),
+                call(url + "&sort=id&offset=4&size=3", headers={"Accept": "application/json"}),
+            ],
+            usage_client.get_http_session().get.call_args_list,
+        )
+
+    @override_settings(USAGE_PAGE_SIZE=2)
+    def test_retrieve_usage_shifted_pages(self):
+        # Usage 2 is returned again as a new usage entered the Guided state while paging
+        pages = [
+            [self._usage_doc("1"), self._usage_doc("2")],
+            [self._usage_doc("2"), self._usage_doc("3")],
+            [self._usage_doc("4")],
+            [],
+        ]
+        responses = [MagicMock(**{"json.return_value": page}) for page in pages]
+        usage_client.get_http_session().get.side_effect = responses
+
+        client = usage_client.UsageClient()
+        cust_usage = client.get_customer_usage(self._customer, self._product_id, state="Guided")
+
+        self.assertEqual(["1", "2", "3", "4"], [usage["id"] for usage in cust_usage])
+        self.assertEqual(4, usage_client.get_http_session().get.call_count)
+
+    @override_settings(USAGE_PAGE_SIZE=2, USAGE_PRODUCT_FILTER=True)
+    def test_retrieve_usage_no_pagination_support(self):
+        # The API returns all the documents whatever the requested page
+        page = [self._usage_doc("1"), self._usage_doc("2")]
+        usage_client.get_http_session().get.return_value = MagicMock(**{"json.return_value": page})
+
+        client = usage_client.UsageClient()
+        cust_usage = list(client.get_customer_usage(self._customer, self._product_id))
+
+        self.assertEqual(page, cust_usage)
+        self.assertEqual(2, usage_client.get_http_session().get.call_count)
+        usage_client.get_http_session().get.assert_called_with(
+            usage_client.settings.USAGE
+            + "/api/usageManagement/v2/usage?relatedParty.id=test_customer&usageCharacteristic.value=1&sort=id&offset=2&size=2",
+            headers={"Accept": "application/json"},
+        )
+
     def _test_invalid_state(self, method, args, kwargs):
         error = None
         try:
@@ -364,12 +663,12 @@ class UsageClientTestCase(TestCase):
 
     def _test_patch(self, expected_json, method, args):
         mock_response = MagicMock()
-        usage_client.requests.patch.return_value = mock_response
+        usage_client.get_http_session().patch.return_value = mock_response
 
         method(*args)
 
         # Verify calls
-        usage_client.requests.patch.assert_called_once_with(
+        usage_client.get_http_session().patch.assert_called_once_with(
             usage_client.settings.USAGE + "/api/usageManagement/v2/usage/" + BASIC_USAGE["id"],
             json=expected_json,
         )
@@ -434,6 +733,110 @@ class UsageClientTestCase(TestCase):
         )
         reload(usage_client)
 
+    def test_rate_usages(self):
+        usage_client.settings.SITE = "http://example.com/"
+
+        session = usage_client.get_http_session()
+        responses = [MagicMock(), MagicMock()]
+        responses[1].raise_for_status.side_effect = Exception("Server error")
+        session.patch.side_effect = responses
+
+        client = usage_client.UsageClient()
+        patches = client.get_rating_patches(
+            [("1", "10", "12", "20"), ("2", "5", "6", "20")], "2016-04-15 10:00:00", "EUR", self._product_id
+        )
+        failed = client.patch_usages(patches, workers=1)
+
+        product_url = "http://example.com/DSProductInventory/api/productInventory/v2/product/1"
+        self.assertEqual(["1", "2"], [usage_id for usage_id, patch in patches])
+        self.assertEqual(
+            client._build_rating_patch("2016-04-15 10:00:00", "5", "6", "20", "EUR", product_url), patches[1][1]
+        )
+        self.assertEqual("2016-04-15T10:00:00", patches[0][1]["ratedProductUsage"][0]["ratingDate"])
+
+        self.assertEqual([("2", patches[1][1], "Server error")], failed)
+        self.assertEqual(
+            [
+                call("http://example.com/DSUsageManagement/api/usageManagement/v2/usage/1", json=patches[0][1]),
+                call("http://example.com/DSUsageManagement/api/usageManagement/v2/usage/2", json=patches[1][1]),
+            ],
+            session.patch.call_args_list,
+        )
+        session.close.assert_not_called()
+        reload(usage_client)
+
+
+class UsageRaterTestCase(TestCase):
+    tags = ("usage-client",)
+
+    def setUp(self):
+        usage_rater.get_database_connection = MagicMock()
+        self._collection = usage_rater.get_database_connection().wstore_failed_ratings
+
+        usage_rater.UsageClient = MagicMock()
+        self._client = usage_rater.UsageClient()
+        self._client.get_rating_patches.return_value = [("1", {"status": "Rated"}), ("2", {"status": "Rated"})]
+
+        usage_rater.datetime = MagicMock()
+        self._now = datetime(2016, 1, 20, 13, 12, 39)
+        usage_rater.datetime.utcnow.return_value = self._now
+
+    def tearDown(self):
+        reload(usage_rater)
+
+    def _expected_failed(self, *usage_ids):
+        return [
+            UpdateOne(
+                {"_id": usage_id},
+                {
+                    "$set": {"patch": {"status": "Rated"}, "error": "error", "failed_at": self._now},
+                    "$inc": {"attempts": 1},
+                },
+                upsert=True,
+            )
+            for usage_id in usage_ids
+        ]
+
+    @override_settings(USAGE_RATING_WORKERS=4)
+    def test_rate(self):
+        self._client.patch_usages.return_value = [("2", {"status": "Rated"}, "error")]
+        ratings = [("1", "10", "12", "20"), ("2", "5", "6", "20")]
+
+        failed = usage_rater.UsageRater().rate(ratings, "2016-01-20 13:12:39", "EUR", "product")
+
+        self.assertEqual([("2", {"status": "Rated"}, "error")], failed)
+        self._client.get_rating_patches.assert_called_once_with(ratings, "2016-01-20 13:12:39", "EUR", "product")
+        self._client.patch_usages.assert_called_once_with(
+            [("1", {"status": "Rated"}), ("2", {"status": "Rated"})], workers=4
+        )
+        self._collection.bulk_write.assert_called_once_with(self._expected_failed("2"), ordered=False)
+
+    @override_settings(USAGE_RATING_BACKGROUND=True)
+    def test_rate_background(self):
+        self._client.patch_usages.return_value = []
+
+        future = usage_rater.UsageRater().rate([("1", "10", "12", "20")], "2016-01-20 13:12:39", "EUR", "product")
+
+        self.assertEqual([], future.result(timeout=5))
+        self._collection.bulk_write.assert_not_called()
+
+    def test_retry_failed(self):
+        self._collection.find.return_value = [
+            {"_id": "1", "patch": {"status": "Rated"}},
+            {"_id": "2", "patch": {"status": "Rated"}},
+        ]
+        self._client.patch_usages.return_value = [("2", {"status": "Rated"}, "error")]
+
+        self.assertEqual((1, 1), usage_rater.UsageRater().retry_failed())
+
+        self.assertEqual(
+            [
+                call([DeleteOne({"_id": "1"})], ordered=False),
+                call(self._expected_failed("2"), ordered=False),
+            ],
+            self._collection.bulk_write.call_args_list,
+        )
+
 
 MANAGER_DENIED_RESP = {"result": "error", "error": "Permission denied"}
 
@@ -540,3 +943,62 @@ class SDRCollectionTestCase(TestCase):
             else:
                 views.UsageClient().update_usage_state.assert_called_once_with("1", "Rejected")
                 self.assertEquals(0, self._manager_inst.update_usage.call_count)
+
+    def _batch_request(self, body, content_type):
+        self.request.body = body
+        self.request.META.get.side_effect = (
+            lambda name, default=None: content_type if name == "CONTENT_TYPE" else "application/json"
+        )
+
+        views.get_usage_rater = MagicMock()
+        self._manager_inst.validate_sdrs.return_value = [(200, "OK"), (422, "Value error")]
+
+        collection = views.ServiceRecordBatchCollection(permitted_methods=("POST",))
+        return collection.create(self.request)
+
+    @parameterized.expand(
+        [
+            ("json", "application/json", lambda sdrs: json.dumps(sdrs)),
+            ("ndjson", "application/x-ndjson", lambda sdrs: "\n".join(json.dumps(sdr) for sdr in sdrs) + "\n"),
+        ]
+    )
+    def test_feed_sdr_batch(self, name, content_type, serialize):
+        sdrs = [deepcopy(BASIC_SDR), deepcopy(BASIC_SDR)]
+        sdrs[0]["id"] = "1"
+        sdrs[1]["id"] = "2"
+
+        response = self._batch_request(serialize(sdrs).encode("utf-8"), content_type)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [
+                {"id": "1", "status": 200, "message": "OK"},
+                {"id": "2", "status": 422, "message": "Value error"},
+            ],
+            json.loads(response.content),
+        )
+
+        self._manager_inst.validate_sdrs.assert_called_once_with(sdrs)
+        self._manager_inst.update_usages.assert_called_once_with()
+        views.get_usage_rater().send.assert_called_once_with(
+            [("1", {"status": "Guided"}), ("2", {"status": "Rejected"})]
+        )
+
+    @parameterized.expand(
+        [
+            ("invalid_json", b"invalid", 400, "The request does not contain a valid JSON array or NDJSON stream"),
+            (
+                "not_list",
+                json.dumps(BASIC_SDR).encode("utf-8"),
+                400,
+                "The request must contain a list of SDR documents",
+            ),
+            ("too_big", json.dumps([BASIC_SDR] * 3).encode("utf-8"), 413, "A batch cannot contain more than 2 SDRs"),
+        ]
+    )
+    @override_settings(SDR_BATCH_MAX_SIZE=2)
+    def test_feed_sdr_batch_invalid(self, name, body, exp_code, exp_msg):
+        response = self._batch_request(body, "application/json")
+
+        self._validate_response(response, exp_code, {"result": "error", "error": exp_msg})
+        self._manager_inst.validate_sdrs.assert_not_called()
@@ -19,12 +19,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlparse
 
-import requests
 from django.conf import settings
 
 from wstore.charging_engine.accounting.errors import UsageError
+from wstore.store_commons.async_client import AsyncClient
+from wstore.store_commons.http_session import get_http_session
 
 
 class UsageClient(object):
@@ -52,7 +54,7 @@ class UsageClient(object):
         # Override the needed headers to avoid spec hrefs to be created with internal host and port
         headers = {"Host": urlparse(settings.SITE).netloc}
 
-        r = requests.post(url, headers=headers, json=usage_item)
+        r = get_http_session().post(url, headers=headers, json=usage_item)
         r.raise_for_status()
 
         return r.json()
@@ -87,38 +89,77 @@ class UsageClient(object):
         path = "api/usageManagement/v2/usageSpecification/" + spec_id
         url = urljoin(self._usage_api, path)
 
-        r = requests.delete(url)
+        r = get_http_session().delete(url)
         r.raise_for_status()
 
+    def _get_usage_pages(self, url, page_size):
+        offset = 0
+        first_id = None
+
+        while True:
+            # Pages are sorted by id, so their contents do not depend on the order chosen by the API
+            r = get_http_session().get(
+                "{}&sort=id&offset={}&size={}".format(url, offset, page_size),
+                headers={"Accept": "application/json"},
+            )
+            r.raise_for_status()
+
+            page = r.json()
+
+            # The API may cap the size of the pages, so only an empty page is the last one. Stop
+            # too if the API ignores the pagination and returns the same documents again
+            if not len(page) or (offset and page[0].get("id") == first_id):
+                break
+
+            yield page
+
+            first_id = page[0].get("id")
+            offset += len(page)
+
+    def _iter_customer_usage(self, url, product_id, page_size):
+        # Documents leaving the filtered state while paging shift the next pages back, so the
+        # following ones are skipped until the next retrieval, while documents entering it shift
+        # them forward and the same usage is returned twice
+        seen = set()
+
+        for page in self._get_usage_pages(url, page_size):
+            for usage_doc in page:
+                usage_id = usage_doc.get("id")
+                if usage_id in seen:
+                    continue
+
+                seen.add(usage_id)
+                if self._belongs_to_product(usage_doc, product_id):
+                    yield usage_doc
+
     def get_customer_usage(self, customer, product_id, state=None):
         """
-        Retrieves the usage made by a customer filtered by service and status
+        Retrieves the usage made by a customer filtered by service and status. The usage
+        is retrieved page by page as the returned generator is consumed
         :param customer: username of the customer
         :param product_id: id of the acquired product being used
         :param state: state of the usage to be retrieved
-        :return: List of customer usages
+        :return: Generator of customer usages
         """
         # Get customer usage filtered by state
         path = "api/usageManagement/v2/usage"
-        url = urljoin(self._usage_api, path) + "?relatedParty.id=" + customer
+        url = urljoin(self._usage_api, path) + "?relatedParty.id=" + quote(customer)
 
         if state is not None:
             self._validate_state(state)
             url += "&status=" + state
 
-        r = requests.get(url, headers={"Accept": "application/json"})
+        if getattr(settings, "USAGE_PRODUCT_FILTER", False):
+            url += "&usageCharacteristic.value=" + quote(str(product_id))
 
-        r.raise_for_status()
-
-        raw_usage = r.json()
-        # Filter only the usage belonging to the specified product
-        return [usage_doc for usage_doc in raw_usage if self._belongs_to_product(usage_doc, product_id)]
+        # The product is checked anyway, as the filter also matches other characteristics
+        return self._iter_customer_usage(url, product_id, int(getattr(settings, "USAGE_PAGE_SIZE", 100)))
 
     def _patch_usage(self, usage_id, patch):
         path = "api/usageManagement/v2/usage/" + str(usage_id)
         url = urljoin(self._usage_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_http_session().patch(url, json=patch)
         r.raise_for_status()
 
     def update_usage_state(self, usage_id, state):
@@ -133,24 +174,15 @@ class UsageClient(object):
         patch = {"status": state}
         self._patch_usage(usage_id, patch)
 
-    def rate_usage(self, usage_id, timestamp, duty_free, price, rate, currency, product_id):
-        """
-        Rates a product with the amount to be charge to the customer based on the given usage
-        :param usage_id: usage where the rate is going to be included
-        :param timestamp: Timestamp when the used was rated
-        :param duty_free: rate value without taxes
-        :param price: rate value with taxes
-        :param rate: applied tax rate
-        :param currency: currency of the amount
-        :param product_id: Id of the product that generates the usage
-        :return:
-        """
+    def _get_product_url(self, product_id):
         inventory_path = settings.INVENTORY.split("/")[3]
         ext_host = settings.SITE
         inventory_url = urljoin(ext_host, inventory_path + "/")
 
-        product_url = urljoin(inventory_url, "api/productInventory/v2/product/" + str(product_id))
-        patch = {
+        return urljoin(inventory_url, "api/productInventory/v2/product/" + str(product_id))
+
+    def _build_rating_patch(self, timestamp, duty_free, price, rate, currency, product_url):
+        return {
             "status": "Rated",
             "ratedProductUsage": [
                 {
@@ -169,4 +201,65 @@ class UsageClient(object):
             ],
         }
 
+    def rate_usage(self, usage_id, timestamp, duty_free, price, rate, currency, product_id):
+        """
+        Rates a product with the amount to be charge to the customer based on the given usage
+        :param usage_id: usage where the rate is going to be included
+        :param timestamp: Timestamp when the used was rated
+        :param duty_free: rate value without taxes
+        :param price: rate value with taxes
+        :param rate: applied tax rate
+        :param currency: currency of the amount
+        :param product_id: Id of the product that generates the usage
+        :return:
+        """
+        patch = self._build_rating_patch(timestamp, duty_free, price, rate, currency, self._get_product_url(product_id))
         self._patch_usage(usage_id, patch)
+
+    def get_rating_patches(self, ratings, timestamp, currency, product_id):
+        """
+        Builds the patches that rate a set of usage documents of the same product
+        :param ratings: List of (usage_id, duty_free, price, rate) tuples
+        :param timestamp: Timestamp when the used was rated
+        :param currency: currency of the amounts
+        :param product_id: Id of the product that generates the usage
+        :return: List of (usage_id, patch) tuples
+        """
+        product_url = self._get_product_url(product_id)
+
+        return [
+            (usage_id, self._build_rating_patch(timestamp, duty_free, price, rate, currency, product_url))
+            for usage_id, duty_free, price, rate in ratings
+        ]
+
+    def patch_usages(self, patches, workers=1):
+        """
+        Applies a set of patches to usage documents using the shared pool of keep-alive connections
+        :param patches: List of (usage_id, patch) tuples
+        :param workers: Number of patches sent at the same time
+        :return: List of (usage_id, patch, error) tuples with the failed patches
+        """
+        session = get_http_session()
+
+        def patch_usage(usage_id, patch):
+            url = urljoin(self._usage_api, "api/usageManagement/v2/usage/" + str(usage_id))
+            r = session.patch(url, json=patch)
+            r.raise_for_status()
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(usage_id, patch, executor.submit(patch_usage, usage_id, patch)) for usage_id, patch in patches]
+
+        for usage_id, patch, future in futures:
+            if future.exception() is not None:
+                failed.append((usage_id, patch, str(future.exception())))
+
+        return failed
+
+
+class AsyncUsageClient(AsyncClient):
+    """
+    Coroutine version of UsageClient, to make independent requests concurrently
+    """
+
+    client_class = UsageClient
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from logging import getLogger
+
+from django.conf import settings
+from pymongo import DeleteOne, UpdateOne
+
+from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.store_commons.database import get_database_connection
+
+logger = getLogger("wstore.default_logger")
+
+
+class UsageRater:
+    """
+    Rates the usage documents of a usage charge in bulk. Ratings can be sent in
+    a background job, and the failed ones are saved to be retried later
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection().wstore_failed_ratings
+        self._workers = getattr(settings, "USAGE_RATING_WORKERS", 8)
+        self._executor = None
+
+        if getattr(settings, "USAGE_RATING_BACKGROUND", False):
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage-rating")
+
+    def _save_failed(self, failed):
+        now = datetime.utcnow()
+        self._collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": str(usage_id)},
+                    {
+                        "$set": {"patch": patch, "error": error, "failed_at": now},
+                        "$inc": {"attempts": 1},
+                    },
+                    upsert=True,
+                )
+                for usage_id, patch, error in failed
+            ],
+            ordered=False,
+        )
+
+    def send(self, patches):
+        """
+        Applies a set of patches to usage documents, saving the failed ones to be retried
+        :param patches: List of (usage_id, patch) tuples
+        :return: List of (usage_id, patch, error) tuples with the failed patches
+        """
+        failed = UsageClient().patch_usages(patches, workers=self._workers)
+
+        if len(failed):
+            logger.error(f"{len(failed)} of {len(patches)} usage updates failed, saved to be retried")
+            self._save_failed(failed)
+
+        return failed
+
+    def rate(self, ratings, timestamp, currency, product_id):
+        """
+        Rates a set of usage documents of the same product
+        :param ratings: List of (usage_id, duty_free, price, rate) tuples
+        :param timestamp: Timestamp when the used was rated
+        :param currency: currency of the amounts
+        :param product_id: Id of the product that generates the usage
+        :return: The list of failed ratings, or a future with it if rated in background
+        """
+        patches = UsageClient().get_rating_patches(ratings, timestamp, currency, product_id)
+
+        if self._executor is not None:
+            return self._executor.submit(self.send, patches)
+
+        return self.send(patches)
+
+    def get_failed(self):
+        return list(self._collection.find())
+
+    def retry_failed(self):
+        """
+        Sends again the saved failed ratings
+        :return: Tuple with the number of sent and failed ratings
+        """
+        docs = self.get_failed()
+        if not len(docs):
+            return 0, 0
+
+        failed = UsageClient().patch_usages([(doc["_id"], doc["patch"]) for doc in docs], workers=self._workers)
+        failed_ids = set(usage_id for usage_id, _, _ in failed)
+
+        sent = [DeleteOne({"_id": doc["_id"]}) for doc in docs if doc["_id"] not in failed_ids]
+        if len(sent):
+            self._collection.bulk_write(sent, ordered=False)
+
+        if len(failed):
+            self._save_failed(failed)
+
+        return len(sent), len(failed)
+
+
+_rater = None
+_rater_pid = None
+_rater_lock = threading.Lock()
+
+
+def get_usage_rater():
+    global _rater, _rater_pid
+
+    with _rater_lock:
+        if _rater is None or _rater_pid != os.getpid():
+            _rater = UsageRater()
+            _rater_pid = os.getpid()
+
+        return _rater
@@ -21,14 +21,21 @@
 
 import json
 
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 
 from wstore.asset_manager.resource_plugins.decorators import on_usage_refreshed
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
+from wstore.charging_engine.accounting.usage_rater import get_usage_rater
 from wstore.ordering.models import Order
 from wstore.store_commons.resource import Resource
-from wstore.store_commons.utils.http import build_response, supported_request_mime_types
+from wstore.store_commons.utils.http import (
+    JsonResponse,
+    build_response,
+    get_content_type,
+    supported_request_mime_types,
+)
 
 
 class ServiceRecordCollection(Resource):
@@ -73,6 +80,49 @@ class ServiceRecordCollection(Resource):
         return response
 
 
+class ServiceRecordBatchCollection(Resource):
+    def _parse_sdrs(self, request):
+        if get_content_type(request)[0] == "application/x-ndjson":
+            return [json.loads(line) for line in request.body.decode("utf-8").splitlines() if line.strip()]
+
+        return json.loads(request.body)
+
+    # This method is used to load a batch of SDR documents, validating
+    # them in order and returning the result of each one
+    @supported_request_mime_types(("application/json", "application/x-ndjson"))
+    def create(self, request):
+        try:
+            sdrs = self._parse_sdrs(request)
+        except:
+            return build_response(request, 400, "The request does not contain a valid JSON array or NDJSON stream")
+
+        if not isinstance(sdrs, list) or not all(isinstance(sdr, dict) for sdr in sdrs):
+            return build_response(request, 400, "The request must contain a list of SDR documents")
+
+        max_size = getattr(settings, "SDR_BATCH_MAX_SIZE", 1000)
+        if len(sdrs) > max_size:
+            return build_response(request, 413, "A batch cannot contain more than {} SDRs".format(max_size))
+
+        sdr_manager = SDRManager()
+        results = sdr_manager.validate_sdrs(sdrs)
+        sdr_manager.update_usages()
+
+        # Valid usage documents are changed to Guided and invalid ones to Rejected. Failed
+        # updates are saved to be retried, so they do not fail the whole batch
+        get_usage_rater().send(
+            [
+                (sdr["id"], {"status": "Guided" if code == 200 else "Rejected"})
+                for sdr, (code, _) in zip(sdrs, results)
+                if "id" in sdr
+            ]
+        )
+
+        return JsonResponse(
+            200,
+            [{"id": sdr.get("id"), "status": code, "message": msg} for sdr, (code, msg) in zip(sdrs, results)],
+        )
+
+
 class SDRRefreshCollection(Resource):
     @supported_request_mime_types(("application/json",))
     def create(self, request):
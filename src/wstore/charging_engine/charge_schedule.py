@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime, timedelta
+from logging import getLogger
+
+from pymongo import ASCENDING, DeleteOne, UpdateOne
+
+from wstore.store_commons.database import get_database_connection
+
+logger = getLogger("wstore.default_logger")
+
+SCHEDULE_COLLECTION = "wstore_charge_schedule"
+
+# Document saved once the schedule has been built from the existing orders
+BUILT_MARKER = "_built"
+
+# Usage payments are renovated every 30 days
+USAGE_PERIOD = 30
+
+
+class ChargeSchedule:
+    """
+    Denormalized schedule with the date of the next action (subscription renovation or
+    usage cycle end) of every active contract, indexed so the pending charges daemon only
+    needs to load the contracts that are due
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[SCHEDULE_COLLECTION]
+
+    @staticmethod
+    def get_next_action(order, contract):
+        """
+        Calculates the date when the customer of a contract must be charged again
+        :return: datetime, or None if the contract does not have pending charges
+        """
+        if contract.terminated:
+            return None
+
+        dates = []
+        if "pay_per_use" in contract.pricing_model:
+            # Search last usage charge
+            last_charge = None
+            for charge in reversed(contract.charges or []):
+                if charge.concept == "usage":
+                    last_charge = charge.date
+                    break
+
+            # No use charge has been applied yet
+            if last_charge is None:
+                last_charge = order.date
+
+            dates.append(last_charge + timedelta(days=USAGE_PERIOD))
+
+        if "subscription" in contract.pricing_model:
+            dates.extend(
+                item["renovation_date"]
+                for item in contract.pricing_model["subscription"]
+                if item.get("renovation_date") is not None
+            )
+
+        return min(dates) if len(dates) else None
+
+    def _get_entry_id(self, order_pk, item_id):
+        return "{}:{}".format(order_pk, item_id)
+
+    def update_order(self, order):
+        """
+        Updates the schedule entries of all the contracts of an order
+        """
+        operations = []
+        for contract in order.get_contracts():
+            entry_id = self._get_entry_id(order.pk, contract.item_id)
+            due = self.get_next_action(order, contract)
+
+            if due is None:
+                operations.append(DeleteOne({"_id": entry_id}))
+            else:
+                operations.append(
+                    UpdateOne(
+                        {"_id": entry_id},
+                        {"$set": {"order": order.pk, "item_id": contract.item_id, "due": due}},
+                        upsert=True,
+                    )
+                )
+
+        if len(operations):
+            self._collection.bulk_write(operations, ordered=False)
+
+    def remove_contract(self, order_pk, item_id):
+        self._collection.delete_one({"_id": self._get_entry_id(order_pk, item_id)})
+
+    def get_due(self, limit):
+        """
+        Returns the contracts whose next action is before the given date
+        :param limit: datetime
+        :return: dict with the ids of the due contracts by order pk
+        """
+        due = {}
+        for entry in self._collection.find({"due": {"$lt": limit}}, projection={"order": True, "item_id": True}):
+            due.setdefault(entry["order"], set()).add(entry["item_id"])
+
+        return due
+
+    def is_built(self):
+        return self._collection.find_one({"_id": BUILT_MARKER}) is not None
+
+    def build(self, orders):
+        """
+        Creates the schedule entries of the given orders, used to initialize the schedule
+        """
+        self._collection.create_index([("due", ASCENDING)])
+
+        for order in orders:
+            self.update_order(order)
+
+        self._collection.update_one({"_id": BUILT_MARKER}, {"$set": {"date": datetime.utcnow()}}, upsert=True)
+        logger.info("Charge schedule built")
@@ -23,7 +23,10 @@ from decimal import Decimal
 from urllib.parse import urljoin, urlparse
 
 from django.conf import settings
-from requests import Request, Session
+from requests import Request
+
+from wstore.store_commons.async_client import AsyncClient
+from wstore.store_commons.http_session import get_http_session
 
 
 class BillingClient:
@@ -72,7 +75,7 @@ class BillingClient:
         url = self._billing_api + "api/billingManagement/v2/appliedCustomerBillingCharge"
         req = Request("POST", url, json=charge)
 
-        session = Session()
+        session = get_http_session()
         prepped = session.prepare_request(req)
 
         # Override host header to avoid inconsistent hrefs in the API
@@ -80,3 +83,11 @@ class BillingClient:
 
         resp = session.send(prepped)
         resp.raise_for_status()
+
+
+class AsyncBillingClient(AsyncClient):
+    """
+    Coroutine version of BillingClient, to make independent requests concurrently
+    """
+
+    client_class = BillingClient
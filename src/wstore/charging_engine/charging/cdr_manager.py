@@ -25,15 +25,16 @@ from bson import ObjectId
 from django.conf import settings
 
 from wstore.ordering.models import Offering
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptorThread
-from wstore.store_commons.database import get_database_connection
+from wstore.rss_adaptor.cdr_outbox import enqueue_cdrs
+from wstore.rss_adaptor.correlation import reserve_correlation_numbers
+from wstore.store_commons.utils.identity_map import get_object
 
 
 class CDRManager(object):
     _order = None
 
     def __init__(self, order, contract):
-        self._offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        self._offering = get_object(Offering, ObjectId(contract.offering))
         self._init_cdr_info(order, contract)
 
     def _init_cdr_info(self, order, contract):
@@ -56,18 +57,7 @@ class CDRManager(object):
             "order": order.order_id + " " + contract.item_id,
         }
 
-    def _generate_cdr_part(self, part, event, description):
-        # Create connection for raw database access
-        db = get_database_connection()
-
-        # Take and increment the correlation number using
-        # the mongoDB atomic access in order to avoid race
-        # problems
-        corr_number = db.wstore_organization.find_and_modify(
-            query={"_id": self._offering.owner_organization.pk},
-            update={"$inc": {"correlation_number": 1}},
-        )["correlation_number"]
-
+    def _generate_cdr_part(self, part, event, description, corr_number):
         cdr_part = {
             "correlation": str(corr_number),
             "cost_value": str(part["value"]),
@@ -79,8 +69,18 @@ class CDRManager(object):
         cdr_part.update(self._cdr_info)
         return cdr_part
 
+    def _generate_cdrs(self, parts):
+        # Reserve the correlation numbers of all the CDRs with a single
+        # atomic access to the provider document
+        corr_numbers = reserve_correlation_numbers(self._offering.owner_organization.pk, len(parts))
+
+        return [
+            self._generate_cdr_part(part, event, description, corr_number)
+            for (part, event, description), corr_number in zip(parts, corr_numbers)
+        ]
+
     def generate_cdr(self, applied_parts, time_stamp):
-        cdrs = []
+        parts = []
 
         self._cdr_info["time_stamp"] = time_stamp
         self._cdr_info["type"] = "C"
@@ -90,7 +90,7 @@ class CDRManager(object):
             # A cdr is generated for every price part
             for part in applied_parts["single_payment"]:
                 description = "One time payment: " + str(part["value"]) + " " + self._cdr_info["cost_currency"]
-                cdrs.append(self._generate_cdr_part(part, "One time payment event", description))
+                parts.append((part, "One time payment event", description))
 
         if "subscription" in applied_parts:
             # A cdr is generated by price part
@@ -104,7 +104,7 @@ class CDRManager(object):
                     + part["unit"]
                 )
 
-                cdrs.append(self._generate_cdr_part(part, "Recurring payment event", description))
+                parts.append((part, "Recurring payment event", description))
 
         if "accounting" in applied_parts:
             # A cdr is generated by price part
@@ -120,11 +120,12 @@ class CDRManager(object):
                     use += int(sdr["value"])
                     description = "Fee per " + part["model"]["unit"] + ", Consumption: " + str(use)
 
-                cdrs.append(self._generate_cdr_part(use_part, "Pay per use event", description))
+                parts.append((use_part, "Pay per use event", description))
+
+        cdrs = self._generate_cdrs(parts)
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        enqueue_cdrs(cdrs)
 
     def refund_cdrs(self, price, duty_free, time_stamp):
         self._cdr_info["time_stamp"] = time_stamp
@@ -137,8 +138,7 @@ class CDRManager(object):
         }
 
         description = "Refund event: " + str(price) + " " + self._cdr_info["cost_currency"]
-        cdrs = [self._generate_cdr_part(aggregated_part, "Refund event", description)]
+        cdrs = self._generate_cdrs([(aggregated_part, "Refund event", description)])
 
-        # Send the created CDRs to the Revenue Sharing System
-        r = RSSAdaptorThread(cdrs)
-        r.start()
+        # Queue the created CDRs to be sent to the Revenue Sharing System
+        enqueue_cdrs(cdrs)
@@ -89,16 +89,9 @@ class CDRGenerationTestCase(TestCase):
 
     def setUp(self):
         # Create Mocks
-        cdr_manager.RSSAdaptorThread = MagicMock()
+        cdr_manager.enqueue_cdrs = MagicMock()
 
-        self._conn = MagicMock()
-        cdr_manager.get_database_connection = MagicMock()
-        cdr_manager.get_database_connection.return_value = self._conn
-
-        self._conn.wstore_organization.find_and_modify.side_effect = [
-            {"correlation_number": 1},
-            {"correlation_number": 2},
-        ]
+        cdr_manager.reserve_correlation_numbers = MagicMock(return_value=range(1, 2))
 
         self._order = MagicMock()
         self._order.order_id = "1"
@@ -191,16 +184,31 @@ class CDRGenerationTestCase(TestCase):
         cdr_m.generate_cdr(applied_parts, "2015-10-21 06:13:26.661650")
 
         # Validate calls
-        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
-            query={"_id": "61004aba5e05acc115f022f0"},
-            update={"$inc": {"correlation_number": 1}},
-        )
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with("61004aba5e05acc115f022f0", 1)
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdrs)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdrs)
 
         cdr_manager.Offering.objects.get.assert_called_once_with(pk=ObjectId("61004aba5e05acc115f022f0"))
 
+    def test_cdr_generation_block(self):
+        cdr_manager.reserve_correlation_numbers.return_value = range(7, 9)
+        part = {
+            "value": Decimal("12"),
+            "unit": "one time",
+            "tax_rate": Decimal("20"),
+            "duty_free": Decimal("10"),
+        }
+
+        cdr_m = cdr_manager.CDRManager(self._order, self._contract)
+        cdr_m.generate_cdr({"single_payment": [part], "subscription": [part]}, "2015-10-21 06:13:26.661650")
+
+        # A single block is reserved for all the CDRs
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with("61004aba5e05acc115f022f0", 2)
+
+        cdrs = cdr_manager.enqueue_cdrs.call_args[0][0]
+        self.assertEquals(["7", "8"], [cdr["correlation"] for cdr in cdrs])
+        self.assertEquals(["One time payment event", "Recurring payment event"], [cdr["event"] for cdr in cdrs])
+
     def test_refund_cdr_generation(self):
         exp_cdr = [
             {
@@ -224,13 +232,9 @@ class CDRGenerationTestCase(TestCase):
         cdr_m.refund_cdrs(Decimal("10"), Decimal("8"), "2015-10-21 06:13:26.661650")
 
         # Validate calls
-        self._conn.wstore_organization.find_and_modify.assert_called_once_with(
-            query={"_id": "61004aba5e05acc115f022f0"},
-            update={"$inc": {"correlation_number": 1}},
-        )
+        cdr_manager.reserve_correlation_numbers.assert_called_once_with("61004aba5e05acc115f022f0", 1)
 
-        cdr_manager.RSSAdaptorThread.assert_called_once_with(exp_cdr)
-        cdr_manager.RSSAdaptorThread().start.assert_called_once_with()
+        cdr_manager.enqueue_cdrs.assert_called_once_with(exp_cdr)
 
 
 TIMESTAMP = datetime(2016, 6, 21, 10, 0, 0)
@@ -303,9 +307,8 @@ class BillingClientTestCase(TestCase):
         billing_client.settings.SITE = site
 
         billing_client.Request = MagicMock()
-        billing_client.Session = MagicMock()
         session = MagicMock()
-        billing_client.Session.return_value = session
+        billing_client.get_http_session = MagicMock(return_value=session)
 
         preped = MagicMock()
         preped.headers = {}
@@ -322,7 +325,7 @@ class BillingClientTestCase(TestCase):
             json=exp_body,
         )
 
-        billing_client.Session.assert_called_once_with()
+        billing_client.get_http_session.assert_called_once_with()
         session.prepare_request.assert_called_once_with(billing_client.Request())
 
         self.assertEquals("extpath.com:8080", preped.headers["Host"])
@@ -31,14 +31,19 @@ from django.conf import settings
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.charging_engine.accounting.sdr_manager import SDRManager
 from wstore.charging_engine.accounting.usage_client import UsageClient
-from wstore.charging_engine.charging.billing_client import BillingClient
+from wstore.charging_engine.accounting.usage_rater import get_usage_rater
+from wstore.charging_engine.charge_schedule import ChargeSchedule
+from wstore.charging_engine.charging.billing_client import AsyncBillingClient, BillingClient
 from wstore.charging_engine.charging.cdr_manager import CDRManager
-from wstore.charging_engine.invoice_builder import InvoiceBuilder
+from wstore.charging_engine.invoice_builder import InvoiceBuilder, get_invoice_pipeline
 from wstore.charging_engine.price_resolver import PriceResolver
+from wstore.ordering.entitlements import EntitlementIndex
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Charge, Offering, Order, Payment
 from wstore.ordering.ordering_client import OrderingClient
+from wstore.store_commons.async_client import run_concurrently
 from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.utils.identity_map import get_object
 from wstore.store_commons.utils.units import ChargePeriod
 
 logger = getLogger("wstore.default_logger")
@@ -48,6 +53,7 @@ class ChargingEngine:
     def __init__(self, order):
         self._order = order
         self._price_resolver = PriceResolver()
+        self._offerings = {}
         self.charging_processors = {
             "initial": self._process_initial_charge,
             "recurring": self._process_renovation_charge,
@@ -149,6 +155,8 @@ class ChargingEngine:
         self._order.owner_organization.acquired_offerings.append(contract.offering)
         self._order.owner_organization.save()
 
+        EntitlementIndex().grant(self._order, contract)
+
         return None, valid_to
 
     def _end_renovation_charge(self, contract, transaction):
@@ -174,21 +182,16 @@ class ChargingEngine:
 
     def _end_use_charge(self, contract, transaction):
         # Change applied usage documents SDR Guided to Rated
-        usage_client = UsageClient()
-
         logger.debug("Finishing USE charge process")
 
-        for sdr_info in transaction["applied_accounting"]:
-            for sdr in sdr_info["accounting"]:
-                usage_client.rate_usage(
-                    sdr["usage_id"],
-                    str(contract.last_charge),
-                    sdr["duty_free"],
-                    sdr["price"],
-                    sdr_info["model"]["tax_rate"],
-                    transaction["currency"],
-                    contract.product_id,
-                )
+        ratings = [
+            (sdr["usage_id"], sdr["duty_free"], sdr["price"], sdr_info["model"]["tax_rate"])
+            for sdr_info in transaction["applied_accounting"]
+            for sdr in sdr_info["accounting"]
+        ]
+
+        # Failed ratings are saved to be retried, so they do not abort the charge
+        get_usage_rater().rate(ratings, str(contract.last_charge), transaction["currency"], contract.product_id)
 
         transaction["related_model"]["accounting"] = transaction["applied_accounting"]
 
@@ -214,6 +217,45 @@ class ChargingEngine:
         except:
             pass
 
+    def _finish_invoices(self, invoices, concept, transactions):
+        # The reserved invoices that could not be rendered have been removed, so their
+        # charges no longer point to them and the notifications are sent without them
+        db = get_database_connection()
+        for charge, job in invoices:
+            if job.exception() is None:
+                continue
+
+            invoice_path = charge.invoice
+            charge.invoice = ""
+            try:
+                db.wstore_order.update_one(
+                    {"_id": self._order.pk},
+                    {"$set": {"contracts.$[].charges.$[charge].invoice": ""}},
+                    array_filters=[{"charge.invoice": invoice_path}],
+                )
+            except Exception as e:
+                logger.error(f"Error removing invoice {invoice_path} from order {self._order.order_id}: {e}")
+
+        self._send_notification(concept, transactions)
+
+    def _create_billing_charges(self, charges):
+        if not len(charges):
+            return
+
+        # Charges are independent, so all of them are sent to the billing API at the same time
+        billing_client = AsyncBillingClient(BillingClient())
+        results = run_concurrently(
+            *[
+                billing_client.create_charge(charge, product_id, start_date=valid_from, end_date=valid_to)
+                for charge, product_id, valid_from, valid_to in charges
+            ],
+            return_exceptions=True,
+        )
+
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
     def end_charging(self, transactions, free_contracts, concept):
         """
         Process the second step of a payment once the customer has approved the charge
@@ -232,9 +274,10 @@ class ChargingEngine:
         self._order.pending_payment = None
 
         invoice_builder = InvoiceBuilder(self._order)
-        billing_client = BillingClient() if concept != "initial" else None
+        billing_charges = []
 
         updated_contracts = {}
+        invoices = []
         for transaction in transactions:
             logger.debug(f"Updating contract for {transaction['item']}")
             contract = self._order.get_item_contract(transaction["item"])
@@ -246,10 +289,11 @@ class ChargingEngine:
             cdr_manager = CDRManager(self._order, contract)
             cdr_manager.generate_cdr(transaction["related_model"], time_stamp.isoformat() + "Z")
 
-            # Generate the invoice
+            # Generate the invoice, it is rendered in background
             invoice_path = ""
+            invoice_job = None
             try:
-                invoice_path = invoice_builder.generate_invoice(contract, transaction, concept)
+                invoice_path, invoice_job = invoice_builder.enqueue_invoice(contract, transaction, concept)
             except:
                 pass
 
@@ -268,19 +312,20 @@ class ChargingEngine:
             contract.charges.append(charge)
             updated_contracts[transaction["item"]] = contract
 
+            if invoice_job is not None:
+                invoices.append((charge, invoice_job))
+
             # Send the charge to the billing API to allow user accesses
             if concept != "initial":
                 # When the change concept is initial, the product has not been yet created in the inventory
-                billing_client.create_charge(
-                    charge,
-                    contract.product_id,
-                    start_date=valid_from,
-                    end_date=valid_to,
-                )
+                billing_charges.append((charge, contract.product_id, valid_from, valid_to))
+
+        self._create_billing_charges(billing_charges)
 
         for free in free_contracts:
             logger.debug(f"Setting {free.offering} as acquired")
             self._order.owner_organization.acquired_offerings.append(free.offering)
+            EntitlementIndex().grant(self._order, free)
 
         # Update order contracts
         new_contracts = []
@@ -295,7 +340,13 @@ class ChargingEngine:
         self._order.owner_organization.save()
         self._order.save()
 
-        self._send_notification(concept, transactions)
+        # Update the dates of the next charges of the order contracts
+        ChargeSchedule().update_order(self._order)
+
+        # Notifications include the invoices, so they are sent once these have been rendered
+        get_invoice_pipeline().when_done(
+            [job for _, job in invoices], self._finish_invoices, invoices, concept, transactions
+        )
         logger.info("Finished charging process OK")
 
     def _save_pending_charge(self, transactions, free_contracts=[]):
@@ -309,29 +360,46 @@ class ChargingEngine:
         self._order.save()
         logger.debug(f"Saved pending charge for order: {self._order.order_id}")
 
-    def _append_transaction(self, transactions, contract, related_model, accounting=None):
-        # Call the price resolver
-        price, duty_free = self._price_resolver.resolve_price(related_model, accounting)
-
-        if "alteration" in related_model and not self._price_resolver.is_altered():
-            del related_model["alteration"]
-
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
-        transaction = {
-            "price": price,
-            "duty_free": duty_free,
-            "description": offering.description,
-            "currency": contract.pricing_model["general_currency"],
-            "related_model": related_model,
-            "item": contract.item_id,
-        }
+    def _get_offering(self, offering_pk):
+        # Contracts of the same offering only load it once per charge
+        if offering_pk not in self._offerings:
+            self._offerings[offering_pk] = get_object(Offering, ObjectId(offering_pk))
 
-        # Get the applied accounting info is needed
-        if accounting is not None:
-            transaction["applied_accounting"] = self._price_resolver.get_applied_sdr()
+        return self._offerings[offering_pk]
 
-        logger.debug(f"Transaction for item {transaction['item']} appended")
-        transactions.append(transaction)
+    def _resolve_transactions(self, charges):
+        """
+        Builds the transactions of the given charges, whose prices are resolved in a single batch
+        :param charges: List of (contract, related_model, accounting) tuples
+        :return: List with the transactions of the charges
+        """
+        results = self._price_resolver.resolve_prices(
+            [(related_model, accounting) for _, related_model, accounting in charges]
+        )
+
+        transactions = []
+        for (contract, related_model, accounting), result in zip(charges, results):
+            if "alteration" in related_model and not result["altered"]:
+                del related_model["alteration"]
+
+            offering = self._get_offering(contract.offering)
+            transaction = {
+                "price": result["price"],
+                "duty_free": result["duty_free"],
+                "description": offering.description,
+                "currency": contract.pricing_model["general_currency"],
+                "related_model": related_model,
+                "item": contract.item_id,
+            }
+
+            # Get the applied accounting info is needed
+            if accounting is not None:
+                transaction["applied_accounting"] = result["applied_sdrs"]
+
+            logger.debug(f"Transaction for item {transaction['item']} appended")
+            transactions.append(transaction)
+
+        return transactions
 
     def _process_initial_charge(self, contracts):
         """
@@ -339,7 +407,7 @@ class ChargingEngine:
         :return: The URL where redirecting the customer to approve the charge
         """
 
-        transactions = []
+        charges = []
         free_contracts = []
         redirect_url = None
 
@@ -359,10 +427,11 @@ class ChargingEngine:
                 related_model["alteration"] = contract.pricing_model["alteration"]
 
             if len(related_model):
-                self._append_transaction(transactions, contract, related_model)
+                charges.append((contract, related_model, None))
             else:
                 free_contracts.append(contract)
 
+        transactions = self._resolve_transactions(charges)
         if len(transactions):
             # Make the charge
             redirect_url = self._charge_client(transactions)
@@ -401,7 +470,7 @@ class ChargingEngine:
         logger.info(f"Resolving renovation charges for order {self._order.order_id}")
 
         now = datetime.utcnow()
-        transactions = []
+        charges = []
         for contract in contracts:
             logger.debug(f"Appending transactions for contract {contract.item_id}")
             # Check if the contract has any recurring model
@@ -431,14 +500,17 @@ class ChargingEngine:
 
             # Calculate the price to be charged if required
             if len(related_model["subscription"]):
-                self._append_transaction(transactions, contract, related_model)
+                charges.append((contract, related_model, None))
 
-        return self._execute_renovation_transactions(transactions, "There is not recurring payments to renovate")
+        return self._execute_renovation_transactions(
+            self._resolve_transactions(charges), "There is not recurring payments to renovate"
+        )
 
     def _parse_raw_accounting(self, usage):
         sdr_manager = SDRManager()
         sdrs = []
 
+        # The usage is retrieved page by page while it is parsed
         for usage_document in usage:
             sdr_values = sdr_manager.get_sdr_values(usage_document)
             sdr_values.update({"usage_id": usage_document["id"]})
@@ -454,7 +526,7 @@ class ChargingEngine:
         self._order.state = "pending"
         logger.info(f"Resolving usage charges for order {self._order.order_id}")
 
-        transactions = []
+        charges = []
         usage_client = UsageClient()
         for contract in contracts:
             logger.debug(f"Appending transactions for contract {contract.item_id}")
@@ -478,9 +550,11 @@ class ChargingEngine:
                 related_model["alteration"] = contract.pricing_model["alteration"]
 
             if len(accounting) > 0:
-                self._append_transaction(transactions, contract, related_model, accounting=accounting)
+                charges.append((contract, related_model, accounting))
 
-        return self._execute_renovation_transactions(transactions, "There is not usage payments to renovate")
+        return self._execute_renovation_transactions(
+            self._resolve_transactions(charges), "There is not usage payments to renovate"
+        )
 
     def resolve_charging(self, type_="initial", related_contracts=None):
         """
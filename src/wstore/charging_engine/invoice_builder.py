@@ -22,6 +22,9 @@
 import codecs
 import os
 import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from decimal import Decimal
@@ -32,9 +35,76 @@ from django.conf import settings
 from django.template import Context, loader
 
 from wstore.ordering.models import Offering
+from wstore.store_commons.utils.identity_map import get_object
 
 logger = getLogger("wstore.default_logger")
 
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_bill_template(name):
+    """
+    Returns a bill template, templates are loaded and compiled only once per process
+    """
+    with _templates_lock:
+        if name not in _templates:
+            _templates[name] = loader.get_template(name)
+
+        return _templates[name]
+
+
+class InvoicePipeline:
+    """
+    Bounded pool of workers where invoices are rendered to PDF
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "INVOICE_WORKERS", 2), thread_name_prefix="invoice-worker"
+        )
+
+    def submit(self, fn, *args):
+        return self._executor.submit(fn, *args)
+
+    def when_done(self, futures, callback, *args):
+        """
+        Calls the given callback once all the given jobs have finished, whatever their result
+        """
+        if not len(futures):
+            callback(*args)
+            return
+
+        lock = threading.Lock()
+        pending = [len(futures)]
+
+        def job_done(future):
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+
+            if finished:
+                callback(*args)
+
+        for future in futures:
+            future.add_done_callback(job_done)
+
+
+_pipeline = None
+_pipeline_pid = None
+_pipeline_lock = threading.Lock()
+
+
+def get_invoice_pipeline():
+    global _pipeline, _pipeline_pid
+
+    with _pipeline_lock:
+        if _pipeline is None or _pipeline_pid != os.getpid():
+            _pipeline = InvoicePipeline()
+            _pipeline_pid = os.getpid()
+
+        return _pipeline
+
 
 class InvoiceBuilder(object):
     def __init__(self, order):
@@ -88,7 +158,7 @@ class InvoiceBuilder(object):
         self._process_alteration_parts(applied_parts, parts)
 
         # Get the bill template
-        bill_template = loader.get_template("contracting/bill_template_initial.html")
+        bill_template = get_bill_template("contracting/bill_template_initial.html")
         return parts, bill_template
 
     def _process_usage_component(self, applied_parts, parts, comp_name, part_name, part_sub):
@@ -123,7 +193,7 @@ class InvoiceBuilder(object):
         self._process_alteration_parts(applied_parts, parts)
 
         # Get the bill template
-        bill_template = loader.get_template("contracting/bill_template_renovation.html")
+        bill_template = get_bill_template("contracting/bill_template_renovation.html")
         return parts, bill_template
 
     def _get_use_parts(self, transaction):
@@ -135,7 +205,7 @@ class InvoiceBuilder(object):
         self._process_alteration_parts(applied_parts, parts)
 
         # Get the bill template
-        bill_template = loader.get_template("contracting/bill_template_use.html")
+        bill_template = get_bill_template("contracting/bill_template_use.html")
         return parts, bill_template
 
     def _fill_alts_context(self, context, parts):
@@ -197,20 +267,26 @@ class InvoiceBuilder(object):
         else:
             context["deduction"] = False
 
-    def _avoid_existing_name(self, name, ix):
-        new_name = name + "_" + str(ix) + ".pdf"
-        path = os.path.join(settings.BILL_ROOT, new_name)
-
-        if os.path.exists(path):
-            path, new_name = self._avoid_existing_name(name, ix + 1)
-
-        return path, new_name
-
-    def generate_invoice(self, contract, transaction, type_):
+    def _reserve_invoice_name(self, invoice_id):
+        # The PDF file is created to reserve its name, as several invoices
+        # with the same id can be rendered at the same time
+        ix = 0
+        while True:
+            name = invoice_id + "_" + str(ix) + ".pdf"
+            path = os.path.join(settings.BILL_ROOT, name)
+
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path, name
+            except FileExistsError:
+                ix += 1
+
+    def prepare_invoice(self, contract, transaction, type_):
         """
-        Create a PDF invoice based on the price components used to charge the user
+        Builds the rendering job of a PDF invoice based on the price components used to charge the user
         :param transaction: Total amount charged to the customer
         :param type_: Type of the charge, initial, renovation, pay-per-use
+        :return: Rendering job and the URL where the invoice will be available
         """
         logger.info(f"Generating invoice for transaction {transaction}")
 
@@ -231,7 +307,7 @@ class InvoiceBuilder(object):
         tax_value = Decimal(transaction["price"]) - Decimal(transaction["duty_free"])
 
         # Load pricing info into the context
-        offering = Offering.objects.get(pk=ObjectId(contract.offering))
+        offering = get_object(Offering, ObjectId(contract.offering))
         context = {
             "basedir": settings.BASEDIR,
             "offering_name": offering.name,
@@ -257,27 +333,66 @@ class InvoiceBuilder(object):
         logger.debug("Processing context for invoice")
         self._context_processors[type_](context, parts)
 
-        # Render the invoice template
-        bill_code = bill_template.render(Context(context))
-
-        # Create the bill code file
         invoice_id = str(self._order.pk) + "_" + contract.item_id + "_" + date
-        raw_invoice_path = os.path.join(settings.BILL_ROOT, invoice_id + ".html")
+        invoice_path, invoice_name = self._reserve_invoice_name(invoice_id)
+
+        job = {
+            "invoice_id": invoice_id,
+            "template": bill_template,
+            "context": context,
+            "path": invoice_path,
+        }
+        return job, os.path.join(settings.MEDIA_URL, "bills/" + invoice_name)
+
+    @staticmethod
+    def render_invoice(job):
+        """
+        Renders the PDF file of an invoice job
+        """
+        try:
+            # Render the invoice template
+            bill_code = job["template"].render(Context(job["context"]))
+
+            # The bill code file is created in a directory owned by the job, so
+            # it is removed with it
+            with tempfile.TemporaryDirectory(prefix="invoice_") as tmp_dir:
+                raw_invoice_path = os.path.join(tmp_dir, job["invoice_id"] + ".html")
+
+                f = codecs.open(raw_invoice_path, "wb", "utf-8")
+                f.write(bill_code)
+                f.close()
+
+                # Compile the bill file
+                if subprocess.call([settings.BASEDIR + "/create_invoice.sh", raw_invoice_path, job["path"]]) != 0:
+                    raise Exception("The PDF file could not be compiled")
+
+        except Exception as e:
+            logger.error(f"Error rendering invoice {job['invoice_id']}: {e}")
 
-        f = codecs.open(raw_invoice_path, "wb", "utf-8")
-        f.write(bill_code)
-        f.close()
+            # Release the reserved name, so no empty invoice is left
+            try:
+                os.remove(job["path"])
+            except OSError:
+                pass
 
-        invoice_path, invoice_name = self._avoid_existing_name(invoice_id, 0)
+            raise
 
-        # Compile the bill file
-        subprocess.call([settings.BASEDIR + "/create_invoice.sh", raw_invoice_path, invoice_path])
+        logger.info(f"Invoice {job['invoice_id']} created at {job['path']}")
 
-        # Remove temporal files
-        for file_ in os.listdir(settings.BILL_ROOT):
-            if not file_.endswith(".pdf"):
-                os.remove(os.path.join(settings.BILL_ROOT, file_))
+    def generate_invoice(self, contract, transaction, type_):
+        """
+        Creates a PDF invoice, waiting until it has been rendered
+        :return: URL of the invoice
+        """
+        job, invoice_url = self.prepare_invoice(contract, transaction, type_)
+        self.render_invoice(job)
 
-        logger.info(f"Invoice {invoice_id} created at {invoice_path}")
+        return invoice_url
 
-        return os.path.join(settings.MEDIA_URL, "bills/" + invoice_name)
+    def enqueue_invoice(self, contract, transaction, type_):
+        """
+        Creates a PDF invoice, which is rendered in background by the invoice pipeline
+        :return: URL where the invoice will be available and the Future of the rendering job
+        """
+        job, invoice_url = self.prepare_invoice(contract, transaction, type_)
+        return invoice_url, get_invoice_pipeline().submit(self.render_invoice, job)
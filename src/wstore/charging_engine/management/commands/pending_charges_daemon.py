@@ -19,14 +19,71 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
+from wstore.charging_engine.charge_schedule import ChargeSchedule
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.ordering.models import Order
+from wstore.store_commons.utils.identity_map import identity_scope
+
+
+class SweepStats:
+    """
+    Thread safe accumulator of the time spent and the failures of every stage of a sweep
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self.failures = []
+
+    @contextmanager
+    def stage(self, name, order, contract):
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+
+            with self._lock:
+                stage = self._stages.setdefault(name, {"count": 0, "time": 0.0, "failures": 0})
+                stage["count"] += 1
+                stage["time"] += elapsed
+
+                if error is not None:
+                    stage["failures"] += 1
+                    self.failures.append((name, order.order_id, contract.product_id, str(error)))
+
+    def report(self):
+        lines = []
+        for name, stage in self._stages.items():
+            lines.append(
+                "{}: {} calls, {:.2f}s total, {:.3f}s avg, {} failed".format(
+                    name,
+                    stage["count"],
+                    stage["time"],
+                    stage["time"] / stage["count"],
+                    stage["failures"],
+                )
+            )
+
+        for name, order_id, product_id, error in self.failures:
+            lines.append("Failed {} of order {} product {}: {}".format(name, order_id, product_id, error))
+
+        return lines
 
 
 class Command(BaseCommand):
@@ -40,18 +97,22 @@ class Command(BaseCommand):
 
             if timed.days < 0:
                 # Suspend the access to the service
-                on_product_suspended(order, contract)
+                with self._stats.stage("plugins", order, contract):
+                    on_product_suspended(order, contract)
 
                 # Notify that the subscription has finished
-                handler.send_payment_required_notification(order, contract)
+                with self._stats.stage("notifications", order, contract):
+                    handler.send_payment_required_notification(order, contract)
 
                 # Set the product as suspended
-                client = InventoryClient()
-                client.suspend_product(contract.product_id)
+                with self._stats.stage("inventory", order, contract):
+                    client = InventoryClient()
+                    client.suspend_product(contract.product_id)
 
             else:
                 # There is less than a week remaining
-                handler.send_near_expiration_notification(order, contract, timed.days)
+                with self._stats.stage("notifications", order, contract):
+                    handler.send_near_expiration_notification(order, contract, timed.days)
 
     def _process_subscription_item(self, order, contract, item):
         try:
@@ -77,6 +138,50 @@ class Command(BaseCommand):
         except:
             pass
 
+    def _process_contract(self, order, contract):
+        # The objects loaded while processing a contract are shared by its notifications
+        with identity_scope():
+            if "pay_per_use" in contract.pricing_model:
+                self._process_usage_item(order, contract)
+
+            if "subscription" in contract.pricing_model:
+                # Validate renovation date
+                for item in contract.pricing_model["subscription"]:
+                    self._process_subscription_item(order, contract, item)
+
+    def _parse_partition(self, partition):
+        try:
+            index, total = [int(value) for value in partition.split("/")]
+        except ValueError:
+            raise CommandError("Invalid partition, it must have the format i/k")
+
+        if total < 1 or index < 0 or index >= total:
+            raise CommandError("Invalid partition, i must be between 0 and k - 1")
+
+        return index, total
+
+    def _in_partition(self, order_pk, index, total):
+        # crc32 is used as the builtin hash of strings is not stable between processes
+        return zlib.crc32(str(order_pk).encode("utf-8")) % total == index
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild-schedule",
+            action="store_true",
+            help="Rebuild the charge schedule from all the existing orders",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of contracts processed concurrently",
+        )
+        parser.add_argument(
+            "--partition",
+            default=None,
+            help="Process only the partition i of k (i/k) of the orders, to split the sweep between nodes",
+        )
+
     def handle(self, *args, **options):
         """
         Periodic task in charge of checking recurring and usage payments dates
@@ -84,13 +189,49 @@ class Command(BaseCommand):
         :return:
         """
 
+        workers = options.get("workers") or 1
+        if workers < 1:
+            raise CommandError("The number of workers must be greater than 0")
+
+        partition = None
+        if options.get("partition"):
+            partition = self._parse_partition(options["partition"])
+
+        self._stats = SweepStats()
+        start = time.monotonic()
+
+        schedule = ChargeSchedule()
+        if options.get("rebuild_schedule") or not schedule.is_built():
+            schedule.build(Order.objects.all())
+
+        # Only the contracts whose next action is in less than a week need to be checked
+        due = schedule.get_due(datetime.utcnow() + timedelta(days=7))
+
+        order_pks = list(due.keys())
+        if partition is not None:
+            order_pks = [pk for pk in order_pks if self._in_partition(pk, *partition)]
+
         # Check contracts
-        for order in Order.objects.all():
+        due_contracts = []
+        for order in Order.objects.filter(pk__in=order_pks):
             for contract in order.get_contracts():
-                if "pay_per_use" in contract.pricing_model and not contract.terminated:
-                    self._process_usage_item(order, contract)
-
-                if "subscription" in contract.pricing_model and not contract.terminated:
-                    # Validate renovation date
-                    for item in contract.pricing_model["subscription"]:
-                        self._process_subscription_item(order, contract, item)
+                if contract.item_id not in due[order.pk]:
+                    continue
+
+                if contract.terminated:
+                    schedule.remove_contract(order.pk, contract.item_id)
+                    continue
+
+                due_contracts.append((order, contract))
+
+        if workers == 1:
+            for order, contract in due_contracts:
+                self._process_contract(order, contract)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for order, contract in due_contracts:
+                    executor.submit(self._process_contract, order, contract)
+
+        self.stdout.write("Checked {} due contracts in {:.2f}s".format(len(due_contracts), time.monotonic() - start))
+        for line in self._stats.report():
+            self.stdout.write(line)
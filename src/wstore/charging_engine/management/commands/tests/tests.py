@@ -20,9 +20,12 @@
 
 
 from datetime import datetime
+from io import StringIO
 
+from django.core.management.base import CommandError
 from django.test import TestCase
 from mock import MagicMock, call
+from parameterized import parameterized
 
 from wstore.charging_engine.management.commands import pending_charges_daemon
 
@@ -46,11 +49,17 @@ class ChargesDaemonTestCase(TestCase):
 
         pending_charges_daemon.on_product_suspended = MagicMock()
 
+        # Mock charge schedule
+        pending_charges_daemon.ChargeSchedule = MagicMock()
+        self._schedule = pending_charges_daemon.ChargeSchedule()
+        self._schedule.is_built.return_value = True
+
     def _build_contract(self, pricing, id_):
         contract = MagicMock()
         contract.terminated = False
         contract.pricing_model = pricing
         contract.product_id = id_
+        contract.item_id = id_
         return contract
 
     def _build_subscription_contract(self, date, id_):
@@ -69,20 +78,27 @@ class ChargesDaemonTestCase(TestCase):
         contract.charges = [charge1, charge2, charge1]
         return contract
 
-    def _test_charging_daemon(self, contracts):
+    def _test_charging_daemon(self, contracts, **options):
         # Not subscription
         contract1 = MagicMock()
         contract1.pricing_model = {"single_payment": []}
 
-        order = MagicMock()
+        order = MagicMock(pk="order")
         order.get_contracts.return_value = [contract1] + contracts
-        pending_charges_daemon.Order.objects.all.return_value = [order]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+
+        # The not due contract is not included in the schedule
+        self._schedule.get_due.return_value = {"order": {"2", "3"}}
 
         # Execute commands
-        command = pending_charges_daemon.Command()
-        command.handle()
+        command = pending_charges_daemon.Command(stdout=StringIO())
+        command.handle(**options)
 
         # Validate calls
+        self._schedule.build.assert_not_called()
+        self._schedule.get_due.assert_called_once_with(datetime(2016, 2, 15))
+        pending_charges_daemon.Order.objects.filter.assert_called_once_with(pk__in=["order"])
+
         self.assertEquals([call(), call()], pending_charges_daemon.NotificationsHandler.call_args_list)
 
         pending_charges_daemon.NotificationsHandler().send_payment_required_notification.assert_called_once_with(
@@ -120,3 +136,78 @@ class ChargesDaemonTestCase(TestCase):
         contract3 = self._build_usage_contract(datetime(2015, 12, 31), "3")
 
         self._test_charging_daemon([contract1, contract2, contract3])
+
+    def test_workers(self):
+        contract1 = self._build_subscription_contract(datetime(2016, 3, 1), "1")
+        contract2 = self._build_subscription_contract(datetime(2016, 2, 10), "2")
+        contract3 = self._build_subscription_contract(datetime(2016, 1, 31), "3")
+
+        self._test_charging_daemon([contract1, contract2, contract3], workers=4)
+
+    @parameterized.expand(
+        [
+            ("first", "0/2", ["order1", "order2", "order3"]),
+            ("second", "1/2", ["order4"]),
+            ("single", "0/1", ["order1", "order2", "order3", "order4"]),
+        ]
+    )
+    def test_partition(self, name, partition, expected):
+        self._schedule.get_due.return_value = {"order1": {"1"}, "order2": {"1"}, "order3": {"1"}, "order4": {"1"}}
+        pending_charges_daemon.Order.objects.filter.return_value = []
+
+        command = pending_charges_daemon.Command(stdout=StringIO())
+        command.handle(partition=partition)
+
+        pending_charges_daemon.Order.objects.filter.assert_called_once_with(pk__in=expected)
+
+    @parameterized.expand([("format", "1-2"), ("index", "2/2"), ("total", "0/0")])
+    def test_invalid_partition(self, name, partition):
+        command = pending_charges_daemon.Command(stdout=StringIO())
+
+        with self.assertRaises(CommandError):
+            command.handle(partition=partition)
+
+    def test_stage_failures(self):
+        contract = self._build_subscription_contract(datetime(2016, 1, 31), "3")
+        order = MagicMock(pk="order", order_id="10")
+        order.get_contracts.return_value = [contract]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+        self._schedule.get_due.return_value = {"order": {"3"}}
+
+        pending_charges_daemon.InventoryClient().suspend_product.side_effect = Exception("Inventory down")
+
+        out = StringIO()
+        command = pending_charges_daemon.Command(stdout=out)
+        command.handle()
+
+        report = out.getvalue()
+        self.assertIn("Checked 1 due contracts", report)
+        self.assertIn("inventory: 1 calls", report)
+        self.assertIn("1 failed", report)
+        self.assertIn("Failed inventory of order 10 product 3: Inventory down", report)
+
+    def test_build_schedule(self):
+        self._schedule.is_built.return_value = False
+        self._schedule.get_due.return_value = {}
+        pending_charges_daemon.Order.objects.filter.return_value = []
+
+        command = pending_charges_daemon.Command(stdout=StringIO())
+        command.handle()
+
+        self._schedule.build.assert_called_once_with(pending_charges_daemon.Order.objects.all())
+        pending_charges_daemon.NotificationsHandler.assert_not_called()
+
+    def test_terminated_contract(self):
+        contract = self._build_subscription_contract(datetime(2016, 1, 31), "1")
+        contract.terminated = True
+
+        order = MagicMock(pk="order")
+        order.get_contracts.return_value = [contract]
+        pending_charges_daemon.Order.objects.filter.return_value = [order]
+        self._schedule.get_due.return_value = {"order": {"1"}}
+
+        command = pending_charges_daemon.Command(stdout=StringIO())
+        command.handle()
+
+        self._schedule.remove_contract.assert_called_once_with("order", "1")
+        pending_charges_daemon.on_product_suspended.assert_not_called()
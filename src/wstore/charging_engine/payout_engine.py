@@ -19,16 +19,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import threading
 import time
 from collections import defaultdict
+from datetime import datetime, timedelta
 from decimal import Decimal
 from logging import getLogger
+from uuid import uuid4
 
-import requests
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from paypalrestsdk import Payout
+from pymongo import ASCENDING, DeleteOne, UpdateOne
 
 from wstore.admin.users.notification_handler import NotificationsHandler
 from wstore.charging_engine.models import ReportSemiPaid, ReportsPayout
@@ -36,14 +39,49 @@ from wstore.charging_engine.payment_client.paypal_client import PayPalClient
 from wstore.models import Context, User
 from wstore.ordering.errors import PayoutError
 from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.http_session import get_http_session
 
 logger = getLogger("wstore.default_logger")
 
+PENDING_PAYOUTS_COLLECTION = "wstore_pending_payouts"
 
-class PayoutWatcher(threading.Thread):
-    def __init__(self, payouts, reports):
-        super().__init__()
-        self.payouts = payouts
+
+def _get_user_mails(usernames):
+    """
+    Resolves the emails of a set of users with a single query
+    :param usernames: Iterable with the usernames, may contain duplicates
+    :return: Dict with the email of every username
+    """
+    usernames = set(usernames)
+    mails = {user.username: user.email for user in User.objects.filter(username__in=list(usernames))}
+
+    missing = usernames.difference(mails)
+    if len(missing):
+        raise User.DoesNotExist(f"Users {', '.join(sorted(missing))} do not exist")
+
+    return mails
+
+
+def _get_report_usernames(report):
+    return [report["ownerProviderId"]] + [stake["stakeholderId"] for stake in report.get("stakeholders", [])]
+
+
+def _get_semi_paid_reports(report_ids):
+    """
+    Loads the semi paid records of a set of reports with a single query
+    :param report_ids: Iterable with the ids of the reports
+    :return: Dict with the ReportSemiPaid of every report that has one
+    """
+    return {semipaid.report: semipaid for semipaid in ReportSemiPaid.objects.filter(report__in=list(set(report_ids)))}
+
+
+class PayoutWatcher:
+    """
+    Processes the result of a payout batch, marking its reports as paid in the RSS
+    once all their stakeholders have been paid
+    """
+
+    def __init__(self, reports):
         self.reports = reports
         self.notifications = NotificationsHandler()
 
@@ -67,7 +105,7 @@ class PayoutWatcher(threading.Thread):
         url += "rss/settlement/reports/{}".format(report)
 
         logger.debug(f"PATCH {url}")
-        response = requests.patch(url, json=data, headers=headers)
+        response = get_http_session().patch(url, json=data, headers=headers)
 
         if response.status_code != 200:
             logger.error(f"Error marking report {report} as paid: {response.reason}")
@@ -154,22 +192,33 @@ class PayoutWatcher(threading.Thread):
         semipaid.save()
         return True
 
+    def _safe_get_semi_paid_reports(self, report_ids):
+        semipaids = _get_semi_paid_reports(report_ids)
+
+        for report_id in report_ids:
+            if report_id not in semipaids:
+                semipaids[report_id] = ReportSemiPaid(report=report_id)
+                semipaids[report_id].save()
+
+        return semipaids
+
     def _check_reports_payout(self, payout):
         logger.debug("Cheking payout of reports")
 
-        reports_id = {item["payout_item"]["sender_item_id"].split("_")[0] for item in payout["items"]}
-        for report_id in reports_id:
-            filtered = list(filter(lambda x: x.get("id") == int(report_id), self.reports))
-            if len(filtered) == 0:
-                continue
+        reports_id = {int(item["payout_item"]["sender_item_id"].split("_")[0]) for item in payout["items"]}
+        reports = {report.get("id"): report for report in self.reports if report.get("id") in reports_id}
 
-            report = filtered[0]
-            reportmails = [User.objects.get(username=report["ownerProviderId"]).email]
-            reportmails.extend(
-                [User.objects.get(username=stake["stakeholderId"]).email for stake in report.get("stakeholders", [])]
-            )
+        if len(reports) == 0:
+            return
 
-            semipaid = self._safe_get_semi_paid(report_id)
+        # Owners, stakeholders and semi paid records of all the reports are loaded at once
+        mails = _get_user_mails(username for report in reports.values() for username in _get_report_usernames(report))
+        semipaids = self._safe_get_semi_paid_reports(list(reports))
+
+        for report_id, report in reports.items():
+            reportmails = [mails[username] for username in _get_report_usernames(report)]
+
+            semipaid = semipaids[report_id]
             semipaid.failed = [x for x in semipaid.failed if x in reportmails]  # Clean mails not in report
             if len(semipaid.failed) == 0 and all([mail in semipaid.success for mail in reportmails]):
                 # Mark as paid in remote
@@ -184,39 +233,208 @@ class PayoutWatcher(threading.Thread):
             self._analyze_item(item)
         self._check_reports_payout(payout)
 
-    def _check_payout(self, payout):
-        logger.debug(f"Checking payout")
+    def check_payout(self, payout_id):
+        """
+        Gets the status of a payout batch from PayPal, processing its items if it has finished.
+        Errors retrieving the batch are raised, while errors processing a finished batch are
+        logged, since processing it again would repeat the notifications and report updates
+        :param payout_id: PayPal id of the payout batch
+        :return: True if the payout batch has not finished yet
+        """
+        logger.debug(f"Checking payout {payout_id}")
+        pay = Payout.find(payout_id)
+        status = pay["batch_header"]["batch_status"]
+        logger.debug(f"Payout status: {status}")
+
         try:
-            pay = Payout.find(payout["batch_header"]["payout_batch_id"])
-            status = pay["batch_header"]["batch_status"]
             self._update_status(pay)
-            logger.debug(f"Payout status: {status}")
-            if status == "DENIED":
-                return False
             if status == "SUCCESS":
                 self._payout_success(pay)
-                return False
-            if status in ["PENDING", "PROCESSING"]:
-                return True
-            return False
-        except Exception:
-            return False
+        except Exception as e:
+            logger.error(f"Error processing payout {payout_id} with status {status}: {e}")
+
+        return status in ["PENDING", "PROCESSING"]
+
+
+class PendingPayouts:
+    """
+    Durable list of the payout batches sent to PayPal that have not finished. Every batch is
+    saved with the date of its next check, which is moved forward while a poller holds it, so
+    the batches claimed by a crashed process are checked by other one once the claim expires
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[PENDING_PAYOUTS_COLLECTION]
+
+    def ensure_indexes(self):
+        self._collection.create_index([("next_check", ASCENDING)])
+        self._collection.create_index([("claim", ASCENDING)])
+
+    def push(self, payout_id, reports, delay):
+        now = datetime.utcnow()
+        self._collection.insert_one(
+            {
+                "_id": payout_id,
+                "reports": reports,
+                "attempts": 0,
+                "created": now,
+                "next_check": now + timedelta(seconds=delay),
+                "claim": None,
+            }
+        )
+
+    def claim(self, batch_size, claim_ttl):
+        """
+        Takes the payout batches whose check is due
+        :param batch_size: Max number of batches to be claimed
+        :param claim_ttl: Seconds the batches are held before other poller can claim them
+        :return: List of claimed documents
+        """
+        now = datetime.utcnow()
+        ids = [
+            doc["_id"]
+            for doc in self._collection.find({"next_check": {"$lte": now}}, projection={"_id": True})
+            .sort("next_check", ASCENDING)
+            .limit(batch_size)
+        ]
+
+        if not len(ids):
+            return []
+
+        token = uuid4().hex
+        self._collection.update_many(
+            {"_id": {"$in": ids}, "next_check": {"$lte": now}},
+            {"$set": {"claim": token, "next_check": now + timedelta(seconds=claim_ttl)}},
+        )
+
+        return list(self._collection.find({"claim": token}))
+
+    def ack(self, docs):
+        # Batches whose claim has expired may be held by other poller
+        self._collection.bulk_write(
+            [DeleteOne({"_id": doc["_id"], "claim": doc["claim"]}) for doc in docs],
+            ordered=False,
+        )
+
+    def retry(self, docs, interval, max_interval):
+        """
+        Schedules the next check of the given batches with exponential backoff
+        """
+        now = datetime.utcnow()
+        updates = []
+
+        for doc in docs:
+            attempts = doc["attempts"] + 1
+            delay = min(max_interval, interval * 2**attempts)
+
+            updates.append(
+                UpdateOne(
+                    {"_id": doc["_id"], "claim": doc["claim"]},
+                    {"$set": {"attempts": attempts, "next_check": now + timedelta(seconds=delay), "claim": None}},
+                )
+            )
+
+        self._collection.bulk_write(updates, ordered=False)
 
-    def _check_payouts(self):
-        logger.debug(f"Checking all payouts")
-        new = []
-        for payout in self.payouts:
-            pending = self._check_payout(payout)
-            if pending:
-                # Still pending or processing
-                new.append(payout)
-        self.payouts = new
+    def get_depth(self):
+        return self._collection.count_documents({})
+
+
+class PayoutPoller(threading.Thread):
+    """
+    Background thread checking the status of the pending payout batches of all the
+    settlements. Every batch is checked less often as it gets older, up to
+    PAYOUT_POLL_BUDGET batches are checked every PAYOUT_POLL_INTERVAL seconds, and
+    batches not finished after PAYOUT_POLL_MAX_AGE seconds are no longer checked
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="payout-poller", daemon=True)
+
+        self._interval = getattr(settings, "PAYOUT_POLL_INTERVAL", 5)
+        self._max_interval = getattr(settings, "PAYOUT_POLL_MAX_INTERVAL", 600)
+        self._budget = getattr(settings, "PAYOUT_POLL_BUDGET", 20)
+        self._max_age = getattr(settings, "PAYOUT_POLL_MAX_AGE", 259200)
 
     def run(self):
-        logger.debug(f"Running PayoutWatcher {id(self)}")
-        while len(self.payouts) != 0:
-            self._check_payouts()
-            time.sleep(1)
+        PendingPayouts().ensure_indexes()
+
+        while True:
+            time.sleep(self._interval)
+
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Error polling payouts: {e}")
+
+    def _check(self, doc):
+        try:
+            return PayoutWatcher(doc["reports"]).check_payout(doc["_id"])
+        except Exception as e:
+            # The batch could not be retrieved from PayPal, so it is checked again later
+            logger.warning(f"Error checking payout {doc['_id']}: {e}")
+            return True
+
+    def poll(self):
+        """
+        Checks the pending payout batches whose check is due, up to the polling budget
+        :return: Number of payout batches checked
+        """
+        pending = PendingPayouts()
+
+        # A claimed batch is held for the time it could take to be checked
+        docs = pending.claim(self._budget, self._max_interval)
+        if not len(docs):
+            return 0
+
+        oldest = datetime.utcnow() - timedelta(seconds=self._max_age)
+        finished = []
+        unfinished = []
+
+        for doc in docs:
+            if doc["created"] < oldest:
+                logger.error(f"Payout {doc['_id']} has not finished after {self._max_age} seconds, no longer checked")
+                finished.append(doc)
+            elif self._check(doc):
+                unfinished.append(doc)
+            else:
+                finished.append(doc)
+
+        if len(finished):
+            pending.ack(finished)
+
+        if len(unfinished):
+            pending.retry(unfinished, self._interval, self._max_interval)
+
+        return len(docs)
+
+
+_poller = None
+_poller_pid = None
+_poller_lock = threading.Lock()
+
+
+def get_payout_poller():
+    """
+    Returns the payout poller of the current process, starting it if needed
+    """
+    global _poller, _poller_pid
+
+    with _poller_lock:
+        if _poller is None or _poller_pid != os.getpid() or not _poller.is_alive():
+            _poller = PayoutPoller()
+            _poller_pid = os.getpid()
+            _poller.start()
+
+        return _poller
+
+
+def watch_payout(payout_id, reports):
+    """
+    Saves a payout batch to be checked in background until it finishes. Batches are checked by
+    the poller of the server process, so the management commands do not start one
+    """
+    PendingPayouts().push(payout_id, reports, getattr(settings, "PAYOUT_POLL_INTERVAL", 5))
 
 
 class PayoutEngine(object):
@@ -248,7 +466,7 @@ class PayoutEngine(object):
         url += "rss/settlement/reports"
 
         logger.debug(f"GET {url} {data}")
-        response = requests.get(url, params=data, headers=headers)
+        response = get_http_session().get(url, params=data, headers=headers)
 
         if response.status_code != 200:
             logger.error(f"GET {url} returned {status_code} {response.reason}")
@@ -261,25 +479,31 @@ class PayoutEngine(object):
         logger.debug("Processing reports")
 
         new_reports = defaultdict(lambda: defaultdict(list))
+        unpaid = [report for report in reports if not report["paid"]]
+
+        if len(unpaid) == 0:
+            return new_reports
+
+        # Users and semi paid records are resolved with a query each instead of one per report
+        mails = _get_user_mails(
+            [report["ownerProviderId"] for report in unpaid]
+            + [stake["stakeholderId"] for report in unpaid for stake in report["stakeholders"]]
+        )
+        semipaids = _get_semi_paid_reports([report["id"] for report in unpaid])
+
         # Divide by currency
-        for report in reports:
-            logger.debug("Processing report {report['id']}")
-            if report["paid"]:
-                continue
-            semipaid = None
-            try:
-                semipaid = ReportSemiPaid.objects.get(report=report["id"])
-            except ObjectDoesNotExist:
-                pass
+        for report in unpaid:
+            logger.debug(f"Processing report {report['id']}")
+            semipaid = semipaids.get(report["id"])
 
             currency = report["currency"]
-            usermail = User.objects.get(username=report["ownerProviderId"]).email
+            usermail = mails[report["ownerProviderId"]]
 
             if semipaid is None or usermail not in semipaid.success:
                 new_reports[currency][usermail].append((report["ownerValue"], report["id"]))
 
             for stake in report["stakeholders"]:
-                stakemail = User.objects.get(username=stake["stakeholderId"]).email
+                stakemail = mails[stake["stakeholderId"]]
 
                 if semipaid is None or stakemail not in semipaid.success:
                     new_reports[currency][stakemail].append((stake["modelValue"], report["id"]))
@@ -341,8 +565,6 @@ class PayoutEngine(object):
     def process_reports(self, reports):
         processed = self._process_reports(reports)
         payouts = self._process_payouts(processed)
-        to_watch = []
-
         for payout, created in payouts:
             if not created:
                 # Full error, not even said the semipaid because it didn't failed some transaction
@@ -354,11 +576,9 @@ class PayoutEngine(object):
             rpayout = ReportsPayout(reports=reports, payout_id=payout_id, status=status)
             rpayout.save()
 
-            to_watch.append(payout)
-
-        if len(to_watch) > 0:
-            watcher = PayoutWatcher(to_watch, reports)
-            watcher.start()
+            # Only the reports paid by the batch are needed to check it
+            reports_id = {int(item["sender_item_id"].split("_")[0]) for item in payout["items"]}
+            watch_payout(payout_id, [report for report in reports if report.get("id") in reports_id])
 
     def process_unpaid(self):
         reports = self._get_reports()
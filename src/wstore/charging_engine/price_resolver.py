@@ -19,52 +19,152 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import hashlib
+import json
 from decimal import Decimal
 from logging import getLogger
+from threading import Lock
 
 logger = getLogger("wstore.default_logger")
 
+# Compiled pricing models, by content hash, shared by all the resolvers of the process
+_MODEL_CACHE_SIZE = 1024
+_compiled_models = {}
+_compiled_models_lock = Lock()
+
+
+def get_model_key(pricing_model):
+    """
+    Returns a hash of the content of a pricing model
+    :param pricing_model: Pricing model as stored in the contract
+    """
+    content = json.dumps(pricing_model, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def compile_pricing_model(pricing_model, key=None):
+    """
+    Returns the compiled version of a pricing model, compiling it if it is not
+    already cached
+    :param pricing_model: Pricing model as stored in the contract
+    :param key: Content hash of the pricing model, calculated if not provided
+    """
+    if key is None:
+        key = get_model_key(pricing_model)
+
+    compiled = _compiled_models.get(key)
+    if compiled is None:
+        compiled = CompiledPricingModel(pricing_model)
+
+        with _compiled_models_lock:
+            if len(_compiled_models) >= _MODEL_CACHE_SIZE:
+                _compiled_models.clear()
+
+            _compiled_models[key] = compiled
+
+    return compiled
+
+
+class CompiledPricingModel:
+    """
+    Pricing model with its price components already parsed, so it can be
+    applied to any number of contracts without parsing it again
+    """
+
+    def __init__(self, pricing_model):
+        self.price = Decimal("0")
+        self.duty_free = Decimal("0")
+
+        # Fixed parts are added in the same order as the price resolver did
+        for part in ("single_payment", "subscription"):
+            for payment in pricing_model.get(part, []):
+                self.price += Decimal(payment["value"])
+                self.duty_free += Decimal(payment["duty_free"])
+
+        self.pay_per_use = None
+        if "pay_per_use" in pricing_model:
+            self.pay_per_use = [
+                (component["unit"].lower(), Decimal(component["value"]), Decimal(component["duty_free"]))
+                for component in pricing_model["pay_per_use"]
+            ]
+
+        self.alteration = None
+        if "alteration" in pricing_model:
+            alteration = pricing_model["alteration"]
+            condition = None
+            if "condition" in alteration:
+                condition = (alteration["condition"]["operation"], Decimal(alteration["condition"]["value"]))
+
+            if isinstance(alteration["value"], dict):
+                value = (Decimal(alteration["value"]["value"]), Decimal(alteration["value"]["duty_free"]))
+                percentage = False
+            else:
+                value = Decimal(alteration["value"])
+                percentage = True
+
+            self.alteration = (condition, percentage, value, alteration["type"] == "discount")
+
 
 class PriceResolver:
     _applied_sdrs = None
 
+    _condition_handlers = {
+        "eq": Decimal.__eq__,
+        "lt": Decimal.__lt__,
+        "gt": Decimal.__gt__,
+        "le": Decimal.__le__,
+        "ge": Decimal.__ge__,
+    }
+
     def __init__(self):
         self._applied_sdrs = []
         self._alteration_applied = False
 
-    def _pay_per_use_preprocesing(self, use_models, accounting_info):
+    def _pay_per_use_preprocesing(self, use_models, accounting_info, compiled_models=None, applied_sdrs=None):
         """
         Process pay-per-use payments and call the corresponding
         price calculator
         """
         logger.debug("Processing pay-per-use payments")
 
+        if compiled_models is None:
+            compiled_models = CompiledPricingModel({"pay_per_use": use_models}).pay_per_use
+
+        if applied_sdrs is None:
+            applied_sdrs = self._applied_sdrs
+
         price = Decimal("0")
         duty_free = Decimal("0")
 
-        for component in use_models:
+        # Group the SDRs of the charged units in a single pass, parsing their values only once
+        units = {unit: [] for unit, _, _ in compiled_models}
+        for sdr in accounting_info:
+            unit = sdr["unit"].lower()
+            if unit in units:
+                units[unit].append((sdr, Decimal(sdr["value"])))
+
+        for component, (unit, comp_value, comp_unit_duty_free) in zip(use_models, compiled_models):
             related_accounting = []
 
             # Get the related accounting info
             partial_price = Decimal("0")
             partial_duty_free = Decimal("0")
 
-            for sdr in accounting_info:
-                if sdr["unit"].lower() == component["unit"].lower():
-                    sdr_info = {"usage_id": sdr["usage_id"], "value": sdr["value"]}
-                    comp_price = Decimal(sdr["value"]) * Decimal(component["value"])
-                    partial_price += comp_price
-                    sdr_info["price"] = str(comp_price)
+            for sdr, value in units[unit]:
+                sdr_info = {"usage_id": sdr["usage_id"], "value": sdr["value"]}
+                comp_price = value * comp_value
+                partial_price += comp_price
+                sdr_info["price"] = str(comp_price)
 
-                    comp_duty_free = Decimal(sdr["value"]) * Decimal(component["duty_free"])
-                    partial_duty_free += comp_duty_free
-                    sdr_info["duty_free"] = str(comp_duty_free)
+                comp_duty_free = value * comp_unit_duty_free
+                partial_duty_free += comp_duty_free
+                sdr_info["duty_free"] = str(comp_duty_free)
 
-                    # Save the information of the SDR document which is needed for further precessing
-                    related_accounting.append(sdr_info)
+                # Save the information of the SDR document which is needed for further precessing
+                related_accounting.append(sdr_info)
 
             # Include the applied SDRs
-            self._applied_sdrs.append(
+            applied_sdrs.append(
                 {
                     "model": component,
                     "accounting": related_accounting,
@@ -82,37 +182,32 @@ class PriceResolver:
     def is_altered(self):
         return self._alteration_applied
 
-    def _process_alteration(self, alteration, price, duty_free):
+    def _process_alteration(self, alteration, price, duty_free, compiled_alteration=None):
         logger.debug("Processing alteration: {alteration}")
 
+        if compiled_alteration is None:
+            compiled_alteration = CompiledPricingModel({"alteration": alteration}).alteration
+
+        condition, percentage, value, discount = compiled_alteration
+
         # Check if there is a condition
         partial_price, partial_duty = Decimal(0), Decimal(0)
         self._alteration_applied = True
 
-        if "condition" in alteration:
-            condition_handlers = {
-                "eq": price.__eq__,
-                "lt": price.__lt__,
-                "gt": price.__gt__,
-                "le": price.__le__,
-                "ge": price.__ge__,
-            }
-            op = alteration["condition"]["operation"]
-            value = alteration["condition"]["value"]
-
-            self._alteration_applied = condition_handlers[op](Decimal(value))
+        if condition is not None:
+            op, condition_value = condition
+            self._alteration_applied = self._condition_handlers[op](price, condition_value)
 
         if self._alteration_applied:
             # Check if the alteration is a percentage or a fixed value
-            if isinstance(alteration["value"], dict):
-                partial_price = Decimal(alteration["value"]["value"])
-                partial_duty = Decimal(alteration["value"]["duty_free"])
+            if not percentage:
+                partial_price, partial_duty = value
             else:
-                partial_price = (Decimal(alteration["value"]) * price) / Decimal("100")
-                partial_duty = (Decimal(alteration["value"]) * duty_free) / Decimal("100")
+                partial_price = (value * price) / Decimal("100")
+                partial_duty = (value * duty_free) / Decimal("100")
 
             # Check if the alteration is a discount
-            if alteration["type"] == "discount":
+            if discount:
                 partial_price *= Decimal("-1")
                 partial_duty *= Decimal("-1")
 
@@ -126,38 +221,27 @@ class PriceResolver:
         """
         return self._applied_sdrs
 
-    def resolve_price(self, pricing_model, accounting_info=None):
-        """
-        Calculates a price to be charged using a pricing
-        model and accounting info.
-        """
-        logger.debug(f"Calculating price with {pricing_model}")
-
-        price = Decimal("0")
-        duty_free = Decimal("0")
-        # Check the pricing model
-        if "single_payment" in pricing_model:
-            for payment in pricing_model["single_payment"]:
-                price += Decimal(payment["value"])
-                duty_free += Decimal(payment["duty_free"])
-
-        if "subscription" in pricing_model:
-            for payment in pricing_model["subscription"]:
-                price += Decimal(payment["value"])
-                duty_free += Decimal(payment["duty_free"])
+    def _apply_model(self, pricing_model, compiled, accounting_info, applied_sdrs):
+        price = compiled.price
+        duty_free = compiled.duty_free
 
-        if "pay_per_use" in pricing_model:
+        if compiled.pay_per_use is not None:
             # Calculate the payment associated with the price component
             partial_price, partial_duty_free = self._pay_per_use_preprocesing(
-                pricing_model["pay_per_use"], accounting_info
+                pricing_model["pay_per_use"],
+                accounting_info,
+                compiled_models=compiled.pay_per_use,
+                applied_sdrs=applied_sdrs,
             )
 
             price += partial_price
             duty_free += partial_duty_free
 
         # Apply price alterations if existing
-        if "alteration" in pricing_model:
-            partial_price, partial_duty_free = self._process_alteration(pricing_model["alteration"], price, duty_free)
+        if compiled.alteration is not None:
+            partial_price, partial_duty_free = self._process_alteration(
+                pricing_model["alteration"], price, duty_free, compiled_alteration=compiled.alteration
+            )
 
             price += partial_price
             duty_free += partial_duty_free
@@ -171,5 +255,54 @@ class PriceResolver:
         price = price.quantize(Decimal("10") ** -2)
         duty_free = duty_free.quantize(Decimal("10") ** -2)
 
-        logger.debug(f"Calculated price with {pricing_model}:\n" f"\tPrice: {price} | Duty_free: {duty_free}")
         return str(price), str(duty_free)
+
+    def resolve_price(self, pricing_model, accounting_info=None):
+        """
+        Calculates a price to be charged using a pricing
+        model and accounting info.
+        """
+        logger.debug(f"Calculating price with {pricing_model}")
+
+        compiled = CompiledPricingModel(pricing_model)
+        price, duty_free = self._apply_model(pricing_model, compiled, accounting_info, self._applied_sdrs)
+
+        logger.debug(f"Calculated price with {pricing_model}:\n" f"\tPrice: {price} | Duty_free: {duty_free}")
+        return price, duty_free
+
+    def resolve_prices(self, charges):
+        """
+        Calculates the prices of many charges at once. Every distinct pricing
+        model is compiled only once, whatever the number of charges using it.
+        :param charges: Iterable of (pricing_model, accounting_info) pairs
+        :return: List with the price, duty_free, applied_sdrs and altered
+        fields of each charge, in the same order
+        """
+        results = []
+        compiled_models = {}
+
+        for pricing_model, accounting_info in charges:
+            # Charges usually share the model object, which avoids hashing it again. The
+            # model is kept in the entry so its id cannot be reused during the call
+            entry = compiled_models.get(id(pricing_model))
+            if entry is None:
+                entry = (pricing_model, compile_pricing_model(pricing_model))
+                compiled_models[id(pricing_model)] = entry
+
+            compiled = entry[1]
+
+            applied_sdrs = []
+            self._alteration_applied = False
+            price, duty_free = self._apply_model(pricing_model, compiled, accounting_info, applied_sdrs)
+
+            results.append(
+                {
+                    "price": price,
+                    "duty_free": duty_free,
+                    "applied_sdrs": applied_sdrs,
+                    "altered": compiled.alteration is not None and self._alteration_applied,
+                }
+            )
+
+        logger.debug(f"Calculated {len(results)} prices with {len(compiled_models)} pricing models")
+        return results
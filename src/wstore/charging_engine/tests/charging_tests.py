@@ -23,16 +23,18 @@
 import json
 from copy import deepcopy
 from datetime import datetime
+from decimal import Decimal
 from importlib import reload
 
 from bson.objectid import ObjectId
 from django.test import TestCase
 from django.test.client import RequestFactory
-from mock import MagicMock, call
+from mock import ANY, MagicMock, call
 from parameterized import parameterized
+from pymongo import DeleteOne, UpdateOne
 
 import wstore.store_commons.utils.http
-from wstore.charging_engine import charging_engine, views
+from wstore.charging_engine import charge_schedule, charging_engine, price_resolver, views
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Payment
 from wstore.store_commons.utils.testing import decorator_mock
@@ -74,11 +76,19 @@ class ChargingEngineTestCase(TestCase):
 
         # Mock invoice builder
         charging_engine.InvoiceBuilder = MagicMock()
-        charging_engine.InvoiceBuilder.return_value.generate_invoice.return_value = INVOICE_PATH
+        self._invoice_job = MagicMock()
+        self._invoice_job.exception.return_value = None
+        charging_engine.InvoiceBuilder.return_value.enqueue_invoice.return_value = (INVOICE_PATH, self._invoice_job)
+
+        # Run the callbacks of the invoice pipeline once the jobs are enqueued
+        charging_engine.get_invoice_pipeline = MagicMock()
+        charging_engine.get_invoice_pipeline().when_done.side_effect = lambda jobs, callback, *args: callback(*args)
 
         # Mock CDR Manager
         charging_engine.CDRManager = MagicMock()
 
+        charging_engine.get_usage_rater = MagicMock()
+
         # Mock datetime
         now = datetime(2016, 1, 20, 13, 12, 39)
         charging_engine.datetime = MagicMock()
@@ -93,6 +103,8 @@ class ChargingEngineTestCase(TestCase):
 
         charging_engine.BillingClient = MagicMock()
         charging_engine.Offering = MagicMock()
+        charging_engine.ChargeSchedule = MagicMock()
+        charging_engine.EntitlementIndex = MagicMock()
 
     def _get_single_payment(self):
         return {
@@ -507,24 +519,6 @@ class ChargingEngineTestCase(TestCase):
                             "price": "200.00",
                             "duty_free": "166.60",
                         },
-                        {
-                            "model": {
-                                "value": "10.00",
-                                "unit": "callmin",
-                                "tax_rate": "20.00",
-                                "duty_free": "8.33",
-                            },
-                            "accounting": [
-                                {
-                                    "price": "10.00",
-                                    "value": "1",
-                                    "usage_id": "3",
-                                    "duty_free": "8.33",
-                                }
-                            ],
-                            "price": "10.00",
-                            "duty_free": "8.33",
-                        },
                     ],
                 },
                 {
@@ -550,30 +544,6 @@ class ChargingEngineTestCase(TestCase):
                     },
                     "item": "2",
                     "applied_accounting": [
-                        {
-                            "model": {
-                                "value": "10.00",
-                                "unit": "call",
-                                "tax_rate": "20.00",
-                                "duty_free": "8.33",
-                            },
-                            "accounting": [
-                                {
-                                    "usage_id": "1",
-                                    "price": "100.00",
-                                    "duty_free": "83.30",
-                                    "value": "10",
-                                },
-                                {
-                                    "usage_id": "4",
-                                    "price": "100.00",
-                                    "duty_free": "83.30",
-                                    "value": "10",
-                                },
-                            ],
-                            "price": "200.00",
-                            "duty_free": "166.60",
-                        },
                         {
                             "model": {
                                 "value": "10.00",
@@ -832,6 +802,20 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals("pending", self._order.state)
         self._order.save.assert_called_once_with()
 
+    def test_payment_prices_resolved_in_batch(self):
+        self._order.state = "pending"
+        transactions, _ = self._set_usage_contracts()
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging._price_resolver = MagicMock(wraps=charging._price_resolver)
+        charging.resolve_charging("usage")
+
+        # Both contracts are resolved by a single call
+        charging._price_resolver.resolve_prices.assert_called_once_with(
+            [(transaction["related_model"], ANY) for transaction in transactions]
+        )
+        self.assertEquals(0, charging._price_resolver.resolve_price.call_count)
+
     def test_renovation_error(self):
         self._order.state = "pending"
         self._set_subscription_contract()
@@ -858,7 +842,7 @@ class ChargingEngineTestCase(TestCase):
 
         # Check invoice generation calls
         charging_engine.InvoiceBuilder.assert_called_once_with(self._order)
-        self.assertEquals(charging_engine.InvoiceBuilder().generate_invoice.call_count, 0)
+        self.assertEquals(charging_engine.InvoiceBuilder().enqueue_invoice.call_count, 0)
         self.assertEquals(charging_engine.BillingClient().create_charge.call_count, 0)
 
         # Check order status
@@ -896,6 +880,15 @@ class ChargingEngineTestCase(TestCase):
         )
         self.assertEquals([call(), call(), call()], self._order.owner_organization.save.call_args_list)
 
+        self.assertEquals(
+            [
+                call(self._order, self._order.get_contracts()[0]),
+                call(self._order, self._order.get_contracts()[1]),
+                call(self._order, self._order.get_contracts()[2]),
+            ],
+            charging_engine.EntitlementIndex().grant.call_args_list,
+        )
+
         self.assertEquals(
             [
                 call(self._order, self._order.get_contracts()[0]),
@@ -1158,28 +1151,11 @@ class ChargingEngineTestCase(TestCase):
         )
 
     def _validate_end_usage_payment(self, transactions):
-        self.assertEquals(
-            [
-                call(
-                    "1",
-                    str(datetime(2016, 1, 20, 13, 12, 39)),
-                    "83.30",
-                    "100.00",
-                    "20.00",
-                    "EUR",
-                    self._order.get_contracts()[0].product_id,
-                ),
-                call(
-                    "3",
-                    str(datetime(2016, 1, 20, 13, 12, 39)),
-                    "83.30",
-                    "100.00",
-                    "20.00",
-                    "EUR",
-                    self._order.get_contracts()[0].product_id,
-                ),
-            ],
-            charging_engine.UsageClient().rate_usage.call_args_list,
+        charging_engine.get_usage_rater().rate.assert_called_once_with(
+            [("1", "83.30", "100.00", "20.00"), ("3", "83.30", "100.00", "20.00")],
+            str(datetime(2016, 1, 20, 13, 12, 39)),
+            "EUR",
+            self._order.get_contracts()[0].product_id,
         )
 
         charging_engine.BillingClient.assert_called_once_with()
@@ -1221,6 +1197,41 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals("paid", self._order.state)
 
         self.assertEquals([call(), call()], self._order.save.call_args_list)
+        charging_engine.ChargeSchedule().update_order.assert_called_once_with(self._order)
+
+        # Notifications are sent once the invoices are rendered
+        charging_engine.get_invoice_pipeline().when_done.assert_called_once_with(
+            [self._invoice_job] * len(transactions), charging._finish_invoices, ANY, name, transactions
+        )
+
+    def test_end_payment_invoice_error(self):
+        self._order.state = "pending"
+        transactions, free_contracts = self._set_initial_contracts()
+        self._invoice_job.exception.return_value = Exception("Rendering error")
+        charging_engine.get_database_connection = MagicMock()
+        charging_engine.Charge.side_effect = lambda **kwargs: MagicMock(**kwargs)
+
+        charging = charging_engine.ChargingEngine(self._order)
+        charging._send_notification = MagicMock()
+        charging.end_charging(transactions, free_contracts, "initial")
+
+        # The charges no longer point to the removed invoices
+        charges = [contract.charges[-1] for contract in self._order.contracts if len(contract.charges)]
+        self.assertEquals([""] * len(transactions), [charge.invoice for charge in charges])
+
+        db = charging_engine.get_database_connection()
+        self.assertEquals(
+            [
+                call(
+                    {"_id": self._order.pk},
+                    {"$set": {"contracts.$[].charges.$[charge].invoice": ""}},
+                    array_filters=[{"charge.invoice": INVOICE_PATH}],
+                )
+            ]
+            * len(transactions),
+            db.wstore_order.update_one.call_args_list,
+        )
+        charging._send_notification.assert_called_once_with("initial", transactions)
 
     def test_invalid_concept(self):
         charging = charging_engine.ChargingEngine(self._order)
@@ -1235,6 +1246,94 @@ class ChargingEngineTestCase(TestCase):
         self.assertEquals("Invalid charge type, must be `initial`, `recurring`, or `usage`", str(error))
 
 
+class ChargeScheduleTestCase(TestCase):
+    tags = ("charging-engine", "charge-schedule")
+
+    def setUp(self):
+        self._collection = MagicMock()
+        charge_schedule.get_database_connection = MagicMock(return_value={"wstore_charge_schedule": self._collection})
+
+        self._order = MagicMock(pk="order", date=datetime(2016, 1, 1))
+
+    def tearDown(self):
+        reload(charge_schedule)
+
+    def _build_contract(self, item_id, pricing, charges=None, terminated=False):
+        return MagicMock(item_id=item_id, pricing_model=pricing, charges=charges or [], terminated=terminated)
+
+    @parameterized.expand(
+        [
+            ("single_payment", {"single_payment": []}, [], None),
+            ("usage_no_charges", {"pay_per_use": []}, [], datetime(2016, 1, 31)),
+            (
+                "usage_charged",
+                {"pay_per_use": []},
+                [MagicMock(concept="usage", date=datetime(2016, 2, 1)), MagicMock(concept="initial")],
+                datetime(2016, 3, 2),
+            ),
+            (
+                "subscription",
+                {
+                    "subscription": [
+                        {"renovation_date": datetime(2016, 5, 1)},
+                        {"renovation_date": datetime(2016, 4, 1)},
+                    ]
+                },
+                [],
+                datetime(2016, 4, 1),
+            ),
+            ("subscription_not_paid", {"subscription": [{"unit": "monthly"}]}, [], None),
+            (
+                "mixed",
+                {"pay_per_use": [], "subscription": [{"renovation_date": datetime(2016, 4, 1)}]},
+                [],
+                datetime(2016, 1, 31),
+            ),
+        ]
+    )
+    def test_next_action(self, name, pricing, charges, expected):
+        contract = self._build_contract("1", pricing, charges)
+        self.assertEquals(expected, charge_schedule.ChargeSchedule.get_next_action(self._order, contract))
+
+    def test_next_action_terminated(self):
+        contract = self._build_contract("1", {"pay_per_use": []}, terminated=True)
+        self.assertIsNone(charge_schedule.ChargeSchedule.get_next_action(self._order, contract))
+
+    def test_update_order(self):
+        self._order.get_contracts.return_value = [
+            self._build_contract("1", {"pay_per_use": []}),
+            self._build_contract("2", {"single_payment": []}),
+        ]
+
+        charge_schedule.ChargeSchedule().update_order(self._order)
+
+        self._collection.bulk_write.assert_called_once_with(
+            [
+                UpdateOne(
+                    {"_id": "order:1"},
+                    {"$set": {"order": "order", "item_id": "1", "due": datetime(2016, 1, 31)}},
+                    upsert=True,
+                ),
+                DeleteOne({"_id": "order:2"}),
+            ],
+            ordered=False,
+        )
+
+    def test_get_due(self):
+        self._collection.find.return_value = [
+            {"order": "order1", "item_id": "1"},
+            {"order": "order1", "item_id": "2"},
+            {"order": "order2", "item_id": "1"},
+        ]
+
+        due = charge_schedule.ChargeSchedule().get_due(datetime(2016, 2, 1))
+
+        self.assertEquals({"order1": {"1", "2"}, "order2": {"1"}}, due)
+        self._collection.find.assert_called_once_with(
+            {"due": {"$lt": datetime(2016, 2, 1)}}, projection={"order": True, "item_id": True}
+        )
+
+
 BASIC_PAYPAL = {
     "reference": "111111111111111111111111",
     "payerId": "payer",
@@ -1258,6 +1357,124 @@ LOCK_CLOSED_RESP = {
 }
 
 
+class PriceResolverTestCase(TestCase):
+    tags = ("charging-engine", "price-resolver")
+
+    _pricing_model = {
+        "general_currency": "EUR",
+        "pay_per_use": [
+            {"unit": "Call", "value": "1.5", "duty_free": "1.2"},
+            {"unit": "megabyte", "value": "0.1", "duty_free": "0.08"},
+            {"unit": "call", "value": "0.5", "duty_free": "0.4"},
+        ],
+    }
+
+    _accounting = [
+        {"usage_id": "1", "unit": "call", "value": "3"},
+        {"usage_id": "2", "unit": "MEGABYTE", "value": "10.5"},
+        {"usage_id": "3", "unit": "hour", "value": "4"},
+        {"usage_id": "4", "unit": "CALL", "value": "2"},
+    ]
+
+    def _naive_applied_sdrs(self, use_models, accounting_info):
+        # Reference implementation matching every component against every SDR
+        applied = []
+        for component in use_models:
+            related = [
+                {
+                    "usage_id": sdr["usage_id"],
+                    "value": sdr["value"],
+                    "price": str(Decimal(sdr["value"]) * Decimal(component["value"])),
+                    "duty_free": str(Decimal(sdr["value"]) * Decimal(component["duty_free"])),
+                }
+                for sdr in accounting_info
+                if sdr["unit"].lower() == component["unit"].lower()
+            ]
+            applied.append(
+                {
+                    "model": component,
+                    "accounting": related,
+                    "price": str(sum((Decimal(sdr["price"]) for sdr in related), Decimal("0"))),
+                    "duty_free": str(sum((Decimal(sdr["duty_free"]) for sdr in related), Decimal("0"))),
+                }
+            )
+        return applied
+
+    def test_pay_per_use_price(self):
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price(self._pricing_model, self._accounting)
+
+        self.assertEqual("11.05", price)
+        self.assertEqual("8.84", duty_free)
+
+        applied = resolver.get_applied_sdr()
+        self.assertEqual(self._naive_applied_sdrs(self._pricing_model["pay_per_use"], self._accounting), applied)
+        self.assertEqual(
+            [["1", "4"], ["2"], ["1", "4"]], [[sdr["usage_id"] for sdr in model["accounting"]] for model in applied]
+        )
+
+    def test_pay_per_use_no_matching_sdrs(self):
+        resolver = price_resolver.PriceResolver()
+        price, duty_free = resolver.resolve_price(
+            self._pricing_model, [{"usage_id": "1", "unit": "hour", "value": "invalid"}]
+        )
+
+        self.assertEqual(("0.00", "0.00"), (price, duty_free))
+        self.assertEqual([[], [], []], [model["accounting"] for model in resolver.get_applied_sdr()])
+
+    def test_resolve_prices_batch(self):
+        price_resolver._compiled_models.clear()
+
+        subscription = {
+            "general_currency": "EUR",
+            "subscription": [{"value": "12.00", "unit": "monthly", "duty_free": "10.00"}],
+            "alteration": {
+                "type": "discount",
+                "value": "50",
+                "condition": {"operation": "gt", "value": "100"},
+            },
+        }
+        charges = [
+            (self._pricing_model, self._accounting),
+            (subscription, None),
+            (deepcopy(self._pricing_model), self._accounting[:1]),
+            (self._pricing_model, []),
+        ]
+
+        results = price_resolver.PriceResolver().resolve_prices(charges)
+
+        # Models with the same content are compiled once
+        self.assertEqual(2, len(price_resolver._compiled_models))
+
+        for (pricing_model, accounting), result in zip(charges, results):
+            resolver = price_resolver.PriceResolver()
+            price, duty_free = resolver.resolve_price(pricing_model, accounting)
+
+            self.assertEqual((price, duty_free), (result["price"], result["duty_free"]))
+            self.assertEqual(resolver.get_applied_sdr(), result["applied_sdrs"])
+            self.assertFalse(result["altered"])
+
+        self.assertEqual(["11.05", "12.00", "6.00", "0.00"], [result["price"] for result in results])
+
+    def test_resolve_prices_alteration(self):
+        pricing_model = {
+            "general_currency": "EUR",
+            "subscription": [{"value": "200.00", "unit": "monthly", "duty_free": "150.00"}],
+            "alteration": {
+                "type": "discount",
+                "value": "10",
+                "condition": {"operation": "ge", "value": "100"},
+            },
+        }
+
+        results = price_resolver.PriceResolver().resolve_prices([(pricing_model, None)])
+
+        self.assertEqual(
+            [{"price": "180.00", "duty_free": "135.00", "applied_sdrs": [], "altered": True}],
+            results,
+        )
+
+
 class PayPalConfirmationTestCase(TestCase):
     tags = ("ordering", "paypal-conf")
 
@@ -1514,6 +1731,30 @@ class PayPalConfirmationTestCase(TestCase):
             )
             self._order_inst.delete.assert_called_once_with()
 
+    def test_set_renovation_states(self):
+        contracts = [MagicMock(product_id="1"), MagicMock(product_id="2"), MagicMock(product_id="3")]
+        self._order_inst.get_item_contract.side_effect = contracts
+
+        def activate_product(product_id):
+            if product_id == "2":
+                raise Exception("Inventory error")
+
+        views.InventoryClient = MagicMock()
+        views.InventoryClient().activate_product.side_effect = activate_product
+        views.on_product_acquired = MagicMock()
+
+        paypal_view = views.PayPalConfirmation(permitted_methods=("POST",))
+        paypal_view._set_renovation_states([{"item": "1"}, {"item": "2"}, {"item": "3"}], {}, self._order_inst)
+
+        self.assertEquals(
+            [call("1"), call("2"), call("3")],
+            sorted(views.InventoryClient().activate_product.call_args_list),
+        )
+        self.assertEquals(
+            [call(self._order_inst, contracts[0]), call(self._order_inst, contracts[2])],
+            views.on_product_acquired.call_args_list,
+        )
+
 
 MISSING_FIELD_RESP = {
     "result": "error",
@@ -18,9 +18,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+from concurrent.futures import Future
+from importlib import reload
+
 from bson.objectid import ObjectId
 from django.test import TestCase
-from mock import MagicMock
+from mock import MagicMock, call
 from parameterized import parameterized
 
 from wstore.charging_engine import invoice_builder
@@ -37,6 +41,7 @@ OWNER_NAME = "owner-user"
 
 BASEDIR = "/home/test"
 BILL_ROOT = "/home/test/media/invoices"
+TMP_DIR = "/tmp/invoice_job"
 MEDIA_URL = "/charging/media/"
 
 TAX = {
@@ -292,18 +297,22 @@ class InvoiceBuilderTestCase(TestCase):
         self._file_handler = MagicMock()
         invoice_builder.codecs.open.return_value = self._file_handler
 
-        self._old_exists = invoice_builder.os.path.exists
-        invoice_builder.os.path.exists = MagicMock()
+        # Two invoices with the same id already exist
+        invoice_builder.os = MagicMock()
+        invoice_builder.os.path.join = os.path.join
+        invoice_builder.os.O_CREAT = os.O_CREAT
+        invoice_builder.os.O_EXCL = os.O_EXCL
+        invoice_builder.os.O_WRONLY = os.O_WRONLY
+        invoice_builder.os.open.side_effect = [FileExistsError(), FileExistsError(), 3]
 
-        invoice_builder.os.path.exists.side_effect = [True, True, False]
-        invoice_builder.os.listdir = MagicMock()
-        invoice_builder.os.listdir.return_value = ["file1.pdf", "file1.html"]
-        invoice_builder.os.remove = MagicMock()
+        invoice_builder.tempfile = MagicMock()
+        invoice_builder.tempfile.TemporaryDirectory.return_value.__enter__.return_value = TMP_DIR
 
         invoice_builder.subprocess = MagicMock()
+        invoice_builder.subprocess.call.return_value = 0
 
     def tearDown(self):
-        invoice_builder.os.path.exists = self._old_exists
+        reload(invoice_builder)
 
     @parameterized.expand(
         [
@@ -346,7 +355,7 @@ class InvoiceBuilderTestCase(TestCase):
         invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
 
         exp_path = MEDIA_URL + "bills/" + invoice_name
-        html_path = BILL_ROOT + "/" + invoice_name.replace("_2.pdf", ".html")
+        html_path = TMP_DIR + "/" + invoice_name.replace("_2.pdf", ".html")
 
         self.assertEquals(exp_path, invoice_path)
 
@@ -365,5 +374,80 @@ class InvoiceBuilderTestCase(TestCase):
             [BASEDIR + "/create_invoice.sh", html_path, BILL_ROOT + "/" + invoice_name]
         )
 
-        invoice_builder.os.listdir.assert_called_once_with(BILL_ROOT)
-        invoice_builder.os.remove.assert_called_once_with(BILL_ROOT + "/file1.html")
+        # The name of the invoice is reserved
+        invoice_builder.os.open.assert_called_with(
+            BILL_ROOT + "/" + invoice_name,
+            os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+        )
+        invoice_builder.os.close.assert_called_once_with(3)
+        invoice_builder.tempfile.TemporaryDirectory.assert_called_once_with(prefix="invoice_")
+
+    @parameterized.expand([("render_error", Exception("Template error"), 0), ("compile_error", None, 1)])
+    def test_invoice_generation_error(self, name, render_error, exit_code):
+        self._template.render.side_effect = render_error
+        invoice_builder.subprocess.call.return_value = exit_code
+
+        builder = invoice_builder.InvoiceBuilder(self._order)
+
+        with self.assertRaises(Exception):
+            builder.generate_invoice(self._contract, SINGLE_PAYMENT_TRANS, "initial")
+
+        # The reserved invoice file is removed
+        invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
+        invoice_builder.os.remove.assert_called_once_with(BILL_ROOT + "/" + invoice_name)
+
+    def test_enqueue_invoice(self):
+        invoice_builder.get_invoice_pipeline = MagicMock()
+
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        invoice_url, job = builder.enqueue_invoice(self._contract, SINGLE_PAYMENT_TRANS, "initial")
+
+        invoice_name = "{}_{}_{}_2.pdf".format(self._order.pk, self._contract.item_id, TIMESTAMP.split()[0])
+        self.assertEquals(MEDIA_URL + "bills/" + invoice_name, invoice_url)
+        self.assertEquals(invoice_builder.get_invoice_pipeline().submit.return_value, job)
+
+        # The invoice is not rendered until the job is executed
+        render, job_info = invoice_builder.get_invoice_pipeline().submit.call_args[0]
+        self.assertEquals(invoice_builder.InvoiceBuilder.render_invoice, render)
+        self.assertEquals(BILL_ROOT + "/" + invoice_name, job_info["path"])
+        self._template.render.assert_not_called()
+        invoice_builder.subprocess.call.assert_not_called()
+
+    def test_template_cache(self):
+        builder = invoice_builder.InvoiceBuilder(self._order)
+        builder._get_initial_parts(SINGLE_PAYMENT_TRANS)
+        builder._get_initial_parts(SINGLE_PAYMENT_TRANS)
+        builder._get_use_parts(USAGE_TRANS)
+
+        self.assertEquals(
+            [call("contracting/bill_template_initial.html"), call("contracting/bill_template_use.html")],
+            invoice_builder.loader.get_template.call_args_list,
+        )
+
+
+class InvoicePipelineTestCase(TestCase):
+    tags = ("invoices",)
+
+    def test_when_done(self):
+        pipeline = invoice_builder.InvoicePipeline()
+        callback = MagicMock()
+
+        futures = [Future(), Future()]
+        pipeline.when_done(futures, callback, "initial")
+
+        futures[0].set_result(None)
+        callback.assert_not_called()
+
+        # Failed jobs also count as finished
+        futures[1].set_exception(Exception("Error rendering"))
+        callback.assert_called_once_with("initial")
+
+    def test_when_done_no_jobs(self):
+        callback = MagicMock()
+        invoice_builder.InvoicePipeline().when_done([], callback, "initial")
+
+        callback.assert_called_once_with("initial")
+
+    def test_submit(self):
+        pipeline = invoice_builder.InvoicePipeline()
+        self.assertEquals(3, pipeline.submit(lambda x: x + 1, 2).result(timeout=5))
@@ -20,10 +20,13 @@
 
 
 from collections import namedtuple
+from datetime import datetime, timedelta
+from importlib import reload
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import MagicMock, call
 from parameterized import parameterized
 
@@ -55,7 +58,13 @@ def createMail(i):
 
 
 def createUsers(*args):
-    return [namedtuple("User", ["email"])(createMail(x)) for x in args]
+    return [namedtuple("User", ["username", "email"])(createMail(x), createMail(x)) for x in args]
+
+
+def queriedValues(model, field):
+    # Bulk queries are made once with the distinct values
+    model.objects.filter.assert_called_once()
+    return sorted(model.objects.filter.call_args[1][field])
 
 
 def createReport(ids, owner=1, stakeholders=None):
@@ -114,7 +123,7 @@ def RSSUrl():
 def setUp():
     # Libraries
     payout_engine.threading = MagicMock()
-    payout_engine.requests = MagicMock()
+    payout_engine.get_http_session = MagicMock()
     payout_engine.Payout = MagicMock()
 
     # Models
@@ -136,17 +145,17 @@ class PayoutWatcherTestCase(TestCase):
         setUp()
 
     def test_mark_as_paid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 200
-        payout_engine.requests.patch().json.return_value = [{"test": "case"}]
+        watcher = payout_engine.PayoutWatcher([])
+        payout_engine.get_http_session().patch().status_code = 200
+        payout_engine.get_http_session().patch().json.return_value = [{"test": "case"}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.get_http_session().patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.get_http_session().patch.assert_called_once_with(
             url,
             json=[{"op": "replace", "path": "/paid", "value": True}],
             headers={
@@ -157,22 +166,22 @@ class PayoutWatcherTestCase(TestCase):
             },
         )
 
-        payout_engine.requests.patch().json.assert_called_once_with()
+        payout_engine.get_http_session().patch().json.assert_called_once_with()
 
         assert result == [{"test": "case"}]
 
     def test_mark_as_paid_error(self):
-        watcher = payout_engine.PayoutWatcher([], [])
-        payout_engine.requests.patch().status_code = 404
-        payout_engine.requests.patch().json.return_value = [{"test": "case"}]
+        watcher = payout_engine.PayoutWatcher([])
+        payout_engine.get_http_session().patch().status_code = 404
+        payout_engine.get_http_session().patch().json.return_value = [{"test": "case"}]
 
-        payout_engine.requests.patch.reset_mock()
+        payout_engine.get_http_session().patch.reset_mock()
 
         result = watcher._mark_as_paid("report1")
 
         url = "{}/rss/settlement/reports/{}".format(RSSUrl(), "report1")
 
-        payout_engine.requests.patch.assert_called_once_with(
+        payout_engine.get_http_session().patch.assert_called_once_with(
             url,
             json=[{"op": "replace", "path": "/paid", "value": True}],
             headers={
@@ -183,12 +192,12 @@ class PayoutWatcherTestCase(TestCase):
             },
         )
 
-        payout_engine.requests.patch().json.assert_not_called()
+        payout_engine.get_http_session().patch().json.assert_not_called()
 
         assert result == []
 
     def test_update_status(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         payout = MagicMock()
         watcher._update_status(payout)
 
@@ -196,7 +205,7 @@ class PayoutWatcherTestCase(TestCase):
         payout["batch_header"].__getitem__.assert_has_calls([call("payout_batch_id"), call("batch_status")])
 
     def test_get_semi_paid_correct(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         payout_engine.ReportSemiPaid.objects.get.return_value = "reportobject"
 
         report = watcher._safe_get_semi_paid("report1")
@@ -205,7 +214,7 @@ class PayoutWatcherTestCase(TestCase):
         assert report == "reportobject"
 
     def test_get_semi_paid_not_exist(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
 
         watcher._safe_get_semi_paid("report1")
@@ -215,7 +224,7 @@ class PayoutWatcherTestCase(TestCase):
         payout_engine.ReportSemiPaid().save.assert_called_once_with()
 
     def test_get_semi_paid_from_item(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         payout_engine.ReportSemiPaid.objects.get.return_value = "reportobject"
 
         report = watcher._safe_get_semi_paid_from_item({"payout_item": {"sender_item_id": "report1_123"}})
@@ -224,7 +233,7 @@ class PayoutWatcherTestCase(TestCase):
         assert report == "reportobject"
 
     def test_get_semi_paid_from_item_not_exist(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
 
         watcher._safe_get_semi_paid_from_item({"payout_item": {"sender_item_id": "report1_123"}})
@@ -233,8 +242,20 @@ class PayoutWatcherTestCase(TestCase):
         payout_engine.ReportSemiPaid.assert_called_once_with(report="report1")
         payout_engine.ReportSemiPaid().save.assert_called_once_with()
 
+    def test_get_semi_paid_reports(self):
+        watcher = payout_engine.PayoutWatcher([])
+        semipaid = ReportSemiPaid(1)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = [semipaid]
+
+        semipaids = watcher._safe_get_semi_paid_reports([1, 2])
+
+        self.assertEquals([1, 2], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals({1: semipaid, 2: payout_engine.ReportSemiPaid()}, semipaids)
+        payout_engine.ReportSemiPaid.assert_any_call(report=2)
+        payout_engine.ReportSemiPaid().save.assert_called_once_with()
+
     def test_analyze_item_status_error_not_notify(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         semipaid = ReportSemiPaid()
 
         payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
@@ -250,7 +271,7 @@ class PayoutWatcherTestCase(TestCase):
         watcher.notifications.send_payout_error.assert_not_called()
 
     def test_analyze_item_status_error_clean_semipaid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         semipaid = ReportSemiPaid(
             1,
             ["user1@email.com", "user2@email.com"],
@@ -271,7 +292,7 @@ class PayoutWatcherTestCase(TestCase):
 
     @parameterized.expand(["DENIED", "PENDING", "UNCLAIMED", "RETURNED", "ONHOLD", "BLOCKED", "FAILED"])
     def test_analyze_item_status_error_notify(self, status):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         semipaid = ReportSemiPaid()
 
         payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
@@ -287,7 +308,7 @@ class PayoutWatcherTestCase(TestCase):
         watcher.notifications.send_payout_error.assert_called_once_with("user1@email.com", "An error")
 
     def test_analyze_item_correct(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         semipaid = ReportSemiPaid()
         payout_engine.ReportSemiPaid.objects.get.return_value = semipaid
 
@@ -301,7 +322,7 @@ class PayoutWatcherTestCase(TestCase):
         semipaid.save.assert_called_once_with()
 
     def test_analyze_item_correct_fix_semipaid(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         semipaid = ReportSemiPaid(
             1,
             ["user1@email.com", "user2@email.com"],
@@ -323,17 +344,16 @@ class PayoutWatcherTestCase(TestCase):
     def test_check_reports_payout_not_finished(self):
         payout = {"items": [{"payout_item": {"sender_item_id": "9_123"}}]}
         reports = [createReport(9), createReport(10, 2)]
-        watcher = payout_engine.PayoutWatcher([], reports)
-        watcher._safe_get_semi_paid = MagicMock()
-        semipaid = ReportSemiPaid(1, ["user1@email.com", "user2@email.com"])
-        watcher._safe_get_semi_paid.return_value = semipaid
+        watcher = payout_engine.PayoutWatcher(reports)
+        semipaid = ReportSemiPaid(9, ["user1@email.com", "user2@email.com"])
+        watcher._safe_get_semi_paid_reports = MagicMock(return_value={9: semipaid})
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_called_once_with(username="user1@email.com")
-        watcher._safe_get_semi_paid.assert_called_once_with("9")
+        self.assertEquals([createMail(1)], queriedValues(payout_engine.User, "username__in"))
+        watcher._safe_get_semi_paid_reports.assert_called_once_with([9])
 
         assert semipaid.failed == ["user1@email.com"]  # Bad emails cleaned
         watcher._mark_as_paid.assert_not_called()
@@ -344,22 +364,21 @@ class PayoutWatcherTestCase(TestCase):
         # Only owner and it is in the report in success, so it is full paid
         payout = {"items": [{"payout_item": {"sender_item_id": "9_123"}}]}
         reports = [createReport(9), createReport(10, 2)]
-        watcher = payout_engine.PayoutWatcher([], reports)
+        watcher = payout_engine.PayoutWatcher(reports)
 
-        watcher._safe_get_semi_paid = MagicMock()
-        semipaid = ReportSemiPaid(1, ["user2@email.com"], ["user1@email.com"])
-        watcher._safe_get_semi_paid.return_value = semipaid
+        semipaid = ReportSemiPaid(9, ["user2@email.com"], ["user1@email.com"])
+        watcher._safe_get_semi_paid_reports = MagicMock(return_value={9: semipaid})
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_called_once_with(username="user1@email.com")
-        watcher._safe_get_semi_paid.assert_called_once_with("9")
+        self.assertEquals([createMail(1)], queriedValues(payout_engine.User, "username__in"))
+        watcher._safe_get_semi_paid_reports.assert_called_once_with([9])
 
         assert semipaid.failed == []  # Bad emails cleaned
-        watcher._mark_as_paid.assert_called_once_with("9")
+        watcher._mark_as_paid.assert_called_once_with(9)
         semipaid.delete.assert_called_once_with()
         semipaid.save.assert_not_called()
 
@@ -367,28 +386,24 @@ class PayoutWatcherTestCase(TestCase):
         # Owner success, but not stakeholders
         payout = {"items": [{"payout_item": {"sender_item_id": "9_123"}}]}
         reports = [createReport(9, 1, [2, 3]), createReport(10, 4)]
-        watcher = payout_engine.PayoutWatcher([], reports)
+        watcher = payout_engine.PayoutWatcher(reports)
 
         semipaid = ReportSemiPaid(
-            1,
+            9,
             ["user2@email.com", "user3@email.com", "notexist@email.com"],
             ["user1@email.com"],
         )
-        watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
+        watcher._safe_get_semi_paid_reports = MagicMock(return_value={9: semipaid})
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_has_calls(
-            [
-                call(username="user1@email.com"),
-                call(username="user2@email.com"),
-                call(username="user3@email.com"),
-            ]
+        self.assertEquals(
+            [createMail(1), createMail(2), createMail(3)], queriedValues(payout_engine.User, "username__in")
         )
-        watcher._safe_get_semi_paid.assert_called_once_with("9")
+        watcher._safe_get_semi_paid_reports.assert_called_once_with([9])
 
         assert semipaid.failed == [
             "user2@email.com",
@@ -402,32 +417,43 @@ class PayoutWatcherTestCase(TestCase):
         # Owner success, but not stakeholders
         payout = {"items": [{"payout_item": {"sender_item_id": "9_123"}}]}
         reports = [createReport(9, 1, [2, 3]), createReport(10, 4)]
-        watcher = payout_engine.PayoutWatcher([], reports)
+        watcher = payout_engine.PayoutWatcher(reports)
 
-        semipaid = ReportSemiPaid(1, ["notexist@email.com"], [createMail(1), createMail(2), createMail(3)])
-        watcher._safe_get_semi_paid = MagicMock(return_value=semipaid)
+        semipaid = ReportSemiPaid(9, ["notexist@email.com"], [createMail(1), createMail(2), createMail(3)])
+        watcher._safe_get_semi_paid_reports = MagicMock(return_value={9: semipaid})
 
         watcher._mark_as_paid = MagicMock()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3)
 
         watcher._check_reports_payout(payout)
 
-        payout_engine.User.objects.get.assert_has_calls(
-            [
-                call(username="user1@email.com"),
-                call(username="user2@email.com"),
-                call(username="user3@email.com"),
-            ]
+        self.assertEquals(
+            [createMail(1), createMail(2), createMail(3)], queriedValues(payout_engine.User, "username__in")
         )
-        watcher._safe_get_semi_paid.assert_called_once_with("9")
+        watcher._safe_get_semi_paid_reports.assert_called_once_with([9])
 
         assert semipaid.failed == []  # Bad emails cleaned
-        watcher._mark_as_paid.assert_called_once_with("9")
+        watcher._mark_as_paid.assert_called_once_with(9)
         semipaid.delete.assert_called_once_with()
         semipaid.save.assert_not_called()
 
+    def test_check_reports_payout_missing_user(self):
+        payout = {"items": [{"payout_item": {"sender_item_id": "9_123"}}]}
+        watcher = payout_engine.PayoutWatcher([createReport(9, 1, [2])])
+        watcher._safe_get_semi_paid_reports = MagicMock()
+        watcher._mark_as_paid = MagicMock()
+
+        payout_engine.User.DoesNotExist = ObjectDoesNotExist
+        payout_engine.User.objects.filter.return_value = createUsers(1)
+
+        with self.assertRaises(ObjectDoesNotExist):
+            watcher._check_reports_payout(payout)
+
+        watcher._safe_get_semi_paid_reports.assert_not_called()
+        watcher._mark_as_paid.assert_not_called()
+
     def test_payout_success(self):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         watcher._analyze_item = MagicMock()
         watcher._check_reports_payout = MagicMock()
 
@@ -448,14 +474,13 @@ class PayoutWatcherTestCase(TestCase):
         ]
     )
     def test_check_payout_denied(self, status, must_cont, success):
-        watcher = payout_engine.PayoutWatcher([], [])
+        watcher = payout_engine.PayoutWatcher([])
         watcher._update_status = MagicMock()
         watcher._payout_success = MagicMock()
 
         pay = {"batch_header": {"batch_status": status}}
         payout_engine.Payout.find.return_value = pay
-        payout = {"batch_header": {"payout_batch_id": "batchID0"}}
-        cont = watcher._check_payout(payout)
+        cont = watcher.check_payout("batchID0")
 
         assert cont == must_cont
         payout_engine.Payout.find.assert_called_once_with("batchID0")
@@ -465,21 +490,166 @@ class PayoutWatcherTestCase(TestCase):
         else:
             watcher._payout_success.assert_not_called()
 
-    def test_check_payouts(self):
-        watcher = payout_engine.PayoutWatcher(["payout1", "payout2", "payout3", "payout4"], [])
-        watcher._check_payout = MagicMock()
-        # Keep watching first and third
-        watcher._check_payout.side_effect = [True, False, True, False]
+    def test_check_payout_error(self):
+        watcher = payout_engine.PayoutWatcher([])
+        payout_engine.Payout.find.side_effect = Exception("PayPal unavailable")
+
+        with self.assertRaises(Exception):
+            watcher.check_payout("batchID0")
+
+    def test_check_payout_processing_error(self):
+        watcher = payout_engine.PayoutWatcher([])
+        watcher._update_status = MagicMock()
+        watcher._payout_success = MagicMock(side_effect=ObjectDoesNotExist("Missing user"))
+        payout_engine.Payout.find.return_value = {"batch_header": {"batch_status": "SUCCESS"}}
+
+        # A finished batch is not checked again even if its processing fails
+        self.assertFalse(watcher.check_payout("batchID0"))
+        watcher._payout_success.assert_called_once_with({"batch_header": {"batch_status": "SUCCESS"}})
+
+
+class PendingPayoutsTestCase(TestCase):
+    tags = ("payout", "payout-poller")
 
-        assert watcher.payouts == ["payout1", "payout2", "payout3", "payout4"]
-        watcher._check_payouts()
-        watcher._check_payout.assert_has_calls([call("payout1"), call("payout2"), call("payout3"), call("payout4")])
-        assert watcher.payouts == ["payout1", "payout3"]
+    def setUp(self):
+        setUp()
+        self._now = datetime(2023, 1, 1, 10, 0, 0)
+        payout_engine.datetime = MagicMock()
+        payout_engine.datetime.utcnow.return_value = self._now
 
-        watcher._check_payout.side_effect = [False, False]
-        watcher._check_payouts()
-        watcher._check_payout.assert_has_calls([call("payout1"), call("payout3")])
-        assert watcher.payouts == []
+        self._collection = payout_engine.get_database_connection()[payout_engine.PENDING_PAYOUTS_COLLECTION]
+
+    def tearDown(self):
+        reload(payout_engine)
+
+    def test_push(self):
+        payout_engine.PendingPayouts().push("batchID0", ["report1"], 5)
+
+        self._collection.insert_one.assert_called_once_with(
+            {
+                "_id": "batchID0",
+                "reports": ["report1"],
+                "attempts": 0,
+                "created": self._now,
+                "next_check": self._now + timedelta(seconds=5),
+                "claim": None,
+            }
+        )
+
+    def test_claim(self):
+        self._collection.find.return_value.sort.return_value.limit.return_value = [{"_id": "batch1"}, {"_id": "batch2"}]
+        payout_engine.uuid4 = MagicMock()
+        payout_engine.uuid4().hex = "token"
+
+        payout_engine.PendingPayouts().claim(20, 600)
+
+        self._collection.find.return_value.sort.return_value.limit.assert_called_once_with(20)
+        self._collection.update_many.assert_called_once_with(
+            {"_id": {"$in": ["batch1", "batch2"]}, "next_check": {"$lte": self._now}},
+            {"$set": {"claim": "token", "next_check": self._now + timedelta(seconds=600)}},
+        )
+        self._collection.find.assert_called_with({"claim": "token"})
+
+    def test_claim_nothing_due(self):
+        self._collection.find.return_value.sort.return_value.limit.return_value = []
+
+        self.assertEquals([], payout_engine.PendingPayouts().claim(20, 600))
+        self._collection.update_many.assert_not_called()
+
+    def test_ack(self):
+        payout_engine.PendingPayouts().ack([{"_id": "batch1", "claim": "token"}])
+
+        # Only the batches still held with the same claim are removed
+        self._collection.bulk_write.assert_called_once_with(
+            [payout_engine.DeleteOne({"_id": "batch1", "claim": "token"})], ordered=False
+        )
+
+    def test_retry(self):
+        payout_engine.PendingPayouts().retry(
+            [{"_id": "batch1", "attempts": 0, "claim": "token"}, {"_id": "batch2", "attempts": 7, "claim": "token"}],
+            5,
+            600,
+        )
+
+        # The delay doubles after every check up to the max interval
+        self._collection.bulk_write.assert_called_once_with(
+            [
+                payout_engine.UpdateOne(
+                    {"_id": "batch1", "claim": "token"},
+                    {"$set": {"attempts": 1, "next_check": self._now + timedelta(seconds=10), "claim": None}},
+                ),
+                payout_engine.UpdateOne(
+                    {"_id": "batch2", "claim": "token"},
+                    {"$set": {"attempts": 8, "next_check": self._now + timedelta(seconds=600), "claim": None}},
+                ),
+            ],
+            ordered=False,
+        )
+
+
+@override_settings(
+    PAYOUT_POLL_INTERVAL=5, PAYOUT_POLL_MAX_INTERVAL=600, PAYOUT_POLL_BUDGET=20, PAYOUT_POLL_MAX_AGE=3600
+)
+class PayoutPollerTestCase(TestCase):
+    tags = ("payout", "payout-poller")
+
+    def setUp(self):
+        setUp()
+        payout_engine.PendingPayouts = MagicMock()
+        payout_engine.PayoutWatcher = MagicMock()
+
+    def tearDown(self):
+        reload(payout_engine)
+
+    def test_watch_payout(self):
+        payout_engine.PayoutPoller = MagicMock()
+
+        payout_engine.watch_payout("batchID0", ["report1"])
+
+        payout_engine.PendingPayouts().push.assert_called_once_with("batchID0", ["report1"], 5)
+        payout_engine.PayoutPoller.assert_not_called()
+
+    def test_poll(self):
+        now = datetime.utcnow()
+        docs = {
+            payout_id: {"_id": payout_id, "reports": ["report1"], "created": created}
+            for payout_id, created in [
+                ("finished", now),
+                ("pending", now),
+                ("error", now),
+                ("expired", now - timedelta(seconds=7200)),
+            ]
+        }
+        payout_engine.PendingPayouts().claim.return_value = list(docs.values())
+
+        def check_payout(payout_id):
+            if payout_id == "error":
+                raise Exception("PayPal unavailable")
+
+            return payout_id == "pending"
+
+        payout_engine.PayoutWatcher().check_payout.side_effect = check_payout
+
+        checked = payout_engine.PayoutPoller().poll()
+
+        self.assertEquals(4, checked)
+        payout_engine.PendingPayouts().claim.assert_called_once_with(20, 600)
+
+        # Expired batches are not checked
+        self.assertEquals(
+            [call("finished"), call("pending"), call("error")],
+            payout_engine.PayoutWatcher().check_payout.call_args_list,
+        )
+        payout_engine.PendingPayouts().ack.assert_called_once_with([docs["finished"], docs["expired"]])
+        payout_engine.PendingPayouts().retry.assert_called_once_with([docs["pending"], docs["error"]], 5, 600)
+
+    def test_poll_nothing_due(self):
+        payout_engine.PendingPayouts().claim.return_value = []
+
+        self.assertEquals(0, payout_engine.PayoutPoller().poll())
+        payout_engine.PayoutWatcher.assert_not_called()
+        payout_engine.PendingPayouts().ack.assert_not_called()
+        payout_engine.PendingPayouts().retry.assert_not_called()
 
 
 class PayoutEngineTestCase(TestCase):
@@ -487,25 +657,25 @@ class PayoutEngineTestCase(TestCase):
 
     def setUp(self):
         setUp()
-        self.oldPayoutWatcher = payout_engine.PayoutWatcher
-        payout_engine.PayoutWatcher = MagicMock()
+        self.oldWatchPayout = payout_engine.watch_payout
+        payout_engine.watch_payout = MagicMock()
         self.reference = "__payout__engine__context__lock__"
 
     def tearDown(self):
-        payout_engine.PayoutWatcher = self.oldPayoutWatcher  # Recover the original implementation
+        payout_engine.watch_payout = self.oldWatchPayout  # Recover the original implementation
 
     def test_get_reports_not_paid(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.requests.get().status_code = 200
-        payout_engine.requests.get().json.return_value = [{"test": "case"}]
+        payout_engine.get_http_session().get().status_code = 200
+        payout_engine.get_http_session().get().json.return_value = [{"test": "case"}]
 
-        payout_engine.requests.get.reset_mock()
+        payout_engine.get_http_session().get.reset_mock()
 
         result = engine._get_reports()
 
         url = "{}/rss/settlement/reports".format(RSSUrl())
 
-        payout_engine.requests.get.assert_called_once_with(
+        payout_engine.get_http_session().get.assert_called_once_with(
             url,
             params={
                 "aggregatorId": None,
@@ -521,7 +691,7 @@ class PayoutEngineTestCase(TestCase):
             },
         )
 
-        payout_engine.requests.get().json.assert_called_once_with()
+        payout_engine.get_http_session().get().json.assert_called_once_with()
 
         assert result == [{"test": "case"}]
 
@@ -548,13 +718,13 @@ class PayoutEngineTestCase(TestCase):
 
         assert new_reports == {}
 
-        payout_engine.ReportSemiPaid.objets.get.assert_not_called()
-        payout_engine.User.objets.get.assert_not_called()
+        payout_engine.ReportSemiPaid.objects.filter.assert_not_called()
+        payout_engine.User.objects.filter.assert_not_called()
 
     def test_process_reports_simple(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = []
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         reports = [
             {
@@ -570,8 +740,8 @@ class PayoutEngineTestCase(TestCase):
 
         # Just one report
         assert new_reports == {"EUR": {"user1@email.com": [(10, 1)]}}
-        payout_engine.ReportSemiPaid.objects.get.assert_called_once_with(report=1)
-        payout_engine.User.objects.get.assert_called_once_with(username=createMail(1))
+        self.assertEquals([1], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals([createMail(1)], queriedValues(payout_engine.User, "username__in"))
 
     @parameterized.expand(
         [
@@ -587,8 +757,8 @@ class PayoutEngineTestCase(TestCase):
     )
     def test_process_reports_multiple_pays_user(self, currencies, result):
         engine = payout_engine.PayoutEngine()
-        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 1)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = []
+        payout_engine.User.objects.filter.return_value = createUsers(1, 1)
 
         reports = [
             {
@@ -611,13 +781,13 @@ class PayoutEngineTestCase(TestCase):
         new_reports = engine._process_reports(reports)
 
         assert new_reports == result
-        payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(1))])
+        self.assertEquals([1, 2], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals([createMail(1)], queriedValues(payout_engine.User, "username__in"))
 
     def test_process_reports_with_stakeholders(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.ReportSemiPaid.objects.get.side_effect = ObjectDoesNotExist()
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3, 2, 1)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = []
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3, 2, 1)
 
         reports = [
             {
@@ -650,21 +820,15 @@ class PayoutEngineTestCase(TestCase):
                 "user3@email.com": [(4, 1)],
             }
         }
-        payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1), call(report=2)])
-        payout_engine.User.objects.get.assert_has_calls(
-            [
-                call(username=createMail(1)),
-                call(username=createMail(2)),
-                call(username=createMail(3)),
-                call(username=createMail(2)),
-                call(username=createMail(1)),
-            ]
+        self.assertEquals([1, 2], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals(
+            [createMail(1), createMail(2), createMail(3)], queriedValues(payout_engine.User, "username__in")
         )
 
     def test_process_reports_user_in_semipaid(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1)])
-        payout_engine.User.objects.get.side_effect = createUsers(1)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = [ReportSemiPaid(1, None, [createMail(1)])]
+        payout_engine.User.objects.filter.return_value = createUsers(1)
 
         reports = [
             {
@@ -680,13 +844,15 @@ class PayoutEngineTestCase(TestCase):
         new_reports = engine._process_reports(reports)
 
         assert new_reports == {}
-        payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1))])
+        self.assertEquals([1], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals([createMail(1)], queriedValues(payout_engine.User, "username__in"))
 
     def test_process_reports_user_in_semipaid_and_stakeholders(self):
         engine = payout_engine.PayoutEngine()
-        payout_engine.ReportSemiPaid.objects.get.return_value = ReportSemiPaid(1, None, [createMail(1), createMail(3)])
-        payout_engine.User.objects.get.side_effect = createUsers(1, 2, 3)
+        payout_engine.ReportSemiPaid.objects.filter.return_value = [
+            ReportSemiPaid(1, None, [createMail(1), createMail(3)])
+        ]
+        payout_engine.User.objects.filter.return_value = createUsers(1, 2, 3)
 
         reports = [
             {
@@ -705,8 +871,10 @@ class PayoutEngineTestCase(TestCase):
         new_reports = engine._process_reports(reports)
 
         assert new_reports == {"EUR": {"user2@email.com": [(5, 1)]}}
-        payout_engine.ReportSemiPaid.objects.get.assert_has_calls([call(report=1)])
-        payout_engine.User.objects.get.assert_has_calls([call(username=createMail(1)), call(username=createMail(2))])
+        self.assertEquals([1], queriedValues(payout_engine.ReportSemiPaid, "report__in"))
+        self.assertEquals(
+            [createMail(1), createMail(2), createMail(3)], queriedValues(payout_engine.User, "username__in")
+        )
 
     def test_process_payouts_create_lock(self):
         engine = payout_engine.PayoutEngine()
@@ -885,21 +1053,27 @@ class PayoutEngineTestCase(TestCase):
         engine._process_reports.assert_called_once_with([])
         engine._process_payouts.assert_called_once_with("returned")
         payout_engine.ReportsPayout.assert_not_called()
-        payout_engine.PayoutWatcher.assert_not_called()
+        payout_engine.watch_payout.assert_not_called()
 
     def test_process_reports_single_payout(self):
         engine = payout_engine.PayoutEngine()
         engine._process_reports = MagicMock()
-        payout1 = {"batch_header": {"payout_batch_id": "payoutId", "batch_status": "SUCCESS"}}
+        payout1 = {
+            "batch_header": {"payout_batch_id": "payoutId", "batch_status": "SUCCESS"},
+            "items": [{"sender_item_id": "1_10"}, {"sender_item_id": "1_11"}],
+        }
         payouts = [(payout1, True)]
         engine._process_payouts = MagicMock(return_value=payouts)
-        rpayout = ReportsPayout(["report1"], "payoutId", "SUCCESS", MagicMock())
+        reports = [{"id": 1}, {"id": 2}]
+        rpayout = ReportsPayout(reports, "payoutId", "SUCCESS", MagicMock())
         payout_engine.ReportsPayout.return_value = rpayout
-        engine.process_reports(["report1"])
+        engine.process_reports(reports)
 
-        payout_engine.ReportsPayout.assert_called_once_with(reports=["report1"], payout_id="payoutId", status="SUCCESS")
+        payout_engine.ReportsPayout.assert_called_once_with(reports=reports, payout_id="payoutId", status="SUCCESS")
         rpayout.save.assert_called_once_with()
-        payout_engine.PayoutWatcher.assert_called_once_with([payout1], ["report1"])
+
+        # Only the reports of the batch are watched
+        payout_engine.watch_payout.assert_called_once_with("payoutId", [{"id": 1}])
 
     def test_process_reports_complex(self):
         engine = payout_engine.PayoutEngine()
@@ -907,23 +1081,27 @@ class PayoutEngineTestCase(TestCase):
         payout = {"batch_header": {"payout_batch_id": "payoutId", "batch_status": "SUCCESS"}}
         err_payout = {"sender_batch_header": {"sender_batch_id": "BATCHID"}}
         payouts = [
-            (payout.copy(), True),
+            (dict(payout, items=[{"sender_item_id": "1_10"}]), True),
             (err_payout.copy(), False),
-            (payout.copy(), True),
+            (dict(payout, items=[{"sender_item_id": "2_11"}, {"sender_item_id": "3_12"}]), True),
         ]
         engine._process_payouts = MagicMock(return_value=payouts)
-        rpayout = ReportsPayout(["report1"], "payoutId", "SUCCESS", MagicMock())
+        reports = [{"id": 1}, {"id": 2}, {"id": 3}]
+        rpayout = ReportsPayout(reports, "payoutId", "SUCCESS", MagicMock())
         payout_engine.ReportsPayout.return_value = rpayout
-        engine.process_reports(["report1"])
+        engine.process_reports(reports)
 
         payout_engine.ReportsPayout.assert_has_calls(
             [
-                call(reports=["report1"], payout_id="payoutId", status="SUCCESS"),
-                call(reports=["report1"], payout_id="payoutId", status="SUCCESS"),
+                call(reports=reports, payout_id="payoutId", status="SUCCESS"),
+                call(reports=reports, payout_id="payoutId", status="SUCCESS"),
             ]
         )
         rpayout.save.assert_has_calls([call(), call()])
-        payout_engine.PayoutWatcher.assert_called_once_with([payout.copy(), payout.copy()], ["report1"])
+        self.assertEquals(
+            [call("payoutId", [{"id": 1}]), call("payoutId", [{"id": 2}, {"id": 3}])],
+            payout_engine.watch_payout.call_args_list,
+        )
 
     def test_process_unpaid(self):
         # Process unpaid just ask for unpaids and process them
@@ -31,18 +31,20 @@ from wstore.asset_manager.resource_plugins.decorators import on_product_acquired
 from wstore.charging_engine.charging.cdr_manager import CDRManager
 from wstore.charging_engine.charging_engine import ChargingEngine
 from wstore.ordering.errors import PaymentError
-from wstore.ordering.inventory_client import InventoryClient
+from wstore.ordering.inventory_client import AsyncInventoryClient, InventoryClient
 from wstore.ordering.models import Offering, Order
 from wstore.ordering.ordering_client import OrderingClient
+from wstore.store_commons.async_client import run_concurrently
 from wstore.store_commons.database import get_database_connection
 from wstore.store_commons.resource import Resource
 from wstore.store_commons.utils.http import authentication_required, build_response, supported_request_mime_types
+from wstore.store_commons.utils.identity_map import get_object
 
 
 class PayPalConfirmation(Resource):
     def _set_initial_states(self, transactions, raw_order, order):
         def is_digital_contract(contract):
-            off = Offering.objects.get(pk=ObjectId(contract.offering))
+            off = get_object(Offering, ObjectId(contract.offering))
             return off.is_digital
 
         # Set all order items as in progress
@@ -62,13 +64,26 @@ class PayPalConfirmation(Resource):
         self.ordering_client.update_items_state(raw_order, "Completed", digital_items)
 
     def _set_renovation_states(self, transactions, raw_order, order):
-        inventory_client = InventoryClient()
+        inventory_client = AsyncInventoryClient(InventoryClient())
 
+        contracts = []
         for transaction in transactions:
             try:
-                contract = order.get_item_contract(transaction["item"])
-                inventory_client.activate_product(contract.product_id)
+                contracts.append(order.get_item_contract(transaction["item"]))
+            except:
+                pass
+
+        # Products are independent, so all of them are activated at the same time
+        results = run_concurrently(
+            *[inventory_client.activate_product(contract.product_id) for contract in contracts],
+            return_exceptions=True,
+        )
 
+        for contract, result in zip(contracts, results):
+            if isinstance(result, BaseException):
+                continue
+
+            try:
                 # Activate the product
                 on_product_acquired(order, contract)
             except:
@@ -24,8 +24,8 @@ from bson import ObjectId
 from django.core.management.base import BaseCommand, CommandError
 
 from wstore.models import Context, Organization
-from wstore.rss_adaptor.rss_adaptor import RSSAdaptor
-from wstore.store_commons.database import get_database_connection
+from wstore.rss_adaptor.cdr_outbox import CDROutbox, CDRShipper
+from wstore.rss_adaptor.correlation import reserve_correlation_numbers
 
 
 class Command(BaseCommand):
@@ -37,30 +37,41 @@ class Command(BaseCommand):
         if len(contexts) < 1:
             raise CommandError("No context")
 
+        # CDRs failed before the outbox existed are still saved in the context
         context = contexts[0]
-        cdrs = context.failed_cdrs
+        legacy_cdrs = context.failed_cdrs
         context.failed_cdrs = []
         context.save()
 
+        outbox = CDROutbox()
+        failed = outbox.get_failed()
+
+        cdrs = legacy_cdrs + [doc["cdr"] for doc in failed]
         if len(cdrs) == 0:
             print("No failed cdrs to send")
             exit(0)
 
-        db = get_database_connection()
         time_stamp = datetime.utcnow().isoformat() + "Z"
 
+        # Group the CDRs by provider, so a block of correlation
+        # numbers is reserved for each of them
+        provider_cdrs = {}
         for cdr in cdrs:
             # Modify time_stamp
             cdr["time_stamp"] = time_stamp
+            provider_cdrs.setdefault(cdr["provider"], []).append(cdr)
+
+        for provider, prov_cdrs in provider_cdrs.items():
+            org = Organization.objects.get(name=provider)
 
-            # Modify correlation number
-            org = Organization.objects.get(name=cdr["provider"])
+            for cdr, corr_number in zip(prov_cdrs, reserve_correlation_numbers(org.pk, len(prov_cdrs))):
+                cdr["correlation"] = str(corr_number)
 
-            new_org = db.wstore_organization.find_and_modify(
-                query={"_id": org.pk}, update={"$inc": {"correlation_number": 1}}
-            )
+        if len(failed):
+            outbox.requeue(failed)
 
-            cdr["correlation"] = new_org["correlation_number"]
+        outbox.push(legacy_cdrs)
 
-        r = RSSAdaptor()
-        r.send_cdr(cdrs)
+        # The command process does not live enough for a background shipper
+        sent = CDRShipper().ship()
+        print("{} cdrs sent, outbox status: {}".format(sent, outbox.get_depth()))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import BaseCommand
+
+from wstore.charging_engine.accounting.usage_rater import UsageRater
+
+
+class Command(BaseCommand):
+    def handle(self, *args, **kargs):
+        """
+        Send again the usage ratings that failed
+        """
+        sent, failed = UsageRater().retry_failed()
+
+        if sent + failed == 0:
+            print("No failed usage ratings to send")
+        else:
+            print("{} usage ratings sent, {} failed".format(sent, failed))
@@ -37,10 +37,18 @@ class Command(BaseCommand):
         context_id = contexts[0].pk
 
         # Context object is locked in order to avoid possible inconsistencies
-        # in the list of pending upgrade notifications
-        lock = DocumentLock("wstore_context", context_id, "ctx")
+        # in the list of pending upgrade notifications. Upgrades may take longer
+        # than the lease of the lock, so it is renewed while it is held
+        lock = DocumentLock("wstore_context", context_id, "ctx", heartbeat=True)
         lock.wait_document()
 
+        try:
+            self._resend_upgrades(context_id)
+        finally:
+            # Release Context object
+            lock.unlock_document()
+
+    def _resend_upgrades(self, context_id):
         context = Context.objects.get(pk=context_id)
 
         # Get pending product notifications and resend them
@@ -72,6 +80,3 @@ class Command(BaseCommand):
 
         context.failed_upgrades = failed_upgrades
         context.save()
-
-        # Release Context object
-        lock.unlock_document()
@@ -20,12 +20,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from importlib import reload
+
 from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.test import TestCase
 from mock import ANY, MagicMock, call
 from parameterized import parameterized
-from wstore.management.commands import downgradeplugin, loadplugin, removeplugin, resend_upgrade
+
+from wstore.management.commands import (
+    build_entitlements,
+    downgradeplugin,
+    loadplugin,
+    removeplugin,
+    resend_upgrade,
+    resume_upgrades,
+)
 
 
 class FakeCommandError(Exception):
@@ -190,7 +200,7 @@ class ResendUpgradeTestCase(TestCase):
 
         self.assertEquals(0, resend_upgrade.InventoryUpgrader.call_count)
 
-        resend_upgrade.DocumentLock.assert_called_once_with("wstore_context", self._ctx_pk, "ctx")
+        resend_upgrade.DocumentLock.assert_called_once_with("wstore_context", self._ctx_pk, "ctx", heartbeat=True)
         self._lock_inst.wait_document.assert_called_once_with()
         self._lock_inst.unlock_document.assert_called_once_with()
 
@@ -243,10 +253,20 @@ class ResendUpgradeTestCase(TestCase):
         # Validate that the lambda method passed to the upgrader is working properly
         self.assertEquals("1", self._passed_method("1"))
 
-        resend_upgrade.DocumentLock.assert_called_once_with("wstore_context", self._ctx_pk, "ctx")
+        resend_upgrade.DocumentLock.assert_called_once_with("wstore_context", self._ctx_pk, "ctx", heartbeat=True)
         self._lock_inst.wait_document.assert_called_once_with()
         self._lock_inst.unlock_document.assert_called_once_with()
 
+    def test_resend_upgrades_error_unlocked(self):
+        self._ctx_inst.failed_upgrades = [{"asset_id": "1", "pending_offerings": ["1"], "pending_products": []}]
+        resend_upgrade.Resource.objects.get.side_effect = Exception("Not found")
+
+        with self.assertRaises(Exception):
+            call_command("resend_upgrade")
+
+        self._ctx_inst.save.assert_not_called()
+        self._lock_inst.unlock_document.assert_called_once_with()
+
     def test_pending_upgrades_no_context(self):
         resend_upgrade.Context.objects.all.return_value = []
 
@@ -256,3 +276,50 @@ class ResendUpgradeTestCase(TestCase):
             msg = str(e)
 
         self.assertEquals("Context object is not yet created", msg)
+
+
+class ResumeUpgradesTestCase(TestCase):
+    tags = ("management", "upgrades")
+
+    def setUp(self):
+        self._upgraders = [MagicMock(), MagicMock()]
+        resume_upgrades.InventoryUpgrader = MagicMock()
+        resume_upgrades.InventoryUpgrader.resume_upgrades.return_value = self._upgraders
+
+    def tearDown(self):
+        reload(resume_upgrades)
+
+    def test_resume_upgrades(self):
+        call_command("resume_upgrades")
+
+        resume_upgrades.InventoryUpgrader.resume_upgrades.assert_called_once_with()
+        for upgrader in self._upgraders:
+            upgrader.join.assert_called_once_with()
+
+
+class BuildEntitlementsTestCase(TestCase):
+    tags = ("management", "entitlements")
+
+    def setUp(self):
+        build_entitlements.EntitlementIndex = MagicMock()
+        build_entitlements.Order = MagicMock()
+
+    def tearDown(self):
+        reload(build_entitlements)
+
+    @parameterized.expand(
+        [
+            ("not_built", False, [], True),
+            ("built", True, [], False),
+            ("rebuild", True, ["--rebuild"], True),
+        ]
+    )
+    def test_build_entitlements(self, name, built, args, expected):
+        build_entitlements.EntitlementIndex().is_built.return_value = built
+
+        call_command("build_entitlements", *args)
+
+        if expected:
+            build_entitlements.EntitlementIndex().build.assert_called_once_with(build_entitlements.Order.objects.all())
+        else:
+            build_entitlements.EntitlementIndex().build.assert_not_called()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime
+from logging import getLogger
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+
+from wstore.ordering.models import Offering
+from wstore.store_commons.database import get_database_connection
+
+logger = getLogger("wstore.default_logger")
+
+ENTITLEMENTS_COLLECTION = "wstore_entitlements"
+
+# Document saved once the index has been built from the existing orders
+BUILT_MARKER = "_built"
+
+# Once built, the index is never removed, so the check is cached per process
+_built = False
+
+
+class EntitlementIndex:
+    """
+    Index of the digital assets an organization is allowed to download. Each entry
+    contains the contracts granting the access, so it is revoked once all of them
+    are terminated
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[ENTITLEMENTS_COLLECTION]
+
+    @staticmethod
+    def get_offering_assets(offering_pk):
+        """
+        Returns the primary keys of the digital assets included in an offering, expanding
+        offering and product bundles
+        """
+        offering = Offering.objects.get(pk=ObjectId(offering_pk))
+
+        offering_assets = []
+        if len(offering.bundled_offerings) > 0:
+            for bundled_pk in offering.bundled_offerings:
+                bundled = Offering.objects.get(pk=ObjectId(bundled_pk))
+                if bundled.is_digital:
+                    offering_assets.append(bundled.asset)
+
+        elif offering.is_digital:
+            offering_assets = [offering.asset]
+
+        asset_pks = []
+        for asset in offering_assets:
+            if len(asset.bundled_assets) > 0:
+                asset_pks.extend(str(asset_pk) for asset_pk in asset.bundled_assets)
+            else:
+                asset_pks.append(str(asset.pk))
+
+        return asset_pks
+
+    def _get_entry_id(self, org_pk, asset_pk):
+        return "{}:{}".format(org_pk, asset_pk)
+
+    def _get_source(self, order, contract):
+        return "{}:{}".format(order.pk, contract.item_id)
+
+    def grant(self, order, contract, asset_pks=None):
+        """
+        Grants the owner organization of an order access to the assets of an acquired contract
+        """
+        if asset_pks is None:
+            asset_pks = self.get_offering_assets(contract.offering)
+
+        org_pk = str(order.owner_organization.pk)
+        source = self._get_source(order, contract)
+
+        operations = [
+            UpdateOne(
+                {"_id": self._get_entry_id(org_pk, asset_pk)},
+                {"$set": {"organization": org_pk, "asset": asset_pk}, "$addToSet": {"sources": source}},
+                upsert=True,
+            )
+            for asset_pk in asset_pks
+        ]
+
+        if len(operations):
+            self._collection.bulk_write(operations, ordered=False)
+
+    def revoke(self, order, contract):
+        """
+        Removes the access granted by a terminated contract
+        """
+        self._collection.update_many(
+            {"organization": str(order.owner_organization.pk), "sources": self._get_source(order, contract)},
+            {"$pull": {"sources": self._get_source(order, contract)}},
+        )
+
+    def is_granted(self, org_pk, asset_pk):
+        entry = self._collection.find_one(
+            {"_id": self._get_entry_id(org_pk, asset_pk), "sources.0": {"$exists": True}}, projection={"_id": True}
+        )
+        return entry is not None
+
+    def is_built(self):
+        global _built
+
+        if not _built:
+            _built = self._collection.find_one({"_id": BUILT_MARKER}) is not None
+
+        return _built
+
+    def build(self, orders):
+        """
+        Creates the entries of the active contracts of the given orders whose offering has
+        been acquired, used to initialize the index
+        """
+        self._collection.create_index([("organization", ASCENDING), ("sources", ASCENDING)])
+
+        offering_assets = {}
+        for order in orders:
+            acquired = order.owner_organization.acquired_offerings
+
+            for contract in order.get_contracts():
+                if contract.terminated or contract.offering not in acquired:
+                    continue
+
+                if contract.offering not in offering_assets:
+                    offering_assets[contract.offering] = self.get_offering_assets(contract.offering)
+
+                self.grant(order, contract, asset_pks=offering_assets[contract.offering])
+
+        self._collection.update_one({"_id": BUILT_MARKER}, {"$set": {"date": datetime.utcnow()}}, upsert=True)
+        logger.info("Entitlement index built")
@@ -22,10 +22,12 @@
 from datetime import datetime
 from urllib.parse import urljoin
 
-import requests
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from wstore.store_commons.async_client import AsyncClient
+from wstore.store_commons.http_session import get_http_session
+
 
 class InventoryClient:
     def __init__(self):
@@ -38,7 +40,7 @@ class InventoryClient:
         return urljoin(site, "charging/api/orderManagement/products")
 
     def get_hubs(self):
-        r = requests.get(self._inventory_api + "/api/productInventory/v2/hub")
+        r = get_http_session().get(self._inventory_api + "/api/productInventory/v2/hub")
         r.raise_for_status()
         return r.json()
 
@@ -55,7 +57,7 @@ class InventoryClient:
         else:
             callback = {"callback": callback_url}
 
-            r = requests.post(self._inventory_api + "/api/productInventory/v2/hub", json=callback)
+            r = get_http_session().post(self._inventory_api + "/api/productInventory/v2/hub", json=callback)
 
             if r.status_code != 201 and r.status_code != 409:
                 msg = "It hasn't been possible to create inventory subscription, "
@@ -66,7 +68,7 @@ class InventoryClient:
     def get_product(self, product_id):
         url = self._inventory_api + "/api/productInventory/v2/product/" + str(product_id)
 
-        r = requests.get(url)
+        r = get_http_session().get(url)
         r.raise_for_status()
 
         return r.json()
@@ -84,7 +86,7 @@ class InventoryClient:
 
         url = self._inventory_api + "/api/productInventory/v2/product" + qs[:-1]
 
-        r = requests.get(url)
+        r = get_http_session().get(url)
         r.raise_for_status()
 
         return r.json()
@@ -98,7 +100,7 @@ class InventoryClient:
         # Build product url
         url = self._inventory_api + "/api/productInventory/v2/product/" + str(product_id)
 
-        r = requests.patch(url, json=patch_body)
+        r = get_http_session().patch(url, json=patch_body)
         r.raise_for_status()
 
         return r.json()
@@ -139,3 +141,11 @@ class InventoryClient:
             "terminationDate": datetime.utcnow().isoformat() + "Z",
         }
         self.patch_product(product_id, patch_body)
+
+
+class AsyncInventoryClient(AsyncClient):
+    """
+    Coroutine version of InventoryClient, to make independent requests concurrently
+    """
+
+    client_class = InventoryClient
@@ -21,10 +21,12 @@
 
 from urllib.parse import urljoin
 
-import requests
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from wstore.store_commons.async_client import AsyncClient
+from wstore.store_commons.http_session import get_http_session
+
 
 class OrderingClient:
     def __init__(self):
@@ -41,7 +43,7 @@ class OrderingClient:
 
         callback = {"callback": urljoin(site, "charging/api/orderManagement/orders")}
 
-        r = requests.post(self._ordering_api + "/productOrdering/v2/hub", callback)
+        r = get_http_session().post(self._ordering_api + "/productOrdering/v2/hub", callback)
 
         if r.status_code != 200 and r.status_code != 409:
             msg = "It hasn't been possible to create ordering subscription, "
@@ -53,7 +55,7 @@ class OrderingClient:
         path = "/DSProductOrdering/api/productOrdering/v2/productOrder/" + str(order_id)
         url = urljoin(self._ordering_api, path)
 
-        r = requests.get(url)
+        r = get_http_session().get(url)
         r.raise_for_status()
 
         return r.json()
@@ -75,7 +77,7 @@ class OrderingClient:
         path = "/DSProductOrdering/api/productOrdering/v2/productOrder/" + str(order["id"])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_http_session().patch(url, json=patch)
 
         r.raise_for_status()
 
@@ -107,6 +109,14 @@ class OrderingClient:
         path = "/DSProductOrdering/api/productOrdering/v2/productOrder/" + str(order["id"])
         url = urljoin(self._ordering_api, path)
 
-        r = requests.patch(url, json=patch)
+        r = get_http_session().patch(url, json=patch)
 
         r.raise_for_status()
+
+
+class AsyncOrderingClient(AsyncClient):
+    """
+    Coroutine version of OrderingClient, to make independent requests concurrently
+    """
+
+    client_class = OrderingClient
@@ -26,16 +26,17 @@ from decimal import Decimal
 from logging import getLogger
 from urllib.parse import urlparse
 
-import requests
 from bson import ObjectId
 from django.conf import settings
 
 from wstore.asset_manager.product_validator import ProductValidator
 from wstore.asset_manager.resource_plugins.decorators import on_product_suspended
 from wstore.charging_engine.charging_engine import ChargingEngine
+from wstore.ordering.entitlements import EntitlementIndex
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.inventory_client import InventoryClient
 from wstore.ordering.models import Contract, Offering, Order
+from wstore.store_commons.http_session import get_http_session
 from wstore.store_commons.rollback import rollback
 
 logger = getLogger("wstore.default_logger")
@@ -47,7 +48,7 @@ class OrderingManager:
         self._validator = ProductValidator()
 
     def _download(self, url, element, item_id):
-        r = requests.get(url, verify=settings.VERIFY_REQUESTS)
+        r = get_http_session().get(url, verify=settings.VERIFY_REQUESTS)
 
         if r.status_code != 200:
             logger.error(f"The {element} specified in order item {item_id} does not exist")
@@ -271,7 +272,7 @@ class OrderingManager:
             if not self._customer.userprofile.current_organization.private:
                 headers["x-organization"] = self._customer.userprofile.current_organization.name
 
-            r = requests.get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
+            r = get_http_session().get(url, headers=headers, verify=settings.VERIFY_REQUESTS)
 
             if r.status_code != 200:
                 logger.error("Status code `{r.status_code}` at the time of retrieving the Billing Address")
@@ -423,6 +424,8 @@ class OrderingManager:
             contract.terminated = True
             order.save()
 
+            EntitlementIndex().revoke(order, contract)
+
             # Terminate product in the inventory
             client.terminate_product(product["id"])
 
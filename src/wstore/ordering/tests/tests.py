@@ -21,6 +21,7 @@
 
 from copy import deepcopy
 from datetime import datetime
+from importlib import reload
 from urllib.parse import urlparse
 
 from bson.objectid import ObjectId
@@ -28,11 +29,12 @@ from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.utils import override_settings
-from mock import MagicMock, call
+from mock import ANY, MagicMock, call
 from parameterized import parameterized
+from pymongo import UpdateOne
 
 from wstore.models import Organization
-from wstore.ordering import inventory_client, ordering_client, ordering_management
+from wstore.ordering import entitlements, inventory_client, ordering_client, ordering_management
 from wstore.ordering.errors import OrderingError
 from wstore.ordering.models import Contract, Offering, Order
 from wstore.ordering.tests.test_data import *
@@ -76,7 +78,7 @@ class OrderingManagementTestCase(TestCase):
         ordering_management.ChargingEngine.return_value = self._charging_inst
 
         # Mock requests
-        ordering_management.requests = MagicMock()
+        ordering_management.get_http_session = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.side_effect = [
@@ -85,7 +87,7 @@ class OrderingManagementTestCase(TestCase):
             CUSTOMER_ACCOUNT,
             CUSTOMER,
         ]
-        ordering_management.requests.get.return_value = self._response
+        ordering_management.get_http_session().get.return_value = self._response
 
         # Mock organization model
         self._org_inst = MagicMock()
@@ -285,7 +287,7 @@ class OrderingManagementTestCase(TestCase):
         valid_response.json.side_effect = [OFFERING]
         invalid_response = MagicMock()
         invalid_response.status_code = 400
-        ordering_management.requests.get.side_effect = [
+        ordering_management.get_http_session().get.side_effect = [
             valid_response,
             invalid_response,
         ]
@@ -314,7 +316,7 @@ class OrderingManagementTestCase(TestCase):
                 result.status_code = 404
             return result
 
-        ordering_management.requests.get = get
+        ordering_management.get_http_session().get = get
 
     def _already_owned(self):
         self._offering_inst.pk = "61004aba5e05acc115f022f0"
@@ -558,7 +560,7 @@ class OrderingManagementTestCase(TestCase):
             ordering_management.ChargingEngine.assert_called_once_with(self._order_inst)
 
             # Check offering and product downloads
-            self.assertEquals(4, ordering_management.requests.get.call_count)
+            self.assertEquals(4, ordering_management.get_http_session().get.call_count)
 
             headers = {"Authorization": "Bearer " + self._customer.userprofile.access_token}
             exp_url = "http://extpath.com:8080{}"
@@ -585,7 +587,7 @@ class OrderingManagementTestCase(TestCase):
                         verify=True,
                     ),
                 ],
-                ordering_management.requests.get.call_args_list,
+                ordering_management.get_http_session().get.call_args_list,
             )
 
             contact_medium = CUSTOMER["contactMedium"][0]["medium"]
@@ -730,13 +732,13 @@ class OrderingClientTestCase(TestCase):
         ordering_client.settings.LOCAL_SITE = "http://testdomain.com"
 
         # Mock requests
-        ordering_client.requests = MagicMock()
+        ordering_client.get_http_session = MagicMock()
         self._response = MagicMock()
         self._response.status_code = 200
         self._response.json.return_value = {"id": "1"}
-        ordering_client.requests.post.return_value = self._response
-        ordering_client.requests.patch.return_value = self._response
-        ordering_client.requests.get.return_value = self._response
+        ordering_client.get_http_session().post.return_value = self._response
+        ordering_client.get_http_session().patch.return_value = self._response
+        ordering_client.get_http_session().get.return_value = self._response
 
     def test_ordering_subscription(self):
         client = ordering_client.OrderingClient()
@@ -744,7 +746,7 @@ class OrderingClientTestCase(TestCase):
         client.create_ordering_subscription()
 
         # Check calls
-        ordering_client.requests.post.assert_called_once_with(
+        ordering_client.get_http_session().post.assert_called_once_with(
             "http://localhost:8080/DSProductOrdering/productOrdering/v2/hub",
             {"callback": "http://testdomain.com/charging/api/orderManagement/orders"},
         )
@@ -800,7 +802,7 @@ class OrderingClientTestCase(TestCase):
         }
         client.update_items_state(order, "InProgress", items)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.get_http_session().patch.assert_called_once_with(
             "http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/20",
             json=expected,
         )
@@ -815,7 +817,7 @@ class OrderingClientTestCase(TestCase):
 
         client.update_state(order, new_state)
 
-        ordering_client.requests.patch.assert_called_once_with(
+        ordering_client.get_http_session().patch.assert_called_once_with(
             "http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/" + order["id"],
             json={"state": new_state},
         )
@@ -829,7 +831,7 @@ class OrderingClientTestCase(TestCase):
 
         self.assertEquals({"id": "1"}, response)
 
-        ordering_client.requests.get.assert_called_once_with(
+        ordering_client.get_http_session().get.assert_called_once_with(
             "http://localhost:8080/DSProductOrdering/api/productOrdering/v2/productOrder/1"
         )
         self._response.raise_for_status.assert_called_once_with()
@@ -916,11 +918,11 @@ class InventoryClientTestCase(TestCase):
 
     def setUp(self):
         # Mock requests
-        inventory_client.requests = MagicMock()
+        inventory_client.get_http_session = MagicMock()
         self.response = MagicMock()
         self.response.status_code = 201
-        inventory_client.requests.post.return_value = self.response
-        inventory_client.requests.get.return_value = self.response
+        inventory_client.get_http_session().post.return_value = self.response
+        inventory_client.get_http_session().get.return_value = self.response
 
         inventory_client.settings.LOCAL_SITE = "http://localhost:8004/"
 
@@ -950,17 +952,17 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.create_inventory_subscription()
 
-        inventory_client.requests.get.assert_called_once_with(
+        inventory_client.get_http_session().get.assert_called_once_with(
             "http://localhost:8080/DSProductInventory/api/productInventory/v2/hub"
         )
 
         if created:
-            inventory_client.requests.post.assert_called_once_with(
+            inventory_client.get_http_session().post.assert_called_once_with(
                 "http://localhost:8080/DSProductInventory/api/productInventory/v2/hub",
                 json={"callback": "http://localhost:8004/charging/api/orderManagement/products"},
             )
         else:
-            self.assertEquals(0, inventory_client.requests.post.call_count)
+            self.assertEquals(0, inventory_client.get_http_session().post.call_count)
 
     def test_create_subscription_error(self):
         self.response.json.return_value = []
@@ -983,21 +985,21 @@ class InventoryClientTestCase(TestCase):
         client = inventory_client.InventoryClient()
         client.activate_product("1")
 
-        inventory_client.requests.patch.assert_called_once_with(
+        inventory_client.get_http_session().patch.assert_called_once_with(
             "http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1",
             json={"status": "Active", "startDate": "2016-01-22T04:10:25.176751Z"},
         )
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.get_http_session().patch().raise_for_status.assert_called_once_with()
 
     def test_suspend_product(self):
         client = inventory_client.InventoryClient()
         client.suspend_product("1")
 
-        inventory_client.requests.patch.assert_called_once_with(
+        inventory_client.get_http_session().patch.assert_called_once_with(
             "http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1",
             json={"status": "Suspended"},
         )
-        inventory_client.requests.patch().raise_for_status.assert_called_once_with()
+        inventory_client.get_http_session().patch().raise_for_status.assert_called_once_with()
 
     def test_terminate_product(self):
         client = inventory_client.InventoryClient()
@@ -1020,31 +1022,152 @@ class InventoryClientTestCase(TestCase):
                     },
                 ),
             ],
-            inventory_client.requests.patch.call_args_list,
+            inventory_client.get_http_session().patch.call_args_list,
         )
 
         self.assertEquals(
             [call(), call()],
-            inventory_client.requests.patch().raise_for_status.call_args_list,
+            inventory_client.get_http_session().patch().raise_for_status.call_args_list,
         )
 
     def test_get_product(self):
         client = inventory_client.InventoryClient()
         client.get_product("1")
 
-        inventory_client.requests.get.assert_called_once_with(
+        inventory_client.get_http_session().get.assert_called_once_with(
             "http://localhost:8080/DSProductInventory/api/productInventory/v2/product/1"
         )
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.get_http_session().get().raise_for_status.assert_called_once_with()
+
+    def test_session_requests(self):
+        inventory_client.get_http_session = MagicMock()
+
+        client = inventory_client.InventoryClient()
+        client.get_products(query={"id": "1"})
+        client.patch_product("1", {"status": "Active"})
+
+        url = "http://localhost:8080/DSProductInventory/api/productInventory/v2/product"
+        self.assertEquals(2, inventory_client.get_http_session.call_count)
+        inventory_client.get_http_session().get.assert_called_once_with(url + "?id=1")
+        inventory_client.get_http_session().patch.assert_called_once_with(url + "/1", json={"status": "Active"})
 
     @parameterized.expand([("all", {}, ""), ("filtered", {"id": "1,2,3"}, "?id=1,2,3")])
     def test_get_products(self, name, query, qs):
         client = inventory_client.InventoryClient()
         products = client.get_products(query=query)
 
-        inventory_client.requests.get.assert_called_once_with(
+        inventory_client.get_http_session().get.assert_called_once_with(
             "http://localhost:8080/DSProductInventory/api/productInventory/v2/product" + qs
         )
-        inventory_client.requests.get().raise_for_status.assert_called_once_with()
+        inventory_client.get_http_session().get().raise_for_status.assert_called_once_with()
+
+        self.assertEquals(inventory_client.get_http_session().get().json(), products)
+
+
+class EntitlementIndexTestCase(TestCase):
+    tags = ("ordering", "entitlements")
+
+    def setUp(self):
+        self._collection = MagicMock()
+        entitlements.get_database_connection = MagicMock(return_value={"wstore_entitlements": self._collection})
+
+        self._asset = MagicMock(pk=ObjectId("61004aba5e05acc115f022a0"), bundled_assets=[])
+        self._offering = MagicMock(bundled_offerings=[], is_digital=True, asset=self._asset)
+
+        entitlements.Offering = MagicMock()
+        entitlements.Offering.objects.get.return_value = self._offering
+
+        self._order = MagicMock(pk="order")
+        self._order.owner_organization.pk = "org"
+        self._order.owner_organization.acquired_offerings = ["61004aba5e05acc115f022f0"]
+
+    def tearDown(self):
+        reload(entitlements)
+
+    def _build_contract(self, item_id, terminated=False):
+        return MagicMock(item_id=item_id, offering="61004aba5e05acc115f022f0", terminated=terminated)
+
+    def _product_bundle(self):
+        self._asset.bundled_assets = ["asset1", "asset2"]
+
+    def _offering_bundle(self):
+        self._offering.bundled_offerings = ["61004aba5e05acc115f022f1", "61004aba5e05acc115f022f2"]
+        entitlements.Offering.objects.get.side_effect = [
+            self._offering,
+            MagicMock(is_digital=True, asset=MagicMock(pk="asset1", bundled_assets=[])),
+            MagicMock(is_digital=False),
+        ]
+
+    @parameterized.expand(
+        [
+            ("digital", ["61004aba5e05acc115f022a0"]),
+            ("product_bundle", ["asset1", "asset2"], _product_bundle),
+            ("offering_bundle", ["asset1"], _offering_bundle),
+        ]
+    )
+    def test_grant(self, name, expected_assets, side_effect=None):
+        if side_effect is not None:
+            side_effect(self)
 
-        self.assertEquals(inventory_client.requests.get().json(), products)
+        entitlements.EntitlementIndex().grant(self._order, self._build_contract("1"))
+
+        operations = self._collection.bulk_write.call_args[0][0]
+        self.assertEquals(
+            [
+                UpdateOne(
+                    {"_id": "org:" + asset},
+                    {"$set": {"organization": "org", "asset": asset}, "$addToSet": {"sources": "order:1"}},
+                    upsert=True,
+                )
+                for asset in expected_assets
+            ],
+            operations,
+        )
+
+    def test_revoke(self):
+        entitlements.EntitlementIndex().revoke(self._order, self._build_contract("1"))
+
+        self._collection.update_many.assert_called_once_with(
+            {"organization": "org", "sources": "order:1"}, {"$pull": {"sources": "order:1"}}
+        )
+
+    @parameterized.expand([("granted", {"_id": "org:asset"}, True), ("not_granted", None, False)])
+    def test_is_granted(self, name, entry, expected):
+        self._collection.find_one.return_value = entry
+
+        self.assertEquals(expected, entitlements.EntitlementIndex().is_granted("org", "asset"))
+        self._collection.find_one.assert_called_once_with(
+            {"_id": "org:asset", "sources.0": {"$exists": True}}, projection={"_id": True}
+        )
+
+    def test_build(self):
+        self._order.get_contracts.return_value = [
+            self._build_contract("1"),
+            self._build_contract("2", terminated=True),
+            self._build_contract("3"),
+        ]
+        other_order = MagicMock(pk="order2")
+        other_order.owner_organization.acquired_offerings = []
+        other_order.get_contracts.return_value = [self._build_contract("1")]
+
+        self._collection.find_one.return_value = None
+
+        index = entitlements.EntitlementIndex()
+        self.assertFalse(index.is_built())
+
+        index.build([self._order, other_order])
+
+        # Offering assets are only resolved once
+        entitlements.Offering.objects.get.assert_called_once_with(pk=ObjectId("61004aba5e05acc115f022f0"))
+        self.assertEquals(2, self._collection.bulk_write.call_count)
+        self.assertEquals(
+            ["order:1", "order:3"],
+            [
+                operations[0][0][0]._doc["$addToSet"]["sources"]
+                for operations in self._collection.bulk_write.call_args_list
+            ],
+        )
+
+        self._collection.update_one.assert_called_once_with(
+            {"_id": entitlements.BUILT_MARKER}, {"$set": {"date": ANY}}, upsert=True
+        )
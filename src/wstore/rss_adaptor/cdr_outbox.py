@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+from datetime import datetime, timedelta
+from logging import getLogger
+from uuid import uuid4
+
+from django.conf import settings
+from pymongo import ASCENDING, UpdateOne
+
+from wstore.models import Organization
+from wstore.rss_adaptor.correlation import release_correlation_numbers
+from wstore.rss_adaptor.rss_adaptor import CDRRejectedError, RSSAdaptor
+from wstore.store_commons.database import get_database_connection
+
+logger = getLogger("wstore.default_logger")
+
+OUTBOX_COLLECTION = "wstore_cdr_outbox"
+
+
+class CDROutbox:
+    """
+    Durable queue of the CDRs pending to be sent to the RSS. Every CDR is saved with the
+    date of its next delivery attempt, which is moved forward while a shipper holds it, so
+    the CDRs claimed by a crashed shipper are delivered by other one once the claim expires.
+    CDRs that exceed the max number of attempts are kept with no next attempt until resent
+    """
+
+    def __init__(self):
+        self._collection = get_database_connection()[OUTBOX_COLLECTION]
+
+    def ensure_indexes(self):
+        self._collection.create_index([("next_attempt", ASCENDING)])
+        self._collection.create_index([("claim", ASCENDING)])
+
+    def push(self, cdrs):
+        if not len(cdrs):
+            return
+
+        now = datetime.utcnow()
+        self._collection.insert_many(
+            [{"cdr": cdr, "attempts": 0, "created": now, "next_attempt": now, "claim": None} for cdr in cdrs]
+        )
+
+    def claim(self, batch_size, claim_ttl):
+        """
+        Takes a batch of the CDRs whose delivery is due
+        :param batch_size: Max number of CDRs to be claimed
+        :param claim_ttl: Seconds the CDRs are held before other shipper can claim them
+        :return: List of claimed outbox documents
+        """
+        now = datetime.utcnow()
+        ids = [
+            doc["_id"]
+            for doc in self._collection.find({"next_attempt": {"$lte": now}}, projection={"_id": True})
+            .sort("next_attempt", ASCENDING)
+            .limit(batch_size)
+        ]
+
+        if not len(ids):
+            return []
+
+        token = uuid4().hex
+        self._collection.update_many(
+            {"_id": {"$in": ids}, "next_attempt": {"$lte": now}},
+            {"$set": {"claim": token, "next_attempt": now + timedelta(seconds=claim_ttl)}},
+        )
+
+        return list(self._collection.find({"claim": token}))
+
+    def ack(self, docs):
+        self._collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+
+    def retry(self, docs, max_attempts, retry_delay, max_retry_delay):
+        """
+        Schedules a new delivery of the given CDRs with exponential backoff
+        :return: List of documents that have exceeded the max number of attempts
+        """
+        now = datetime.utcnow()
+        updates = []
+        failed = []
+
+        for doc in docs:
+            attempts = doc["attempts"] + 1
+
+            next_attempt = None
+            if attempts < max_attempts:
+                delay = min(max_retry_delay, retry_delay * 2 ** (attempts - 1))
+                next_attempt = now + timedelta(seconds=delay)
+            else:
+                failed.append(doc)
+
+            updates.append(
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"attempts": attempts, "next_attempt": next_attempt, "claim": None}},
+                )
+            )
+
+        self._collection.bulk_write(updates, ordered=False)
+        return failed
+
+    def reject(self, docs):
+        """
+        Keeps the given CDRs as failed with no next attempt, since the RSS will refuse them until they are fixed
+        """
+        self._collection.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in docs]}},
+            {"$set": {"next_attempt": None, "claim": None}, "$inc": {"attempts": 1}},
+        )
+
+    def get_failed(self):
+        return list(self._collection.find({"next_attempt": None}))
+
+    def requeue(self, docs):
+        """
+        Schedules again the delivery of failed CDRs, saving their possibly modified content
+        """
+        now = datetime.utcnow()
+        self._collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$set": {"cdr": doc["cdr"], "attempts": 0, "next_attempt": now, "claim": None}},
+                )
+                for doc in docs
+            ],
+            ordered=False,
+        )
+
+    def get_depth(self):
+        """
+        :return: dict with the number of CDRs pending to be sent and the number of failed CDRs
+        """
+        failed = self._collection.count_documents({"next_attempt": None})
+        return {
+            "pending": self._collection.count_documents({}) - failed,
+            "failed": failed,
+        }
+
+
+class CDRShipper(threading.Thread):
+    """
+    Background thread sending the CDRs of the outbox to the RSS. CDRs of different orders
+    are coalesced in batches which are sent every CDR_BATCH_INTERVAL seconds or as soon
+    as CDR_BATCH_SIZE CDRs have been queued
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="cdr-shipper", daemon=True)
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._queued = 0
+
+        self._batch_size = getattr(settings, "CDR_BATCH_SIZE", 100)
+        self._interval = getattr(settings, "CDR_BATCH_INTERVAL", 5)
+        self._max_attempts = getattr(settings, "CDR_MAX_ATTEMPTS", 10)
+        self._retry_delay = getattr(settings, "CDR_RETRY_DELAY", 30)
+        self._max_retry_delay = getattr(settings, "CDR_MAX_RETRY_DELAY", 3600)
+
+    def notify(self, count):
+        with self._lock:
+            self._queued += count
+            if self._queued >= self._batch_size:
+                self._wakeup.set()
+
+    def run(self):
+        CDROutbox().ensure_indexes()
+
+        while True:
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+            with self._lock:
+                self._queued = 0
+
+            try:
+                self.ship()
+            except Exception as e:
+                logger.error(f"Error shipping CDRs: {e}")
+
+    def _release_failed(self, docs):
+        # Return the correlation numbers when possible, failed CDRs are renumbered when resent
+        numbers = {}
+        for doc in docs:
+            numbers.setdefault(doc["cdr"]["provider"], []).append(doc["cdr"]["correlation"])
+
+        for provider, corr_numbers in numbers.items():
+            org = Organization.objects.get(name=provider)
+            release_correlation_numbers(org.pk, corr_numbers)
+
+    def _send(self, docs, accepted, rejected):
+        # A rejected batch is split to find the CDRs refused by the RSS, so the valid ones are delivered
+        try:
+            RSSAdaptor().send_cdr([doc["cdr"] for doc in docs])
+        except CDRRejectedError:
+            if len(docs) == 1:
+                rejected.extend(docs)
+                return
+
+            half = len(docs) // 2
+            self._send(docs[:half], accepted, rejected)
+            self._send(docs[half:], accepted, rejected)
+            return
+
+        accepted.extend(docs)
+
+    def ship(self):
+        """
+        Sends all the due CDRs of the outbox to the RSS
+        :return: Number of CDRs sent
+        """
+        outbox = CDROutbox()
+        sent = 0
+
+        while True:
+            # A claimed batch is held for the time it could take to be sent
+            docs = outbox.claim(self._batch_size, self._interval + 60)
+            if not len(docs):
+                break
+
+            accepted = []
+            rejected = []
+            error = None
+            try:
+                self._send(docs, accepted, rejected)
+            except Exception as e:
+                error = e
+
+            if len(accepted):
+                outbox.ack(accepted)
+                sent += len(accepted)
+
+            if len(rejected):
+                logger.error(f"The RSS has rejected {len(rejected)} CDRs, saved as failed")
+                outbox.reject(rejected)
+                self._release_failed(rejected)
+
+            if error is not None:
+                done = set(doc["_id"] for doc in accepted + rejected)
+                pending = [doc for doc in docs if doc["_id"] not in done]
+
+                logger.warning(f"Error sending {len(pending)} CDRs to the RSS: {error}")
+                failed = outbox.retry(pending, self._max_attempts, self._retry_delay, self._max_retry_delay)
+
+                if len(failed):
+                    logger.error(f"{len(failed)} CDRs exceeded the max number of delivery attempts")
+                    self._release_failed(failed)
+
+                # Stop until the next cycle, as the RSS is probably not available
+                break
+
+        if sent:
+            logger.debug(f"Sent {sent} CDRs to the RSS, outbox status: {outbox.get_depth()}")
+
+        return sent
+
+
+_shipper = None
+_shipper_pid = None
+_shipper_lock = threading.Lock()
+
+
+def get_shipper():
+    """
+    Returns the CDR shipper of the current process, starting it if needed
+    """
+    global _shipper, _shipper_pid
+
+    with _shipper_lock:
+        if _shipper is None or _shipper_pid != os.getpid() or not _shipper.is_alive():
+            _shipper = CDRShipper()
+            _shipper_pid = os.getpid()
+            _shipper.start()
+
+        return _shipper
+
+
+def _get_running_shipper():
+    with _shipper_lock:
+        if _shipper is not None and _shipper_pid == os.getpid() and _shipper.is_alive():
+            return _shipper
+
+    return None
+
+
+def enqueue_cdrs(cdrs):
+    """
+    Saves the given CDRs in the outbox to be sent to the RSS in background
+    """
+    CDROutbox().push(cdrs)
+
+    # Processes not running a shipper, as the management commands, leave the CDRs
+    # in the outbox to be sent by the server
+    shipper = _get_running_shipper()
+    if shipper is not None:
+        shipper.notify(len(cdrs))
+
+
+def get_queue_depth():
+    return CDROutbox().get_depth()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from logging import getLogger
+
+from wstore.store_commons.database import get_database_connection
+
+logger = getLogger("wstore.default_logger")
+
+
+def reserve_correlation_numbers(org_id, count):
+    """
+    Reserves a contiguous block of CDR correlation numbers of an organization
+    using a single atomic increment of the counter
+    :param org_id: Id of the organization owning the counter
+    :param count: Number of correlation numbers to reserve
+    :return: range with the reserved correlation numbers
+    """
+    if count < 1:
+        return range(0)
+
+    db = get_database_connection()
+    prev = db.wstore_organization.find_one_and_update(
+        {"_id": org_id},
+        {"$inc": {"correlation_number": count}},
+        projection={"correlation_number": True},
+    )
+
+    start = prev.get("correlation_number", 0)
+    return range(start, start + count)
+
+
+def release_correlation_numbers(org_id, numbers):
+    """
+    Returns a block of correlation numbers to the counter of an organization. The
+    block is only released if it is contiguous and no other numbers have been reserved
+    after it, otherwise the numbers stay consumed and the CDRs must be renumbered when resent
+    :param org_id: Id of the organization owning the counter
+    :param numbers: Correlation numbers to be released
+    :return: True if the numbers have been released
+    """
+    numbers = sorted(int(number) for number in numbers)
+
+    if not len(numbers) or numbers[-1] - numbers[0] + 1 != len(numbers):
+        return False
+
+    db = get_database_connection()
+    prev = db.wstore_organization.find_one_and_update(
+        {"_id": org_id, "correlation_number": numbers[-1] + 1},
+        {"$inc": {"correlation_number": -len(numbers)}},
+        projection={"correlation_number": True},
+    )
+
+    released = prev is not None
+    if not released:
+        logger.debug(f"Correlation numbers {numbers[0]}-{numbers[-1]} could not be released")
+
+    return released
@@ -19,24 +19,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import threading
-
-import requests
 from bson import ObjectId
 from django.conf import settings
 
-from wstore.models import Context, Organization
-from wstore.store_commons.database import get_database_connection
+from wstore.store_commons.http_session import get_http_session
 
 
-class RSSAdaptorThread(threading.Thread):
-    def __init__(self, cdr_info):
-        threading.Thread.__init__(self)
-        self.cdr = cdr_info
+class CDRRejectedError(Exception):
+    """
+    The RSS has refused the CDRs because of their content, so sending them again will fail
+    """
 
-    def run(self):
-        r = RSSAdaptor()
-        r.send_cdr(self.cdr)
+    def __init__(self, msg, status_code):
+        super().__init__(msg)
+        self.status_code = status_code
 
 
 class RSSAdaptor:
@@ -77,17 +73,11 @@ class RSSAdaptor:
             "X-Email": settings.WSTOREMAIL,
         }
 
-        response = requests.post(url, json=data, headers=headers)
+        response = get_http_session().post(url, json=data, headers=headers)
 
         if response.status_code != 201:
-            db = get_database_connection()
-            # Restore correlation numbers
-            for cdr in cdr_info:
-                org = Organization.objects.get(name=cdr["provider"])
-                db.wstore_organization.find_and_modify(
-                    query={"_id": org.pk}, update={"$inc": {"correlation_number": -1}}
-                )["correlation_number"]
-
-            context = Context.objects.all()[0]
-            context.failed_cdrs.extend(cdr_info)
-            context.save()
+            msg = "The RSS has rejected the CDRs with status code {}".format(response.status_code)
+            if 400 <= response.status_code < 500:
+                raise CDRRejectedError(msg, response.status_code)
+
+            raise Exception(msg)
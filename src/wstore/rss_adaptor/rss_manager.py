@@ -19,9 +19,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import requests
 from django.conf import settings
 
+from wstore.store_commons.http_session import get_http_session
+
 
 class RSSManager(object):
     _rss = None
@@ -47,7 +48,8 @@ class RSSManager(object):
             "X-Email": self._credentials["email"],
         }
 
-        methods = {"POST": requests.post, "PUT": requests.put}
+        session = get_http_session()
+        methods = {"POST": session.post, "PUT": session.put}
 
         response = methods[method](url, json=data, headers=headers)
         response.raise_for_status()
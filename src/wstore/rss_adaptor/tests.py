@@ -21,15 +21,18 @@
 
 
 from copy import deepcopy
+from datetime import datetime, timedelta
 from importlib import reload
 
 from bson import ObjectId
 from django.conf import settings
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import MagicMock, call
 from parameterized import parameterized
+from pymongo import UpdateOne
 
-from wstore.rss_adaptor import model_manager, rss_adaptor, rss_manager
+from wstore.rss_adaptor import cdr_outbox, correlation, model_manager, rss_adaptor, rss_manager
 
 
 class RSSAdaptorTestCase(TestCase):
@@ -40,15 +43,9 @@ class RSSAdaptorTestCase(TestCase):
         settings.RSS = "http://testhost.com/rssHost/"
         settings.STORE_NAME = "wstore"
 
-        rss_adaptor.requests = MagicMock()
+        rss_adaptor.get_http_session = MagicMock()
         self._response = MagicMock()
-        rss_adaptor.requests.post.return_value = self._response
-
-        # Mocks for fail responses
-        rss_adaptor.get_database_connection = MagicMock()
-        rss_adaptor.Organization = MagicMock()
-        rss_adaptor.Organization.objects.get().pk = b"111111111111"
-        rss_adaptor.Context = MagicMock()
+        rss_adaptor.get_http_session().post.return_value = self._response
 
     def test_rss_client(self):
         # Create mocks
@@ -76,7 +73,7 @@ class RSSAdaptorTestCase(TestCase):
             ]
         )
 
-        rss_adaptor.requests.post.assert_called_once_with(
+        rss_adaptor.get_http_session().post.assert_called_once_with(
             "http://testhost.com/rssHost/rss/cdrs",
             json=[
                 {
@@ -104,9 +101,6 @@ class RSSAdaptorTestCase(TestCase):
             },
         )
 
-        rss_adaptor.get_database_connection.assert_not_called()
-        rss_adaptor.Context.objects.all.assert_not_called()
-
     def test_rss_remote_error(self):
         # Create Mocks
         self._response.status_code = 500
@@ -126,20 +120,287 @@ class RSSAdaptorTestCase(TestCase):
             "event": "One time",
             "type": "C",
         }
-        cdrs = [cdr, cdr]
 
         rss_ad = rss_adaptor.RSSAdaptor()
-        rss_ad.send_cdr(cdrs)
 
-        # Decrement correlation number for every cdr
-        calls = call(query={"_id": b"111111111111"}, update={"$inc": {"correlation_number": -1}})
-        rss_adaptor.get_database_connection().wstore_organization.find_and_modify.assert_has_calls(
-            [calls, calls], any_order=True
+        with self.assertRaises(Exception) as error:
+            rss_ad.send_cdr([cdr])
+
+        self.assertEquals("The RSS has rejected the CDRs with status code 500", str(error.exception))
+        self.assertNotIsInstance(error.exception, rss_adaptor.CDRRejectedError)
+
+    def test_rss_cdrs_rejected(self):
+        self._response.status_code = 400
+
+        cdr = {
+            "provider": "test_provider",
+            "correlation": "2",
+            "order": "1234567890",
+            "offering": "test_offering",
+            "product_class": "SaaS",
+            "description": "The description",
+            "cost_currency": "EUR",
+            "cost_value": "10",
+            "tax_value": "0.0",
+            "time_stamp": "10-05-13T10:00:00Z",
+            "customer": "test_customer",
+            "event": "One time",
+            "type": "C",
+        }
+
+        with self.assertRaises(rss_adaptor.CDRRejectedError) as error:
+            rss_adaptor.RSSAdaptor().send_cdr([cdr])
+
+        self.assertEquals(400, error.exception.status_code)
+
+
+class CorrelationNumbersTestCase(TestCase):
+    tags = ("rss-adaptor", "correlation")
+
+    def setUp(self):
+        self._db = MagicMock()
+        correlation.get_database_connection = MagicMock(return_value=self._db)
+
+    def test_reserve_block(self):
+        self._db.wstore_organization.find_one_and_update.return_value = {"correlation_number": 5}
+
+        numbers = correlation.reserve_correlation_numbers("org", 3)
+
+        self.assertEquals([5, 6, 7], list(numbers))
+        self._db.wstore_organization.find_one_and_update.assert_called_once_with(
+            {"_id": "org"},
+            {"$inc": {"correlation_number": 3}},
+            projection={"correlation_number": True},
+        )
+
+    def test_reserve_empty_block(self):
+        self.assertEquals([], list(correlation.reserve_correlation_numbers("org", 0)))
+        correlation.get_database_connection.assert_not_called()
+
+    @parameterized.expand(
+        [
+            ("released", ["6", "5", "7"], {"correlation_number": 8}, True),
+            ("reserved_after", ["5", "6", "7"], None, False),
+        ]
+    )
+    def test_release_block(self, name, numbers, prev, released):
+        self._db.wstore_organization.find_one_and_update.return_value = prev
+
+        self.assertEquals(released, correlation.release_correlation_numbers("org", numbers))
+        self._db.wstore_organization.find_one_and_update.assert_called_once_with(
+            {"_id": "org", "correlation_number": 8},
+            {"$inc": {"correlation_number": -3}},
+            projection={"correlation_number": True},
+        )
+
+    def test_release_not_contiguous(self):
+        self.assertFalse(correlation.release_correlation_numbers("org", ["2", "5"]))
+        correlation.get_database_connection.assert_not_called()
+
+
+class CDROutboxTestCase(TestCase):
+    tags = ("rss-adaptor", "cdr-outbox")
+
+    def setUp(self):
+        self._now = datetime(2023, 5, 1, 10, 0, 0)
+        cdr_outbox.datetime = MagicMock()
+        cdr_outbox.datetime.utcnow.return_value = self._now
+
+        cdr_outbox.uuid4 = MagicMock()
+        cdr_outbox.uuid4.return_value.hex = "claim"
+
+        self._collection = MagicMock()
+        cdr_outbox.get_database_connection = MagicMock(return_value={"wstore_cdr_outbox": self._collection})
+
+    def tearDown(self):
+        reload(cdr_outbox)
+
+    def test_push(self):
+        cdr_outbox.CDROutbox().push([{"correlation": "1"}, {"correlation": "2"}])
+
+        self._collection.insert_many.assert_called_once_with(
+            [
+                {
+                    "cdr": {"correlation": str(corr)},
+                    "attempts": 0,
+                    "created": self._now,
+                    "next_attempt": self._now,
+                    "claim": None,
+                }
+                for corr in (1, 2)
+            ]
+        )
+
+    def test_claim(self):
+        cursor = MagicMock()
+        cursor.sort.return_value.limit.return_value = [{"_id": 1}, {"_id": 2}]
+        claimed_docs = [{"_id": 1, "cdr": {}}, {"_id": 2, "cdr": {}}]
+        self._collection.find.side_effect = [cursor, claimed_docs]
+
+        claimed = cdr_outbox.CDROutbox().claim(50, 60)
+
+        self.assertEquals(claimed_docs, claimed)
+        self.assertEquals(
+            [
+                call({"next_attempt": {"$lte": self._now}}, projection={"_id": True}),
+                call({"claim": "claim"}),
+            ],
+            self._collection.find.call_args_list,
+        )
+        cursor.sort.return_value.limit.assert_called_once_with(50)
+        self._collection.update_many.assert_called_once_with(
+            {"_id": {"$in": [1, 2]}, "next_attempt": {"$lte": self._now}},
+            {"$set": {"claim": "claim", "next_attempt": self._now + timedelta(seconds=60)}},
+        )
+
+    def test_claim_empty(self):
+        self._collection.find.return_value.sort.return_value.limit.return_value = []
+
+        self.assertEquals([], cdr_outbox.CDROutbox().claim(50, 60))
+        self._collection.update_many.assert_not_called()
+
+    def test_retry(self):
+        failed = cdr_outbox.CDROutbox().retry([{"_id": 1, "attempts": 2}, {"_id": 2, "attempts": 4}], 5, 30, 3600)
+
+        self.assertEquals([{"_id": 2, "attempts": 4}], failed)
+        self._collection.bulk_write.assert_called_once_with(
+            [
+                UpdateOne(
+                    {"_id": 1},
+                    {"$set": {"attempts": 3, "next_attempt": self._now + timedelta(seconds=120), "claim": None}},
+                ),
+                UpdateOne({"_id": 2}, {"$set": {"attempts": 5, "next_attempt": None, "claim": None}}),
+            ],
+            ordered=False,
+        )
+
+    def test_reject(self):
+        cdr_outbox.CDROutbox().reject([{"_id": 1}, {"_id": 2}])
+
+        self._collection.update_many.assert_called_once_with(
+            {"_id": {"$in": [1, 2]}},
+            {"$set": {"next_attempt": None, "claim": None}, "$inc": {"attempts": 1}},
         )
-        # Save the failed cdrs
-        rss_adaptor.Context.objects.all.assert_called_once_with()
-        rss_adaptor.Context.objects.all()[0].failed_cdrs.extend.assert_called_once_with(cdrs)
-        rss_adaptor.Context.objects.all()[0].save.assert_called_once_with()
+
+    def test_get_depth(self):
+        self._collection.count_documents.side_effect = [2, 10]
+        self.assertEquals({"pending": 8, "failed": 2}, cdr_outbox.CDROutbox().get_depth())
+
+
+@override_settings(CDR_BATCH_SIZE=2, CDR_BATCH_INTERVAL=5, CDR_MAX_ATTEMPTS=3)
+class CDRShipperTestCase(TestCase):
+    tags = ("rss-adaptor", "cdr-outbox")
+
+    def setUp(self):
+        self._outbox = MagicMock()
+        cdr_outbox.CDROutbox = MagicMock(return_value=self._outbox)
+        cdr_outbox.RSSAdaptor = MagicMock()
+        cdr_outbox.Organization = MagicMock()
+        cdr_outbox.release_correlation_numbers = MagicMock()
+
+        self._docs = [
+            {"_id": 1, "cdr": {"provider": "provider", "correlation": "3"}},
+            {"_id": 2, "cdr": {"provider": "provider", "correlation": "4"}},
+        ]
+
+    def tearDown(self):
+        reload(cdr_outbox)
+
+    def test_ship_batches(self):
+        self._outbox.claim.side_effect = [self._docs, self._docs[:1], []]
+
+        sent = cdr_outbox.CDRShipper().ship()
+
+        self.assertEquals(3, sent)
+        self.assertEquals([call(2, 65), call(2, 65), call(2, 65)], self._outbox.claim.call_args_list)
+        self.assertEquals(
+            [call([doc["cdr"] for doc in self._docs]), call([self._docs[0]["cdr"]])],
+            cdr_outbox.RSSAdaptor().send_cdr.call_args_list,
+        )
+        self.assertEquals([call(self._docs), call(self._docs[:1])], self._outbox.ack.call_args_list)
+        self._outbox.retry.assert_not_called()
+
+    def test_ship_error(self):
+        self._outbox.claim.return_value = self._docs
+        self._outbox.retry.return_value = self._docs
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = Exception("RSS error")
+
+        sent = cdr_outbox.CDRShipper().ship()
+
+        self.assertEquals(0, sent)
+        self._outbox.claim.assert_called_once_with(2, 65)
+        self._outbox.retry.assert_called_once_with(self._docs, 3, 30, 3600)
+        self._outbox.ack.assert_not_called()
+
+        # Correlation numbers of failed CDRs are returned
+        cdr_outbox.Organization.objects.get.assert_called_once_with(name="provider")
+        cdr_outbox.release_correlation_numbers.assert_called_once_with(
+            cdr_outbox.Organization.objects.get().pk, ["3", "4"]
+        )
+
+    def test_ship_rejected(self):
+        docs = self._docs + [{"_id": 3, "cdr": {"provider": "provider", "correlation": "5"}}]
+        self._outbox.claim.side_effect = [docs, []]
+
+        def send_cdr(cdrs):
+            if docs[1]["cdr"] in cdrs:
+                raise cdr_outbox.CDRRejectedError("Rejected", 400)
+
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = send_cdr
+
+        sent = cdr_outbox.CDRShipper().ship()
+
+        # Only the rejected CDR is failed, the rest of the batch is delivered
+        self.assertEquals(2, sent)
+        self._outbox.ack.assert_called_once_with([docs[0], docs[2]])
+        self._outbox.reject.assert_called_once_with([docs[1]])
+        self._outbox.retry.assert_not_called()
+        cdr_outbox.release_correlation_numbers.assert_called_once_with(cdr_outbox.Organization.objects.get().pk, ["4"])
+
+    def test_ship_rejected_error(self):
+        self._outbox.claim.return_value = self._docs
+        self._outbox.retry.return_value = []
+        cdr_outbox.RSSAdaptor().send_cdr.side_effect = [
+            cdr_outbox.CDRRejectedError("Rejected", 400),
+            None,
+            Exception("RSS error"),
+        ]
+
+        sent = cdr_outbox.CDRShipper().ship()
+
+        # The CDRs not sent when the RSS stopped responding are retried
+        self.assertEquals(1, sent)
+        self._outbox.ack.assert_called_once_with(self._docs[:1])
+        self._outbox.retry.assert_called_once_with(self._docs[1:], 3, 30, 3600)
+        self._outbox.reject.assert_not_called()
+
+    def test_notify_batch_size(self):
+        shipper = cdr_outbox.CDRShipper()
+
+        shipper.notify(1)
+        self.assertFalse(shipper._wakeup.is_set())
+
+        shipper.notify(1)
+        self.assertTrue(shipper._wakeup.is_set())
+
+    def test_enqueue_cdrs(self):
+        cdr_outbox._get_running_shipper = MagicMock()
+        cdrs = [doc["cdr"] for doc in self._docs]
+
+        cdr_outbox.enqueue_cdrs(cdrs)
+
+        self._outbox.push.assert_called_once_with(cdrs)
+        cdr_outbox._get_running_shipper().notify.assert_called_once_with(2)
+
+    def test_enqueue_cdrs_no_shipper(self):
+        cdr_outbox.CDRShipper = MagicMock()
+        cdrs = [doc["cdr"] for doc in self._docs]
+
+        cdr_outbox.enqueue_cdrs(cdrs)
+
+        # The CDRs are left to the shipper of the server process
+        self._outbox.push.assert_called_once_with(cdrs)
+        cdr_outbox.CDRShipper.assert_not_called()
 
 
 BASIC_MODEL = {
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+
+_client_pool = None
+_client_pool_pid = None
+_client_pool_lock = threading.Lock()
+
+
+def _get_client_pool():
+    global _client_pool, _client_pool_pid
+
+    with _client_pool_lock:
+        # A forked process cannot reuse the threads of its parent
+        if _client_pool is None or _client_pool_pid != os.getpid():
+            # Every thread can keep one of the pooled connections of a host busy
+            _client_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "HTTP_POOL_SIZE", 20), thread_name_prefix="api-clients"
+            )
+            _client_pool_pid = os.getpid()
+
+        return _client_pool
+
+
+class AsyncClient:
+    """
+    Coroutine interface of a blocking API client. Every public method of the client is
+    exposed as a coroutine function whose request is made in a thread pool sized as the
+    HTTP connection pool, so several calls can be waiting for their responses at once
+    """
+
+    client_class = None
+
+    def __init__(self, client=None):
+        """
+        :param client: Blocking client to be wrapped, a new instance of client_class if not provided
+        """
+        self._client = client if client is not None else self.client_class()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        method = getattr(self._client, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_get_client_pool(), partial(method, *args, **kwargs))
+
+        return call
+
+
+def run_sync(awaitable):
+    """
+    Runs a coroutine until it finishes from synchronous code
+    :param awaitable: Coroutine to be run
+    :return: The result of the coroutine
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(awaitable)
+
+    # The thread is already running an event loop, which cannot be blocked
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, awaitable).result()
+
+
+def run_concurrently(*awaitables, return_exceptions=False):
+    """
+    Runs a set of independent coroutines at the same time from synchronous code
+    :param awaitables: Coroutines to be run
+    :param return_exceptions: Whether the errors are returned as results instead of being raised
+    :return: List with the results in the order of the coroutines
+    """
+
+    async def gather():
+        return await asyncio.gather(*awaitables, return_exceptions=return_exceptions)
+
+    return run_sync(gather())
@@ -20,91 +20,287 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
 from logging import getLogger
+from uuid import uuid4
 
 from django.conf import settings
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
+
+from wstore.store_commons.errors import DocumentNotFoundError, LockTimeoutError
 
 logger = getLogger("wstore.default_logger")
 
+# Database roles supported by get_database_connection
+PRIMARY = "primary"
+SECONDARY_PREFERRED = "secondary_preferred"
+
+READ_PREFERENCES = {
+    PRIMARY: ReadPreference.PRIMARY,
+    SECONDARY_PREFERRED: ReadPreference.SECONDARY_PREFERRED,
+}
+
 
-def get_database_connection():
+class ClientRegistry:
     """
-    Gets a raw database connection to MongoDB
+    Process wide registry of MongoDB clients. A single MongoClient (and so a single
+    connection pool) is shared by all the threads of the process, while database
+    handles are cached per role. pymongo clients are not fork safe, so the registry
+    is reset in the child process after a fork
     """
-    logger.debug("Getting connection to MongoDB")
 
-    # Get database info from settings
-    database_info = settings.DATABASES["default"]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._client = None
+        self._handles = {}
+
+    def _build_client(self):
+        database_info = settings.DATABASES["default"]
+        client_info = database_info.get("CLIENT", {})
+
+        client_args = {
+            "maxPoolSize": int(getattr(settings, "MONGO_MAX_POOL_SIZE", 100)),
+            "minPoolSize": int(getattr(settings, "MONGO_MIN_POOL_SIZE", 0)),
+        }
+
+        if "username" in client_info:
+            client_args["username"] = client_info["username"]
+            client_args["password"] = client_info.get("password")
+            client_args["authSource"] = database_info["NAME"]
 
-    # Create database connection
-    client = None
-    if 'CLIENT' in database_info:
-        client_info = database_info['CLIENT']
-        db_name = database_info['NAME']
+        port = int(client_info["port"]) if "port" in client_info else None
+        return MongoClient(client_info.get("host", "localhost"), port, **client_args)
 
-        if "host" in client_info and "port" in client_info and "username" in client_info:
-            client = MongoClient(
-                client_info['host'],
-                int(client_info['port']),
-                username=client_info['username'],
-                password=client_info['password'],
-                authSource=db_name)
+    def get_database(self, role=PRIMARY):
+        if role not in READ_PREFERENCES:
+            raise ValueError("Invalid database role: " + str(role))
 
-        elif "host" in client_info and "port" in client_info and "username" not in client_info:
-            client = MongoClient(client_info["host"], int(client_info["port"]))
+        if self._pid != os.getpid():
+            # The registry has been inherited from a parent process
+            self.reset()
 
-        elif "host" in client_info and "port" not in client_info and "username" in client_info:
-            client = MongoClient(
-                client_info['host'],
-                username=client_info['username'],
-                password=client_info['password'],
-                authSource=db_name)
+        handle = self._handles.get(role)
+        if handle is not None:
+            return handle
 
-        elif "host" in client_info and "port" not in client_info and "username" not in client_info:
-            client = MongoClient(client_info["host"])
+        with self._lock:
+            if self._client is None:
+                logger.debug("Creating MongoDB client")
+                self._client = self._build_client()
 
-        elif "host" not in client_info and "port" in client_info and "username" in client_info:
-            client = MongoClient(
-                'localhost',
-                int(client_info['port']),
-                username=client_info['username'],
-                password=client_info['password'],
-                authSource=db_name)
+            if role not in self._handles:
+                db_name = settings.DATABASES["default"]["NAME"]
+                self._handles[role] = self._client.get_database(db_name, read_preference=READ_PREFERENCES[role])
+                logger.info(f"Connected to MongoDB: {db_name} ({role}) OK")
 
-        elif "host" not in client_info and "port" in client_info and "username" not in client_info:
-            client = MongoClient("localhost", int(client_info["port"]))
+            return self._handles[role]
 
-        else:
-            client = MongoClient()
-    else:
-        client = MongoClient()
+    def reset(self):
+        """
+        Forgets the current client without closing it, used after a fork since the
+        sockets of the pool belong to the parent process
+        """
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._client = None
+        self._handles = {}
 
-    db = client[db_name]
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
 
-    logger.info(f"Connected to MongoDB: {db_name} OK")
-    return db
+            self._client = None
+            self._handles = {}
+
+
+_registry = ClientRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_registry.reset)
+
+
+def get_database_connection(role=PRIMARY):
+    """
+    Gets a raw database connection to MongoDB. The returned handle is shared by the
+    whole process, so it must not be closed by the caller
+    :param role: PRIMARY for writes and consistent reads or SECONDARY_PREFERRED for reads
+    that can tolerate replication lag
+    """
+    return _registry.get_database(role)
+
+
+def close_database_connections():
+    """
+    Closes the shared MongoDB client of the current process
+    """
+    _registry.close()
 
 
 class DocumentLock:
-    def __init__(self, collection, doc_id, lock_id):
+    """
+    Lease based lock over a MongoDB document. The lease is saved in the locked document
+    as an owner token and an expiration date, so the lock of a crashed holder is
+    reclaimed once its lease expires. Waiters back off exponentially (with jitter)
+    between attempts, so they barely load the database while the lock is taken.
+    Holders running for longer than the TTL can enable the heartbeat, which renews
+    the lease in background until the document is unlocked
+    """
+
+    BACKOFF_BASE = 0.05
+    BACKOFF_MAX = 2.0
+
+    def __init__(self, collection, doc_id, lock_id, ttl=None, heartbeat=False):
         self._collection = collection
         self._doc_id = doc_id
         self._lock_id = "_lock_{}".format(lock_id)
+        self._ttl = ttl if ttl is not None else getattr(settings, "DOCUMENT_LOCK_TTL", 60)
+        self._owner = uuid4().hex
         self._db = get_database_connection()
+        self._heartbeat = heartbeat
+        self._heartbeat_stop = None
+        self._exists = False
+
+    def _get_lease(self):
+        return {
+            "owner": self._owner,
+            "expires": datetime.utcnow() + timedelta(seconds=self._ttl),
+        }
+
+    def _backoff(self):
+        attempt = 0
+        while True:
+            yield random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2**attempt))
+            attempt = min(attempt + 1, 16)
+
+    def _timeout_error(self):
+        logger.error(f"Timeout waiting for document {self._lock_id}")
+        return LockTimeoutError("Timeout waiting for the lock {} of document {}".format(self._lock_id, self._doc_id))
 
     def lock_document(self):
-        prev = self._db[self._collection].find_one_and_update({"_id": self._doc_id}, {"$set": {self._lock_id: True}})
-        logger.debug(f"Locked document {self._lock_id}")
-        return self._lock_id in prev and prev[self._lock_id]
+        """
+        Tries to take the lease of the document
+        :return: True if the document is locked by other owner, False if the lease has been taken
+        :raises DocumentNotFoundError: If the document does not exist
+        """
+        query = {
+            "_id": self._doc_id,
+            "$or": [
+                # Boolean locks written by previous versions are released by the release_legacy_locks migration
+                {self._lock_id: {"$in": [None, False]}},
+                {self._lock_id + ".owner": self._owner},
+                {self._lock_id + ".expires": {"$lt": datetime.utcnow()}},
+            ],
+        }
+        prev = self._db[self._collection].find_one_and_update(query, {"$set": {self._lock_id: self._get_lease()}})
+
+        locked = prev is None
+        if locked and not self._exists:
+            # The existence of the document is only checked on the first failed attempt
+            if self._db[self._collection].find_one({"_id": self._doc_id}, {"_id": 1}) is None:
+                raise DocumentNotFoundError("The document {} to be locked does not exist".format(self._doc_id))
+
+            self._exists = True
+
+        if not locked:
+            logger.debug(f"Locked document {self._lock_id}")
+
+            if self._heartbeat:
+                self._start_heartbeat()
+
+        return locked
+
+    def wait_document(self, timeout=None):
+        """
+        Blocks until the lease of the document is taken
+        :param timeout: Max number of seconds to wait, None to wait until the lock is released or expires
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        for delay in self._backoff():
+            if not self.lock_document():
+                return
+
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise self._timeout_error()
+
+            logger.debug(f"Waiting for document {self._lock_id}")
+            time.sleep(delay)
+
+    async def wait_document_async(self, timeout=None):
+        """
+        Coroutine version of wait_document, database accesses are made in the default executor
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else time.monotonic() + timeout
 
-    def wait_document(self):
-        locked = self.lock_document()
-        logger.debug(f"Waiting for document {self._lock_id}")
+        for delay in self._backoff():
+            if not await loop.run_in_executor(None, self.lock_document):
+                return
 
-        while locked:
-            locked = self.lock_document()
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise self._timeout_error()
+
+            await asyncio.sleep(delay)
+
+    def renew(self):
+        """
+        Extends the lease of the document, used by holders running for longer than the TTL
+        :return: False if the lease has been lost
+        """
+        result = self._db[self._collection].update_one(
+            {"_id": self._doc_id, self._lock_id + ".owner": self._owner},
+            {"$set": {self._lock_id: self._get_lease()}},
+        )
+        return result.matched_count > 0
+
+    def _start_heartbeat(self):
+        if self._heartbeat_stop is not None:
+            return
+
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self._ttl / 3.0):
+                try:
+                    if not self.renew():
+                        logger.error(f"Lost the lease of document {self._lock_id}")
+                        return
+                except Exception as e:
+                    logger.warning(f"Error renewing the lease of document {self._lock_id}: {e}")
+
+        self._heartbeat_stop = stopped
+        threading.Thread(target=beat, daemon=True).start()
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
 
     def unlock_document(self):
+        self._stop_heartbeat()
         logger.debug(f"Unlocked document {self._lock_id}")
-        self._db[self._collection].find_one_and_update({"_id": self._doc_id}, {"$set": {self._lock_id: False}})
+        self._db[self._collection].update_one(
+            {"_id": self._doc_id, self._lock_id + ".owner": self._owner},
+            {"$unset": {self._lock_id: ""}},
+        )
+
+    def __enter__(self):
+        self.wait_document()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlock_document()
+
+    async def __aenter__(self):
+        await self.wait_document_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await asyncio.get_running_loop().run_in_executor(None, self.unlock_document)
@@ -33,3 +33,19 @@ class RepositoryError(Exception):
 
     def __str__(self):
         return self.value
+
+
+class LockTimeoutError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return self.value
+
+
+class DocumentNotFoundError(Exception):
+    def __init__(self, msg):
+        self.value = msg
+
+    def __str__(self):
+        return self.value
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from logging import getLogger
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = getLogger("wstore.default_logger")
+
+# Only requests that can be repeated without side effects are retried
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+
+class PooledSession(Session):
+    """
+    Session applying a default timeout to the requests that do not specify one
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        return super().send(request, **kwargs)
+
+
+class SessionRegistry:
+    """
+    Process wide registry of the HTTP session used to access the TMForum APIs and the
+    other external services. The session keeps a pool of keep-alive connections per host
+    shared by all the threads of the process. Connections cannot be shared with a
+    forked process, so the registry is reset in the child process after a fork
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._session = None
+        self._adapter = None
+
+    def _build_session(self):
+        retries = Retry(
+            total=int(getattr(settings, "HTTP_RETRIES", 3)),
+            backoff_factor=float(getattr(settings, "HTTP_RETRY_BACKOFF", 0.3)),
+            status_forcelist=(502, 503, 504),
+            allowed_methods=IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+
+        self._adapter = HTTPAdapter(
+            pool_connections=int(getattr(settings, "HTTP_POOL_HOSTS", 10)),
+            pool_maxsize=int(getattr(settings, "HTTP_POOL_SIZE", 20)),
+            max_retries=retries,
+        )
+
+        timeout = (
+            float(getattr(settings, "HTTP_CONNECT_TIMEOUT", 5)),
+            float(getattr(settings, "HTTP_READ_TIMEOUT", 60)),
+        )
+
+        session = PooledSession(timeout)
+
+        # The session is shared by all the users of the process, so cookies set by a
+        # response must not be sent in the requests made on behalf of other users
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        session.mount("http://", self._adapter)
+        session.mount("https://", self._adapter)
+        return session
+
+    def get_session(self):
+        if self._pid != os.getpid():
+            # The registry has been inherited from a parent process
+            self.reset()
+
+        if self._session is not None:
+            return self._session
+
+        with self._lock:
+            if self._session is None:
+                logger.debug("Creating HTTP session")
+                self._session = self._build_session()
+
+            return self._session
+
+    def get_stats(self):
+        """
+        Returns the usage of the connection pool of every host
+        """
+        if self._adapter is None:
+            return {}
+
+        stats = {}
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+
+            stats["{}://{}:{}".format(pool.scheme, pool.host, pool.port)] = {
+                "connections": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": pool.pool.qsize() if pool.pool is not None else 0,
+            }
+
+        return stats
+
+    def reset(self):
+        """
+        Forgets the current session without closing it, used after a fork since the
+        sockets of the pool belong to the parent process
+        """
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._session = None
+        self._adapter = None
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+
+            self._session = None
+            self._adapter = None
+
+
+_registry = SessionRegistry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_registry.reset)
+
+
+def get_http_session():
+    """
+    Gets the HTTP session shared by the whole process. Requests made with it reuse the
+    pooled connections, use the configured timeouts and retry idempotent methods
+    """
+    return _registry.get_session()
+
+
+def get_http_pool_stats():
+    """
+    Returns the number of connections opened, the requests made and the idle connections
+    of the pool of every host accessed by the process
+    """
+    return _registry.get_stats()
+
+
+def close_http_session():
+    """
+    Closes the shared HTTP session of the current process
+    """
+    _registry.close()
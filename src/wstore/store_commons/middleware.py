@@ -20,15 +20,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from django.conf import settings
 from django.utils.functional import SimpleLazyObject
 
+from wstore.store_commons.utils.cache import TTLCache
+from wstore.store_commons.utils.identity_map import identity_scope
+
+# Ids of the users and organizations already synchronized with the identity headers, by the fingerprint
+# of the headers. Only ids are cached, model instances are loaded on every request so they are never shared
+_identities = TTLCache(getattr(settings, "AUTH_CACHE_SIZE", 1000), getattr(settings, "AUTH_CACHE_TTL", 60))
+
 
 class AuthenticationMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
 
     def _get_api_user(self, request):
-        from django.conf import settings
         from django.contrib.auth.models import AnonymousUser
         from wstore.models import Organization, User
 
@@ -55,29 +62,65 @@ class AuthenticationMiddleware:
         if len(token_info) != 2 and token_info[0].lower() != "bearer":
             return AnonymousUser()
 
+        # Requests with the same identity headers resolve to the same user
+        fingerprint = (
+            token_info[1],
+            user_name,
+            nick_name,
+            display_name,
+            email,
+            tuple(roles),
+            external_username,
+            idp,
+            issuerDid,
+        )
+        user_roles = []
+
+        if settings.PROVIDER_ROLE in roles:
+            user_roles.append("provider")
+
+        if settings.CUSTOMER_ROLE in roles:
+            user_roles.append("customer")
+
+        identity = _identities.get(fingerprint)
+        if identity is not None:
+            user_pk, org_pk = identity
+            try:
+                # The profile may have been switched to other organization by a request with other
+                # headers, so it is only reused if it still matches these ones
+                user = User.objects.get(pk=user_pk)
+                profile = user.userprofile
+                if (
+                    profile.access_token == token_info[1]
+                    and profile.current_roles == user_roles
+                    and profile.current_organization_id == org_pk
+                ):
+                    return user
+            except:
+                pass
+
         # Check if the user already exist
         try:
             user = User.objects.get(username=user_name)
         except:
             user = User.objects.create(username=user_name)
 
+        # Only the changed documents are saved
+        profile = user.userprofile
+        profile_changed = False
+
         if nick_name == user_name:
             # Update user info
-            user.email = email
-            user.userprofile.complete_name = display_name
-            user.userprofile.actor_id = external_username
-            user.is_staff = settings.ADMIN_ROLE.lower() in roles
-            user.save()
-
-        user.userprofile.access_token = token_info[1]
-
-        user_roles = []
+            is_staff = settings.ADMIN_ROLE.lower() in roles
+            if user.email != email or user.is_staff != is_staff:
+                user.email = email
+                user.is_staff = is_staff
+                user.save()
 
-        if settings.PROVIDER_ROLE in roles:
-            user_roles.append("provider")
-
-        if settings.CUSTOMER_ROLE in roles:
-            user_roles.append("customer")
+            if profile.complete_name != display_name or profile.actor_id != external_username:
+                profile.complete_name = display_name
+                profile.actor_id = external_username
+                profile_changed = True
 
         # Get or create current organization
         try:
@@ -85,17 +128,28 @@ class AuthenticationMiddleware:
         except:
             org = Organization.objects.create(name=nick_name)
 
-        org.private = nick_name == user_name
-        org.idp = idp
-        org.issuerDid = issuerDid
-        org.save()
-
-        user.userprofile.current_roles = user_roles
-        user.userprofile.current_organization = org
+        private = nick_name == user_name
+        if org.private != private or org.idp != idp or org.issuerDid != issuerDid:
+            org.private = private
+            org.idp = idp
+            org.issuerDid = issuerDid
+            org.save()
+
+        if (
+            profile.access_token != token_info[1]
+            or profile.current_roles != user_roles
+            or profile.current_organization_id != org.pk
+        ):
+            profile.access_token = token_info[1]
+            profile.current_roles = user_roles
+            profile.current_organization = org
+            profile_changed = True
 
         # change user.userprofile.current_organization
-        user.userprofile.save()
+        if profile_changed:
+            profile.save()
 
+        _identities.set(fingerprint, (user.pk, org.pk))
         return user
 
     def __call__(self, request):
@@ -103,3 +157,17 @@ class AuthenticationMiddleware:
 
         response = self.get_response(request)
         return response
+
+
+class IdentityMapMiddleware:
+    """
+    Scopes an identity map to each request, so the offerings and resources used by the
+    different components are loaded once
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_scope():
+            return self.get_response(request)
@@ -20,6 +20,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from http.client import HTTPMessage
 from importlib import reload
 
 from bson import ObjectId
@@ -28,8 +32,11 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from mock import MagicMock, call
 from parameterized import parameterized
+from requests import Request
+from requests.cookies import MockRequest, MockResponse
 
-from wstore.store_commons import database, middleware, rollback
+from wstore.store_commons import async_client, database, http_session, middleware, rollback
+from wstore.store_commons.errors import DocumentNotFoundError, LockTimeoutError
 from wstore.store_commons.utils.url import is_valid_url
 
 __test__ = False
@@ -70,6 +77,8 @@ class AuthenticationMiddlewareTestCase(TestCase):
 
         wstore.models.Organization = self._org_model
 
+        middleware._identities.clear()
+
     def tearDown(self):
         import wstore.models
 
@@ -225,6 +234,87 @@ class AuthenticationMiddlewareTestCase(TestCase):
         self._org_instance.save.assert_called_once_with()
         self._user_inst.userprofile.save.assert_called_once_with()
 
+    def _set_identity_headers(self, roles="customer"):
+        self.request.META.update(
+            {
+                "HTTP_X_ROLES": roles,
+                "HTTP_AUTHORIZATION": "Bearer 1234567890abcdf",
+                "HTTP_X_EMAIL": "user@email.com",
+                "HTTP_X_EXT_NAME": "user",
+                "HTTP_X_IDP_ID": "local",
+            }
+        )
+
+    def _call_middleware(self):
+        middleware.AuthenticationMiddleware(lambda request: None)(self.request)
+
+        # Resolve the lazy user
+        self.request.user.username
+        return self.request.user
+
+    def test_get_api_user_unchanged(self):
+        self._set_identity_headers()
+
+        # The stored user and organization already match the headers
+        self._user_inst.email = "user@email.com"
+        self._user_inst.is_staff = False
+        profile = self._user_inst.userprofile
+        profile.complete_name = "Test user"
+        profile.actor_id = "user"
+        profile.access_token = "1234567890abcdf"
+        profile.current_roles = ["customer"]
+        profile.current_organization_id = "org"
+        self._org_instance.private = True
+        self._org_instance.idp = "local"
+        self._org_instance.issuerDid = "none"
+
+        self.assertEqual(self._user_inst, self._call_middleware())
+
+        self._user_inst.save.assert_not_called()
+        self._org_instance.save.assert_not_called()
+        profile.save.assert_not_called()
+
+    def test_get_api_user_cached(self):
+        self._set_identity_headers()
+        self._user_inst.userprofile.current_organization_id = "org"
+        user = self._call_middleware()
+
+        # Requests with the same headers load the user again, but do not synchronize it
+        self.assertEqual(self._user_inst, user)
+        self.assertEqual(user, self._call_middleware())
+
+        self.assertEqual(
+            [call(username="test-user"), call(pk=self._user_inst.pk)], self._user_model.objects.get.call_args_list
+        )
+        self._org_model.objects.get.assert_called_once_with(name="test-user")
+
+        # A change in the headers resolves the user again
+        self._set_identity_headers(roles="customer,seller")
+        self._call_middleware()
+
+        self.assertEqual(3, self._user_model.objects.get.call_count)
+        self.assertEqual(["provider", "customer"], self._user_inst.userprofile.current_roles)
+
+    def test_get_api_user_cached_profile_changed(self):
+        self._set_identity_headers()
+        profile = self._user_inst.userprofile
+        profile.current_organization_id = "org"
+        self._call_middleware()
+
+        # Other request switched the profile to other organization
+        profile.current_organization_id = "other-org"
+        profile.save.reset_mock()
+
+        self.assertEqual(self._user_inst, self._call_middleware())
+
+        # The cached identity is not used, so the profile is synchronized again
+        self.assertEqual(
+            [call(username="test-user"), call(pk=self._user_inst.pk), call(username="test-user")],
+            self._user_model.objects.get.call_args_list,
+        )
+        self.assertEqual(self._org_instance, profile.current_organization)
+        profile.save.assert_called_once_with()
+
 
 @override_settings(BASEDIR="/base/dir")
 class RollbackTestCase(TestCase):
@@ -360,6 +450,222 @@ class RollbackTestCase(TestCase):
         rollback.downgrade_asset_pa(manager())
 
 
+@override_settings(
+    DATABASES={
+        "default": {
+            "NAME": "wstore_db",
+            "CLIENT": {"host": "mongo", "port": "27018", "username": "user", "password": "passwd"},
+        }
+    },
+    MONGO_MAX_POOL_SIZE=20,
+    MONGO_MIN_POOL_SIZE=2,
+)
+class DatabaseConnectionTestCase(TestCase):
+    tags = ("database",)
+
+    def setUp(self):
+        self._old_client = database.MongoClient
+        database.MongoClient = MagicMock()
+
+        self._registry = database.ClientRegistry()
+
+    def tearDown(self):
+        database.MongoClient = self._old_client
+
+    def test_client_is_shared(self):
+        db = self._registry.get_database()
+        db2 = self._registry.get_database(database.PRIMARY)
+
+        self.assertEquals(db, db2)
+        database.MongoClient.assert_called_once_with(
+            "mongo", 27018, maxPoolSize=20, minPoolSize=2, username="user", password="passwd", authSource="wstore_db"
+        )
+        database.MongoClient.return_value.get_database.assert_called_once_with(
+            "wstore_db", read_preference=database.ReadPreference.PRIMARY
+        )
+
+    def test_secondary_role(self):
+        self._registry.get_database()
+        self._registry.get_database(database.SECONDARY_PREFERRED)
+
+        self.assertEquals(1, database.MongoClient.call_count)
+        self.assertEquals(
+            [
+                call("wstore_db", read_preference=database.ReadPreference.PRIMARY),
+                call("wstore_db", read_preference=database.ReadPreference.SECONDARY_PREFERRED),
+            ],
+            database.MongoClient.return_value.get_database.call_args_list,
+        )
+
+    def test_invalid_role(self):
+        with self.assertRaises(ValueError):
+            self._registry.get_database("arbiter")
+
+    def test_reset_after_fork(self):
+        self._registry.get_database()
+
+        # Simulate that the registry has been inherited by a child process
+        self._registry._pid = -1
+        self._registry.get_database()
+
+        self.assertEquals(2, database.MongoClient.call_count)
+        database.MongoClient.return_value.close.assert_not_called()
+
+    def test_close(self):
+        self._registry.get_database()
+        self._registry.close()
+
+        database.MongoClient.return_value.close.assert_called_once_with()
+        self._registry.get_database()
+        self.assertEquals(2, database.MongoClient.call_count)
+
+
+class HTTPSessionTestCase(TestCase):
+    tags = ("http-session",)
+
+    def setUp(self):
+        self._registry = http_session.SessionRegistry()
+
+    def tearDown(self):
+        self._registry.close()
+
+    @override_settings(HTTP_POOL_HOSTS=4, HTTP_POOL_SIZE=8, HTTP_RETRIES=2)
+    def test_session_is_shared(self):
+        session = self._registry.get_session()
+
+        self.assertIs(session, self._registry.get_session())
+        adapter = session.get_adapter("https://example.com")
+        self.assertIs(adapter, session.get_adapter("http://example.com"))
+        self.assertEquals(4, adapter._pool_connections)
+        self.assertEquals(8, adapter._pool_maxsize)
+        self.assertEquals(2, adapter.max_retries.total)
+        self.assertEquals((502, 503, 504), adapter.max_retries.status_forcelist)
+
+    def test_only_idempotent_methods_retried(self):
+        retries = self._registry.get_session().get_adapter("http://example.com").max_retries
+
+        self.assertTrue(retries.is_retry("GET", 503))
+        self.assertTrue(retries.is_retry("PUT", 503))
+        self.assertFalse(retries.is_retry("POST", 503))
+        self.assertFalse(retries.is_retry("PATCH", 503))
+
+    @parameterized.expand([("default", None, (5.0, 60.0)), ("explicit", 10, 10)])
+    @override_settings(HTTP_CONNECT_TIMEOUT=5, HTTP_READ_TIMEOUT=60)
+    def test_default_timeout(self, name, timeout, expected):
+        session = self._registry.get_session()
+        adapter = MagicMock()
+        adapter.send.return_value = MagicMock(url="http://example.com/api", is_redirect=False, raw=None)
+        session.get_adapter = MagicMock(return_value=adapter)
+
+        session.get("http://example.com/api", timeout=timeout)
+
+        self.assertEquals(expected, adapter.send.call_args[1]["timeout"])
+
+    def test_cookies_not_stored(self):
+        session = self._registry.get_session()
+        headers = HTTPMessage()
+        headers["Set-Cookie"] = "sessionid=1234; Path=/"
+        request = Request("GET", "http://example.com/api").prepare()
+
+        session.cookies.extract_cookies(MockResponse(headers), MockRequest(request))
+
+        self.assertEquals(0, len(session.cookies))
+
+    def test_reset_after_fork(self):
+        session = self._registry.get_session()
+        session.close = MagicMock()
+
+        # Simulate that the registry has been inherited by a child process
+        self._registry._pid = -1
+
+        self.assertIsNot(session, self._registry.get_session())
+        session.close.assert_not_called()
+
+    def test_pool_stats(self):
+        self.assertEquals({}, self._registry.get_stats())
+
+        adapter = self._registry.get_session().get_adapter("http://example.com")
+        pool = adapter.poolmanager.connection_from_url("http://example.com/api")
+        pool.num_connections = 2
+        pool.num_requests = 5
+
+        self.assertEquals(
+            {"http://example.com:80": {"connections": 2, "requests": 5, "idle": pool.pool.qsize()}},
+            self._registry.get_stats(),
+        )
+
+
+class AsyncClientTestCase(TestCase):
+    tags = ("async-client",)
+
+    def setUp(self):
+        self._client = MagicMock()
+        self._client.get_product.return_value = {"id": "1"}
+        self._client.api = "http://example.com/"
+
+    def test_client_methods(self):
+        client = async_client.AsyncClient(self._client)
+
+        self.assertEquals({"id": "1"}, async_client.run_sync(client.get_product("1", expand=True)))
+        self._client.get_product.assert_called_once_with("1", expand=True)
+        self.assertEquals("http://example.com/", client.api)
+
+        with self.assertRaises(AttributeError):
+            client._private
+
+    def test_client_class(self):
+        client_class = MagicMock(return_value=self._client)
+
+        class TestClient(async_client.AsyncClient):
+            pass
+
+        TestClient.client_class = client_class
+
+        async_client.run_sync(TestClient().get_product("1"))
+        client_class.assert_called_once_with()
+        self._client.get_product.assert_called_once_with("1")
+
+    def test_run_concurrently(self):
+        started = []
+        barrier = threading.Barrier(3, timeout=5)
+
+        def get_product(product_id):
+            # Every call waits for the others, so it only finishes if all of them run at the same time
+            started.append(product_id)
+            barrier.wait()
+            if product_id == "3":
+                raise ValueError("Invalid product")
+
+            return {"id": product_id}
+
+        self._client.get_product.side_effect = get_product
+        client = async_client.AsyncClient(self._client)
+
+        results = async_client.run_concurrently(
+            *[client.get_product(product_id) for product_id in ("1", "2", "3")], return_exceptions=True
+        )
+
+        self.assertEquals([{"id": "1"}, {"id": "2"}], results[:2])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEquals(["1", "2", "3"], sorted(started))
+
+    def test_run_concurrently_error(self):
+        self._client.get_product.side_effect = ValueError("Invalid product")
+        client = async_client.AsyncClient(self._client)
+
+        with self.assertRaises(ValueError):
+            async_client.run_concurrently(client.get_product("1"))
+
+    def test_run_sync_running_loop(self):
+        client = async_client.AsyncClient(self._client)
+
+        async def handler():
+            # Synchronous code called from a coroutine cannot block the running loop
+            return async_client.run_sync(client.get_product("1"))
+
+        self.assertEquals({"id": "1"}, asyncio.run(handler()))
+
+
 class DocumentLockTestCase(TestCase):
     tags = ("lock",)
 
@@ -371,31 +677,141 @@ class DocumentLockTestCase(TestCase):
         self._connection = MagicMock()
         database.get_database_connection = MagicMock(return_value=self._connection)
 
+        self._now = datetime(2023, 5, 1, 10, 0, 0)
+        self._datetime = database.datetime
+        database.datetime = MagicMock()
+        database.datetime.utcnow.return_value = self._now
+
+        self._uuid4 = database.uuid4
+        database.uuid4 = MagicMock()
+        database.uuid4.return_value.hex = "owner"
+
+        self._time = database.time
+        database.time = MagicMock()
+        database.time.monotonic.return_value = 0
+
+    def tearDown(self):
+        database.datetime = self._datetime
+        database.uuid4 = self._uuid4
+        database.time = self._time
+
+    def _lock_query(self):
+        return {
+            "_id": self._id,
+            "$or": [
+                {self._lock_id: {"$in": [None, False]}},
+                {self._lock_id + ".owner": "owner"},
+                {self._lock_id + ".expires": {"$lt": self._now}},
+            ],
+        }
+
+    def _lease(self):
+        return {"$set": {self._lock_id: {"owner": "owner", "expires": self._now + timedelta(seconds=30)}}}
+
     def test_wait_for_document(self):
         self._connection[self._collection].find_one_and_update.side_effect = [
-            {self._lock_id: True},
-            {self._lock_id: False},
+            None,
+            {self._lock_id: {"owner": "other", "expires": self._now}},
         ]
 
-        lock = database.DocumentLock(self._collection, self._id, "test")
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=30)
         lock.wait_document()
 
         # Check database calls
         self.assertEquals(
-            [
-                call({"_id": self._id}, {"$set": {self._lock_id: True}}),
-                call({"_id": self._id}, {"$set": {self._lock_id: True}}),
-            ],
+            [call(self._lock_query(), self._lease()), call(self._lock_query(), self._lease())],
             self._connection[self._collection].find_one_and_update.call_args_list,
         )
+        self.assertEquals(1, database.time.sleep.call_count)
+
+    def test_wait_for_document_timeout(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        database.time.monotonic.side_effect = [0, 0.5, 1.5, 3]
+
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=30)
+
+        with self.assertRaises(LockTimeoutError):
+            lock.wait_document(timeout=2)
+
+        # The existence of the document is checked once while waiting
+        self.assertEquals(3, self._connection[self._collection].find_one_and_update.call_count)
+        self._connection[self._collection].find_one.assert_called_once_with({"_id": self._id}, {"_id": 1})
+
+    def test_wait_for_missing_document(self):
+        self._connection[self._collection].find_one_and_update.return_value = None
+        self._connection[self._collection].find_one.return_value = None
+
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=30)
+
+        with self.assertRaises(DocumentNotFoundError):
+            lock.wait_document()
+
+        self._connection[self._collection].find_one.assert_called_once_with({"_id": self._id}, {"_id": 1})
+        database.time.sleep.assert_not_called()
+
+    @override_settings(DOCUMENT_LOCK_TTL=30)
+    def test_lock_context_manager(self):
+        with database.DocumentLock(self._collection, self._id, "test"):
+            self._connection[self._collection].find_one_and_update.assert_called_once_with(
+                self._lock_query(), self._lease()
+            )
+            self._connection[self._collection].update_one.assert_not_called()
+
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {"_id": self._id, self._lock_id + ".owner": "owner"}, {"$unset": {self._lock_id: ""}}
+        )
+
+    def test_wait_for_document_async(self):
+        self._connection[self._collection].find_one_and_update.return_value = {}
+
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=30)
+        asyncio.run(lock.wait_document_async())
+
+        self._connection[self._collection].find_one_and_update.assert_called_once_with(
+            self._lock_query(), self._lease()
+        )
+
+    @parameterized.expand([("renewed", 1, True), ("lost", 0, False)])
+    def test_renew_lease(self, name, matched, expected):
+        self._connection[self._collection].update_one.return_value.matched_count = matched
+
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=30)
+        self.assertEquals(expected, lock.renew())
+
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {"_id": self._id, self._lock_id + ".owner": "owner"}, self._lease()
+        )
+
+    def test_lease_heartbeat(self):
+        self._connection[self._collection].find_one_and_update.return_value = {}
+
+        lock = database.DocumentLock(self._collection, self._id, "test", ttl=0.03, heartbeat=True)
+        lock.wait_document()
+
+        # The lease is renewed in background while the document is locked
+        renewed = threading.Event()
+
+        def renew(*args):
+            renewed.set()
+            return MagicMock(matched_count=1)
+
+        self._connection[self._collection].update_one.side_effect = renew
+        self.assertTrue(renewed.wait(5))
+
+        lock.unlock_document()
+        self._connection[self._collection].update_one.assert_any_call(
+            {"_id": self._id, self._lock_id + ".owner": "owner"},
+            {"$set": {self._lock_id: {"owner": "owner", "expires": self._now + timedelta(seconds=0.03)}}},
+        )
+        self.assertIsNone(lock._heartbeat_stop)
 
     def test_unlock_document(self):
         lock = database.DocumentLock(self._collection, self._id, "test")
         lock.unlock_document()
 
         # Check database calls
-        self._connection[self._collection].find_one_and_update.assert_called_once_with(
-            {"_id": self._id}, {"$set": {self._lock_id: False}}
+        self._connection[self._collection].update_one.assert_called_once_with(
+            {"_id": self._id, self._lock_id + ".owner": "owner"}, {"$unset": {self._lock_id: ""}}
         )
 
 
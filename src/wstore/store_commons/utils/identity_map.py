@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2023 Future Internet Consulting and Development Solutions S.L.
+
+# This file belongs to the business-charging-backend
+# of the Business API Ecosystem.
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from contextlib import contextmanager
+from logging import getLogger
+
+logger = getLogger("wstore.default_logger")
+
+_local = threading.local()
+
+
+class IdentityMap:
+    """
+    Keeps the model instances loaded within a request or job, so every object is
+    retrieved from the database once
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self.queries = 0
+        self.saved = 0
+
+    def _get_key(self, model, pk):
+        return model, str(pk)
+
+    def get(self, model, pk):
+        key = self._get_key(model, pk)
+
+        if key in self._objects:
+            self.saved += 1
+        else:
+            self._objects[key] = model.objects.get(pk=pk)
+            self.queries += 1
+
+        return self._objects[key]
+
+    def get_many(self, model, pks):
+        """
+        Returns the objects with the given primary keys in the same order, loading
+        the missing ones with a single query
+        :param model: Model class of the objects
+        :param pks: List of primary keys, may contain duplicates
+        """
+        missing = {}
+        for pk in pks:
+            key = self._get_key(model, pk)
+            if key not in self._objects:
+                missing[key] = pk
+
+        if len(missing):
+            for obj in model.objects.filter(pk__in=list(missing.values())):
+                self._objects[self._get_key(model, obj.pk)] = obj
+
+            self.queries += 1
+
+        objects = []
+        for pk in pks:
+            key = self._get_key(model, pk)
+            if key in missing:
+                # The first occurrence of a missing object is loaded from the database
+                del missing[key]
+
+                if key not in self._objects:
+                    # Objects not returned by the batch query raise the usual DoesNotExist
+                    self._objects[key] = model.objects.get(pk=pk)
+                    self.queries += 1
+            else:
+                self.saved += 1
+
+            objects.append(self._objects[key])
+
+        return objects
+
+
+def get_identity_map():
+    """
+    Returns the identity map of the current scope, or None if there is no active scope
+    """
+    return getattr(_local, "identity_map", None)
+
+
+@contextmanager
+def identity_scope():
+    """
+    Activates an identity map for the current thread. Nested scopes share the outer map
+    """
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        yield identity_map
+        return
+
+    identity_map = IdentityMap()
+    _local.identity_map = identity_map
+    try:
+        yield identity_map
+    finally:
+        _local.identity_map = None
+
+        if identity_map.saved:
+            logger.debug(f"Identity map saved {identity_map.saved} queries ({identity_map.queries} executed)")
+
+
+def get_object(model, pk):
+    """
+    Retrieves a model instance by its primary key, reusing the one already loaded
+    in the current scope
+    """
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return model.objects.get(pk=pk)
+
+    return identity_map.get(model, pk)
+
+
+def get_objects(model, pks):
+    """
+    Retrieves a list of model instances by their primary keys with a single query
+    """
+    return (get_identity_map() or IdentityMap()).get_many(model, pks)
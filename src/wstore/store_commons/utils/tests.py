@@ -22,8 +22,10 @@
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
+from mock import MagicMock
 from parameterized import parameterized
 
+from wstore.store_commons.utils import cache, identity_map
 from wstore.store_commons.utils.units import ChargePeriod, CurrencyCode
 
 
@@ -117,3 +119,114 @@ class CurrencyCodeUnitsTestCase(TestCase):
             self.valid,
         ]
         self.assertEqual(CurrencyCode.to_json(), dict_expected)
+
+
+class TTLCacheTestCase(TestCase):
+    tags = ("cache",)
+
+    def setUp(self):
+        self._time = cache.time
+        cache.time = MagicMock()
+        cache.time.monotonic.return_value = 100
+
+    def tearDown(self):
+        cache.time = self._time
+
+    def test_expiration(self):
+        ttl_cache = cache.TTLCache(10, 30)
+        ttl_cache.set("key", False)
+
+        cache.time.monotonic.return_value = 129
+        self.assertFalse(ttl_cache.get("key", "missing"))
+
+        cache.time.monotonic.return_value = 130
+        self.assertEqual("missing", ttl_cache.get("key", "missing"))
+        self.assertEqual(0, len(ttl_cache))
+
+    def test_eviction(self):
+        ttl_cache = cache.TTLCache(2, 30)
+        ttl_cache.set("key1", 1)
+        ttl_cache.set("key2", 2)
+
+        # The least recently used entry is evicted
+        ttl_cache.get("key1")
+        ttl_cache.set("key3", 3)
+
+        self.assertEqual([1, None, 3], [ttl_cache.get(key) for key in ("key1", "key2", "key3")])
+
+    def test_invalidation(self):
+        ttl_cache = cache.TTLCache(10, 30)
+        ttl_cache.set("key1", 1)
+        ttl_cache.set("key2", 2)
+
+        ttl_cache.invalidate("key1")
+        ttl_cache.invalidate("missing")
+        self.assertEqual([None, 2], [ttl_cache.get("key1"), ttl_cache.get("key2")])
+
+        ttl_cache.clear()
+        self.assertIsNone(ttl_cache.get("key2"))
+
+
+class IdentityMapTestCase(TestCase):
+    tags = ("identity-map",)
+
+    def setUp(self):
+        self._model = MagicMock()
+        self._model.objects.get.side_effect = lambda pk: MagicMock(pk=pk)
+
+    def test_get_without_scope(self):
+        first = identity_map.get_object(self._model, "1")
+        second = identity_map.get_object(self._model, "1")
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(2, self._model.objects.get.call_count)
+
+    def test_get_in_scope(self):
+        with identity_map.identity_scope() as scope:
+            first = identity_map.get_object(self._model, "1")
+            self.assertEqual(first, identity_map.get_object(self._model, "1"))
+
+            # Nested scopes share the loaded objects
+            with identity_map.identity_scope():
+                self.assertEqual(first, identity_map.get_object(self._model, "1"))
+
+        self._model.objects.get.assert_called_once_with(pk="1")
+        self.assertEqual(1, scope.queries)
+        self.assertEqual(2, scope.saved)
+        self.assertIsNone(identity_map.get_identity_map())
+
+    def test_get_many(self):
+        obj1, obj2, obj3 = MagicMock(pk="1"), MagicMock(pk="2"), MagicMock(pk="3")
+        self._model.objects.get.side_effect = [obj1]
+        self._model.objects.filter.return_value = [obj3, obj2]
+
+        with identity_map.identity_scope() as scope:
+            self.assertEqual(obj1, identity_map.get_object(self._model, "1"))
+            objects = identity_map.get_objects(self._model, ["2", "1", "3", "2"])
+
+        self.assertEqual([obj2, obj1, obj3, obj2], objects)
+        self._model.objects.filter.assert_called_once_with(pk__in=["2", "3"])
+        self.assertEqual(2, scope.queries)
+
+        # Only the loaded "1" and the repeated "2" are served from the map
+        self.assertEqual(2, scope.saved)
+
+    def test_get_many_not_batched(self):
+        obj1, obj2 = MagicMock(pk="1"), MagicMock(pk="2")
+        self._model.objects.get.side_effect = [obj2]
+        self._model.objects.filter.return_value = [obj1]
+
+        with identity_map.identity_scope() as scope:
+            objects = identity_map.get_objects(self._model, ["1", "2", "1"])
+
+        self.assertEqual([obj1, obj2, obj1], objects)
+        self._model.objects.get.assert_called_once_with(pk="2")
+        self.assertEqual(2, scope.queries)
+        self.assertEqual(1, scope.saved)
+
+    def test_get_many_missing(self):
+        self._model.objects.filter.return_value = []
+        self._model.objects.get.side_effect = Exception("Not found")
+
+        with self.assertRaises(Exception):
+            identity_map.get_objects(self._model, ["1"])
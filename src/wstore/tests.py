@@ -72,6 +72,11 @@ class ServeMediaTestCase(TestCase):
         self._offering_inst.asset = self._asset_inst
         views.Offering.objects.get.side_effect = [MagicMock(), self._offering_inst]
 
+        # Mock entitlement index, not built by default
+        views.EntitlementIndex = MagicMock()
+        self._entitlements = views.EntitlementIndex.return_value
+        self._entitlements.is_built.return_value = False
+
     def _validate_res_call(self):
         views.Resource.objects.filter.assert_called_once_with(resource_path=self._resource_path)
         self.assertEquals(0, views.Order.objects.get.call_count)
@@ -116,6 +121,13 @@ class ServeMediaTestCase(TestCase):
             views.Offering.objects.get.call_args_list,
         )
 
+    def _validate_index_call(self):
+        self._validate_res_call()
+        self.assertEquals(0, views.Offering.objects.get.call_count)
+        self._entitlements.is_granted.assert_called_once_with(
+            str(self._user.userprofile.current_organization.pk), str(self._asset_inst.pk)
+        )
+
     def _validate_upgrading_call(self):
         self.assertEquals(
             [
@@ -212,6 +224,15 @@ class ServeMediaTestCase(TestCase):
             self._asset_inst,
         ]
 
+    def _indexed(self):
+        self._acquired()
+        self._entitlements.is_built.return_value = True
+        self._entitlements.is_granted.return_value = True
+
+    def _not_indexed(self):
+        self._indexed()
+        self._entitlements.is_granted.return_value = False
+
     def _upgrading(self):
         self._asset_inst.old_versions = [MagicMock(resource_path=self._resource_path)]
         views.Resource.objects.filter.side_effect = [
@@ -256,6 +277,15 @@ class ServeMediaTestCase(TestCase):
                 _expected_file,
                 _product_bundle_acquired,
             ),
+            (
+                "asset_indexed",
+                "assets/test_user",
+                "widget.wgt",
+                _validate_index_call,
+                _validate_serve,
+                _expected_file,
+                _indexed,
+            ),
             (
                 "public_asset",
                 "assets/test_user",
@@ -325,6 +355,21 @@ class ServeMediaTestCase(TestCase):
                 ),
                 _unauthorized,
             ),
+            (
+                "asset_not_indexed",
+                "assets/test_user",
+                "widget.wgt",
+                _validate_index_call,
+                _validate_error,
+                (
+                    403,
+                    {
+                        "result": "error",
+                        "error": "You are not authorized to download the specified asset",
+                    },
+                ),
+                _not_indexed,
+            ),
             (
                 "invoice_not_found",
                 "bills",
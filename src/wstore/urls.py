@@ -107,6 +107,10 @@ urlpatterns = [
         r"^charging/api/orderManagement/accounting/?$",
         accounting_views.ServiceRecordCollection(permitted_methods=("POST",)),
     ),
+    url(
+        r"^charging/api/orderManagement/accounting/batch/?$",
+        accounting_views.ServiceRecordBatchCollection(permitted_methods=("POST",)),
+    ),
     url(
         r"^charging/api/orderManagement/accounting/refresh/?$",
         accounting_views.SDRRefreshCollection(permitted_methods=("POST",)),